@@ -513,6 +513,7 @@ class Visibility:
         self.phasecentre = phasecentre  # Phase centre of observation
         self.configuration = configuration  # Antenna/station configuration
         self.polarisation_frame = polarisation_frame
+        self.gridding_order = None  # Cached (key, permutation) from get_gridding_order
     
     def __str__(self):
         """Default printer for Skycomponent
@@ -49,6 +49,12 @@ G_solution_interval     Solution interval for G term        100
 phaseonly               Do phase-only solutions             True
 phasecentre             Phase centre (usually as SkyCoord)  SkyCoord("-1.0d", "37.0d", frame='icrs', equinox='J2000')
 spectral_mode           Visibility processing mode          'mfs' or 'channel'
+precision               Floating point precision of images  'double' or 'single'
+epsilon                 Target accuracy of gridding         1e-6
+uvgrid_tile             Size of tiles of a sparse uv grid   64
+freqwin_batch           Frequency windows imaged per task   16 (default 1, one task per window)
+dft_block_size          Phasors per block of a DFT          1048576
+timeslice_resample      Timeslice image interpolation       'spline' or 'griddata'
 ====================    ==================================  ========================================================
 
 """
@@ -56,6 +62,8 @@ spectral_mode           Visibility processing mode          'mfs' or 'channel'
 import logging
 import os
 
+import numpy
+
 log = logging.getLogger(__name__)
 
 
@@ -92,3 +100,21 @@ def get_parameter(kwargs, key, default=None):
     if key in kwargs.keys():
         value = kwargs[key]
     return value
+
+
+def get_precision_dtypes(kwargs):
+    """ Get the real and complex dtypes for the precision parameter
+
+    precision='double' (the default) gives float64 and complex128, precision='single' gives float32 and
+    complex64.
+
+    :param kwargs: Parameter dictionary
+    :return: real dtype, complex dtype
+    """
+    precision = get_parameter(kwargs, 'precision', 'double')
+    if precision == 'double':
+        return numpy.dtype('float64'), numpy.dtype('complex128')
+    elif precision == 'single':
+        return numpy.dtype('float32'), numpy.dtype('complex64')
+    else:
+        raise ValueError("Unknown precision %s" % precision)
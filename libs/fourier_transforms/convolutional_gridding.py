@@ -9,9 +9,12 @@ This module contains functions for performing the gridding process and the inver
 """
 
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy
 
+from libs.util.numba_support import jit, numba_available, warn_numba_unavailable
+
 log = logging.getLogger(__name__)
 
 
@@ -152,6 +155,187 @@ def grdsf(nu):
     return grdsf, (1 - nu ** 2) * grdsf
 
 
+def es_kernel_parameters(epsilon, padding=2.0):
+    """ Width, shape parameter and table oversampling of the exponential of semicircle kernel for a target accuracy
+
+    The width and shape follow Barnett, Magland and af Klinteberg, SIAM J. Sci. Comput. 41, C479 (2019) for the
+    grid padding (upsampling) factor. The oversampling of a kernel table is chosen so that the phase error from
+    rounding the uv positions to the table is less than epsilon / 2 at the corners of the
+    unpadded image.
+
+    :param epsilon: Target relative accuracy
+    :param padding: Padding of the grid
+    :return: width (pixels), beta, oversampling
+    """
+    assert 0.0 < epsilon < 1.0, "Accuracy must be between 0 and 1"
+    assert padding > 1.0, "Exponential of semicircle kernel needs a padded grid"
+    width = int(numpy.ceil(-numpy.log(epsilon / 10.0) / (numpy.pi * numpy.sqrt(1.0 - 1.0 / padding))))
+    width = max(width, 2)
+    beta = 0.97 * numpy.pi * width * (1.0 - 0.5 / padding)
+    oversampling = int(numpy.ceil(2.0 * numpy.pi / (padding * epsilon)))
+    return width, beta, oversampling
+
+
+def es_padding(epsilon, nvis, npixel, paddings=(1.25, 1.5, 2.0)):
+    """ Padding giving the least work for the exponential of semicircle kernel at a target accuracy
+
+    Less padding needs a wider kernel. The work is estimated as nvis * width ** 2 for the gridding and
+    5 * n * log2(n) for the FFT of the n pixel padded grid.
+
+    :param epsilon: Target relative accuracy
+    :param nvis: Number of visibilities
+    :param npixel: Number of pixels on the side of the unpadded image
+    :param paddings: Paddings to choose from
+    :return: padding
+    """
+    def work(padding):
+        width, _, _ = es_kernel_parameters(epsilon, padding)
+        npad = (padding * npixel) ** 2
+        return nvis * width ** 2 + 5.0 * npad * numpy.log2(npad)
+
+    return min(paddings, key=work)
+
+
+def es_kernel(nu, beta):
+    """ Exponential of semicircle kernel exp(beta * (sqrt(1 - nu ** 2) - 1)), zero for abs(nu) >= 1
+
+    :param nu: Coordinate in units of the kernel half width
+    :param beta: Shape parameter
+    :return: kernel values
+    """
+    nu = numpy.abs(numpy.asarray(nu, dtype='float'))
+    kernel = numpy.zeros_like(nu)
+    inside = nu < 1.0
+    kernel[inside] = numpy.exp(beta * (numpy.sqrt(1.0 - nu[inside] ** 2) - 1.0))
+    return kernel
+
+
+def es_grid_correction(npixel, width, beta):
+    """ Fourier transform of the exponential of semicircle kernel at the pixels of an image of npixel pixels
+
+    The transform is found by Gauss-Legendre quadrature, which is exact to rounding error for the kernel widths
+    used. The value at the centre is the integral of the kernel.
+
+    :param npixel: Number of pixels on the side of the image
+    :param width: Width of kernel (grid cells)
+    :param beta: Shape parameter
+    :return: transform [npixel]
+    """
+    nodes, weights = numpy.polynomial.legendre.leggauss(4 * width + 60)
+    halfwidth = 0.5 * width
+    phi = es_kernel(nodes, beta) * weights * halfwidth
+    return numpy.cos(2.0 * numpy.pi * numpy.outer(coordinates(npixel), nodes * halfwidth)) @ phi
+
+
+def es_calculate(shape, width, beta, oversampling=1):
+    """ Compute the grid correction function and oversampled kernel table for the exponential of semicircle kernel
+
+    The kernel table has the layout of anti_aliasing_calculate. The kernel is normalised by its integral so that
+    the grid correction function is exact.
+
+    :param shape: (height, width) pair of the padded grid
+    :param width: Width of kernel (grid cells)
+    :param beta: Shape parameter
+    :param oversampling: Number of sub-samples per grid pixel
+    :return: gcf[ny, nx], kernel[oversampling, oversampling, s1d, s1d]
+    """
+    ny, nx = shape
+    gcf1d = []
+    for n in (ny, nx):
+        ghat = es_grid_correction(n, width, beta)
+        g = numpy.zeros_like(ghat)
+        g[ghat > 0.0] = ghat[n // 2] / ghat[ghat > 0.0]
+        gcf1d.append(g)
+    gcf = numpy.outer(gcf1d[0], gcf1d[1])
+
+    integral = es_grid_correction(1, width, beta)[0]
+    s1d = es_table_width(width)
+    offsets = numpy.arange(s1d) - s1d // 2
+    kernel1d = numpy.array([es_kernel((offsets - f / oversampling) / (0.5 * width), beta)
+                            for f in range(oversampling)]) / integral
+    kernel4d = kernel1d[:, numpy.newaxis, :, numpy.newaxis] * kernel1d[numpy.newaxis, :, numpy.newaxis, :]
+    return gcf, kernel4d.astype('complex')
+
+
+def es_table_width(width):
+    """ Number of kernel taps (even) needed to hold a kernel of the given width at any fractional position
+
+    :param width: Width of kernel (grid cells)
+    :return: number of taps
+    """
+    return 2 * int(numpy.ceil(0.5 * width)) + 2
+
+
+def es_kernels_exact(shape, vuvwmap, width, beta, dtype='complex'):
+    """ Exponential of semicircle kernels evaluated at the exact uv position of each visibility
+
+    The kernels are for use with an oversampling of 1, so that the kernel index of each visibility is its row. This
+    removes the error from rounding the uv positions to an oversampled table.
+
+    :param shape: (height, width) pair of the padded grid
+    :param vuvwmap: map uvw to grid fractions
+    :param width: Width of kernel (grid cells)
+    :param beta: Shape parameter
+    :param dtype: dtype of the kernels
+    :return: kernels [nvis, 1, 1, s1d, s1d]
+    """
+    ny, nx = shape
+    integral = es_grid_correction(1, width, beta)[0]
+    s1d = es_table_width(width)
+    offsets = numpy.arange(s1d) - s1d // 2
+
+    def kernel1d(n, p):
+        x = n // 2 + p * n
+        fraction = x - numpy.floor(x + 0.5)
+        return es_kernel((offsets[numpy.newaxis, :] - fraction[:, numpy.newaxis]) / (0.5 * width), beta) / integral
+
+    ky = kernel1d(ny, vuvwmap[:, 1])
+    kx = kernel1d(nx, vuvwmap[:, 0])
+    kernels = (ky[:, :, numpy.newaxis] * kx[:, numpy.newaxis, :]).astype(dtype)
+    return kernels.reshape([len(vuvwmap), 1, 1, s1d, s1d])
+
+
+class ExactKernel:
+    """ Kernel evaluated at the exact uv position of each visibility, one chunk of rows at a time
+
+    This stands in for the kernel table of a kernel list (kernel_indices, [ExactKernel]). convolutional_grid,
+    convolutional_degrid and the tiled equivalents evaluate the kernels of a chunk of rows with kernel_list and grid
+    that chunk, so that no more than max_bytes of kernels are held at once. The shape is that of a table with
+    oversampling 1.
+    """
+
+    def __init__(self, function, support, dtype='complex', max_bytes=2 ** 26):
+        """ Kernel evaluated by function(shape, vuvwmap) giving kernels [nvis, 1, 1, support, support]
+
+        :param function: Function of the (height, width) pair of the grid and vuvwmap, e.g. es_kernels_exact
+        :param support: Number of kernel taps
+        :param dtype: dtype of the kernels
+        :param max_bytes: Largest size of the kernels of one chunk of rows
+        """
+        self.function = function
+        self.shape = (1, 1, support, support)
+        self.dtype = numpy.dtype(dtype)
+        self.max_bytes = max_bytes
+
+    def chunks(self, nvis):
+        """ Slices of rows holding no more than max_bytes of kernels
+
+        :param nvis: Number of visibilities
+        :return: list of slices
+        """
+        step = max(1, self.max_bytes // (self.shape[-1] * self.shape[-2] * self.dtype.itemsize))
+        return [slice(start, min(start + step, nvis)) for start in range(0, nvis, step)]
+
+    def kernel_list(self, shape, vuvwmap):
+        """ Kernel list with one kernel per visibility
+
+        :param shape: (height, width) pair of the grid
+        :param vuvwmap: map uvw to grid fractions for the rows of one chunk
+        :return: kernel list
+        """
+        return numpy.arange(len(vuvwmap)), self.function(shape, vuvwmap)
+
+
 def w_beam(npixel, field_of_view, w, cx=None, cy=None, remove_shift=False):
     """ W beam, the fresnel diffraction pattern arising from non-coplanar baselines
     
@@ -203,12 +387,70 @@ def frac_coord(npixel, kernel_oversampling, p):
     return flx.astype(int), fracx.astype(int)
 
 
-def convolutional_degrid(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap):
+def half_plane_uvwmap(vuvwmap, nx, margin):
+    """ Map uvw grid fractions for a grid of nx columns to those for its half plane grid
+
+    The half plane grid holds columns nx//2 - margin to nx - 1 of the full grid, so it can be used by the gridding
+    and degridding functions for visibilities with u >= 0.
+
+    :param vuvwmap: map uvw to grid fractions, with u >= 0
+    :param nx: Number of columns in the full grid
+    :param margin: Number of columns of the half plane grid at negative u
+    :return: map uvw to fractions of the half plane grid
+    """
+    assert numpy.all(vuvwmap[:, 0] >= 0.0), "Half plane mapping needs u >= 0"
+    nhalf = nx // 2 + margin
+    half_vuvwmap = numpy.array(vuvwmap)
+    half_vuvwmap[:, 0] = (margin + vuvwmap[:, 0] * nx - nhalf // 2) / nhalf
+    return half_vuvwmap
+
+
+def convolutional_degrid(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap, gridder='numpy'):
     """Convolutional degridding with frequency and polarisation independent
 
     Takes into account fractional `uv` coordinate values where the GCF
     is oversampled
 
+    The work is done by one of the degridding engines:
+
+        - 'numpy': batched gather of kernel-sized windows for all polarisations (default)
+        - 'numba': compiled loop over visibilities and kernel taps, falling back to 'numpy' if numba is not available
+        - 'python': reference loop over visibilities
+
+    If the kernel is an ExactKernel, the kernels are evaluated and degridded one chunk of rows at a time.
+
+    :param kernel_list: list of oversampled convolution kernel
+    :param vshape: Shape of visibility
+    :param uvgrid:   The uv plane to de-grid from
+    :param vuvwmap: function to map uvw to grid fractions
+    :param vfrequencymap: function to map frequency to image channels
+    :param gridder: Degridding engine 'numpy' | 'numba' | 'python'
+    :return: Array of visibilities.
+    """
+    exact = kernel_list[1][0]
+    if isinstance(exact, ExactKernel):
+        vis = numpy.zeros([vshape[0], vshape[-1]], dtype='complex')
+        for rows in exact.chunks(vshape[0]):
+            vis[rows] = convolutional_degrid(exact.kernel_list(uvgrid.shape[-2:], vuvwmap[rows]),
+                                             (len(vis[rows]), vshape[-1]), uvgrid, vuvwmap[rows],
+                                             numpy.array(vfrequencymap)[rows], gridder=gridder)
+        return vis.reshape(vshape)
+    
+    if gridder == 'numpy':
+        return convolutional_degrid_numpy(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap)
+    elif gridder == 'numba':
+        return convolutional_degrid_numba(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap)
+    elif gridder == 'python':
+        return convolutional_degrid_python(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap)
+    else:
+        raise ValueError("Unknown gridder %s" % gridder)
+
+
+def convolutional_degrid_python(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap):
+    """Convolutional degridding with frequency and polarisation independent, looping over visibilities
+
+    This is the reference implementation for the other degridding engines.
+
     :param kernel_list: list of oversampled convolution kernel
     :param vshape: Shape of visibility
     :param uvgrid:   The uv plane to de-grid from
@@ -251,11 +493,234 @@ def convolutional_degrid(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap):
     return numpy.array(vis)
 
 
-def convolutional_grid(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap):
+def convolutional_degrid_numpy(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap, batch_size=1024):
+    """Convolutional degridding with frequency and polarisation independent, using array operations
+
+    For a batch of visibilities, the kernel-sized windows of the grid are gathered for all polarisations
+    at once by fancy indexing into the flattened grid, and contracted with the selected (conjugated)
+    oversampled kernels in a single batched matrix product. The result agrees with convolutional_degrid_python to within
+    rounding.
+
+    :param kernel_list: list of oversampled convolution kernel
+    :param vshape: Shape of visibility
+    :param uvgrid:   The uv plane to de-grid from
+    :param vuvwmap: function to map uvw to grid fractions
+    :param vfrequencymap: function to map frequency to image channels
+    :param batch_size: Number of visibilities degridded per batch, bounding the temporary memory
+    :return: Array of visibilities.
+    """
+    nvis, vnpol = vshape[0], vshape[-1]
+    vis = numpy.zeros([nvis, vnpol], dtype='complex')
+    chan, x, y, kernel_table, kernel_select = gridding_coordinates(kernel_list, uvgrid.shape, vuvwmap,
+                                                                   vfrequencymap)
+    degrid_taps_numpy(vis, uvgrid, numpy.conjugate(kernel_table), kernel_select, chan, x, y, batch_size=batch_size)
+    
+    return vis.reshape(vshape)
+
+
+def degrid_taps_numpy(vis, uvgrid, kernel_table, kernel_select, chan, x, y, batch_size=1024):
+    """ Sum the kernel taps of visibilities from a grid using array operations
+
+    See convolutional_degrid_numpy for the method.
+
+    :param vis: Visibilities to fill [nvis, npol]
+    :param uvgrid: Grid to degrid from [nchan, npol, ny, nx]
+    :param kernel_table: (Conjugated) kernels [nkernels, gh, gw]
+    :param kernel_select: Index into kernel_table for each visibility
+    :param chan: Grid channel for each visibility
+    :param x: Grid x coordinate of the first kernel tap for each visibility
+    :param y: Grid y coordinate of the first kernel tap for each visibility
+    :param batch_size: Number of visibilities degridded per batch, bounding the temporary memory
+    :return: vis
+    """
+    inchan, inpol, ny, nx = uvgrid.shape
+    nvis, vnpol = vis.shape
+    _, gh, gw = kernel_table.shape
+    kernel_table = kernel_table.reshape([-1, gh * gw])
+    
+    # Flattened index of the first kernel tap of each row in the first polarisation, and the offsets of all
+    # taps and polarisations from it
+    corner = (chan * inpol * ny + y) * nx + x
+    tap_offsets = (numpy.arange(vnpol)[:, numpy.newaxis, numpy.newaxis] * ny * nx
+                   + numpy.arange(gh)[numpy.newaxis, :, numpy.newaxis] * nx
+                   + numpy.arange(gw)[numpy.newaxis, numpy.newaxis, :]).reshape([vnpol, gh * gw])
+    flatgrid = uvgrid.reshape([-1])
+    
+    for start in range(0, nvis, batch_size):
+        end = min(start + batch_size, nvis)
+        windows = flatgrid[corner[start:end, numpy.newaxis, numpy.newaxis] + tap_offsets[numpy.newaxis, ...]]
+        vis[start:end, :] = numpy.matmul(windows, kernel_table[kernel_select[start:end], :, numpy.newaxis])[..., 0]
+    
+    return vis
+
+
+def convolutional_degrid_numba(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap):
+    """Convolutional degridding with frequency and polarisation independent, using a compiled loop
+
+    The loop over visibilities, polarisations and kernel taps is compiled by numba (see degrid_loop_numba). If
+    numba is not available, the work is done by convolutional_degrid_numpy instead.
+
+    :param kernel_list: list of oversampled convolution kernel
+    :param vshape: Shape of visibility
+    :param uvgrid:   The uv plane to de-grid from
+    :param vuvwmap: function to map uvw to grid fractions
+    :param vfrequencymap: function to map frequency to image channels
+    :return: Array of visibilities.
+    """
+    if not numba_available:
+        warn_numba_unavailable('convolutional_degrid_numba', 'convolutional_degrid_numpy')
+        return convolutional_degrid_numpy(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap)
+    
+    kernel_indices, kernels = kernel_list
+    kernel_oversampling, _, gh, gw = kernels[0].shape
+    assert gh % 2 == 0, "Convolution kernel must have even number of pixels"
+    assert gw % 2 == 0, "Convolution kernel must have even number of pixels"
+    inchan, inpol, ny, nx = uvgrid.shape
+    nvis, vnpol = vshape[0], vshape[-1]
+    vis = numpy.zeros([nvis, vnpol], dtype='complex')
+    
+    # uvw -> fraction of grid mapping
+    y, yf = frac_coord(ny, kernel_oversampling, vuvwmap[:, 1])
+    y -= gh // 2
+    x, xf = frac_coord(nx, kernel_oversampling, vuvwmap[:, 0])
+    x -= gw // 2
+    chan = numpy.array(vfrequencymap, dtype='int')
+    
+    # Kernels are looked up by a single index into a table of [kernel, yf, xf] entries
+    if len(kernels) > 1:
+        kernel_table = numpy.conjugate(numpy.array(kernels)).reshape([-1, gh, gw])
+        kernel_select = (numpy.array(kernel_indices, dtype='int') * kernel_oversampling + yf) * kernel_oversampling \
+                        + xf
+    else:
+        kernel_table = numpy.conjugate(kernels[0]).reshape([-1, gh, gw])
+        kernel_select = yf * kernel_oversampling + xf
+    # The standard anti-aliasing kernels are real so half the multiplications can then be skipped
+    if not numpy.any(numpy.imag(kernel_table)):
+        kernel_table = numpy.ascontiguousarray(numpy.real(kernel_table))
+    
+    degrid_loop_numba(vis, uvgrid, kernel_table, kernel_select, chan, x, y)
+    
+    return vis.reshape(vshape)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def degrid_loop_numba(vis, uvgrid, kernel_table, kernel_select, chan, x, y):
+    """ Compiled degridding loop used by convolutional_degrid_numba
+
+    :param vis: Visibilities to fill [nvis, npol]
+    :param uvgrid: Grid to degrid from [nchan, npol, ny, nx]
+    :param kernel_table: (Conjugated) kernels [nkernels, gh, gw]
+    :param kernel_select: Index into kernel_table for each visibility
+    :param chan: Grid channel for each visibility
+    :param x: Grid x coordinate of the first kernel tap for each visibility
+    :param y: Grid y coordinate of the first kernel tap for each visibility
+    :return: vis
+    """
+    nvis, npol = vis.shape
+    gh, gw = kernel_table.shape[1], kernel_table.shape[2]
+    for row in range(nvis):
+        kernel = kernel_table[kernel_select[row]]
+        for pol in range(npol):
+            grid = uvgrid[chan[row], pol]
+            total = 0.0j
+            for iy in range(gh):
+                for ix in range(gw):
+                    total += grid[y[row] + iy, x[row] + ix] * kernel[iy, ix]
+            vis[row, pol] = total
+    return vis
+
+
+def convolutional_grid(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap, gridder='numpy', nthreads=1,
+                       order=None):
     """Grid after convolving with frequency and polarisation independent gcf
 
     Takes into account fractional `uv` coordinate values where the GCF is oversampled
 
+    The work is done by one of the gridding engines:
+
+        - 'numpy': vectorised scatter-add of all kernel taps in bounded size batches (default)
+        - 'numba': compiled loop over visibilities and kernel taps, falling back to 'numpy' if numba is not available
+        - 'python': reference loop over visibilities
+
+    If nthreads > 1, the 'numpy' and 'numba' engines are run in threads by convolutional_grid_threaded. The
+    compiled 'numba' engine releases the GIL and so scales best.
+
+    If order is given (see gridding_order), the visibilities are gridded in that order so that consecutive kernel
+    adds fall in the same part of the grid.
+
+    If the kernel is an ExactKernel, the kernels are evaluated and gridded one chunk of rows at a time.
+
+    :param kernel_list: List of oversampled convolution kernels
+    :param uvgrid: Grid to add to [nchan, npol, npixel, npixel]
+    :param vis: Visibility values
+    :param visweights: Visibility weights
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param gridder: Gridding engine 'numpy' | 'numba' | 'python'
+    :param nthreads: Number of threads to grid with
+    :param order: Optional permutation of the visibilities to grid in
+    :return: uv grid[nchan, npol, ny, nx], sumwt[nchan, npol]
+    """
+    if order is not None:
+        kernel_indices, kernels = kernel_list
+        if len(kernels) > 1:
+            kernel_list = (numpy.array(kernel_indices)[order], kernels)
+        vis = vis[order]
+        visweights = visweights[order]
+        vuvwmap = vuvwmap[order]
+        vfrequencymap = numpy.array(vfrequencymap)[order]
+    
+    exact = kernel_list[1][0]
+    if isinstance(exact, ExactKernel):
+        sumwt = numpy.zeros(uvgrid.shape[:2])
+        for rows in exact.chunks(len(vuvwmap)):
+            uvgrid, chunk_sumwt = convolutional_grid(exact.kernel_list(uvgrid.shape[-2:], vuvwmap[rows]), uvgrid,
+                                                     vis[rows], visweights[rows], vuvwmap[rows],
+                                                     numpy.array(vfrequencymap)[rows], gridder=gridder,
+                                                     nthreads=nthreads)
+            sumwt += chunk_sumwt
+        return uvgrid, sumwt
+    
+    if nthreads > 1 and gridder in ['numpy', 'numba']:
+        return convolutional_grid_threaded(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap,
+                                           gridder=gridder, nthreads=nthreads)
+    elif gridder == 'numpy':
+        return convolutional_grid_numpy(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap)
+    elif gridder == 'numba':
+        return convolutional_grid_numba(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap)
+    elif gridder == 'python':
+        return convolutional_grid_python(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap)
+    else:
+        raise ValueError("Unknown gridder %s" % gridder)
+
+
+def gridding_order(shape, vuvwmap, vfrequencymap, tile=32):
+    """Find an order of the visibilities that improves the locality of gridding
+
+    The visibilities are sorted by channel and by the tile x tile cell of the grid that they fall in, so that
+    consecutive kernel adds touch the same few cache lines of the grid.
+
+    :param shape: Shape of grid [nchan, npol, ny, nx]
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param tile: Size of uv tile (pixels)
+    :return: Permutation of the visibilities
+    """
+    inchan, inpol, ny, nx = shape
+    y, _ = frac_coord(ny, 1, vuvwmap[:, 1])
+    x, _ = frac_coord(nx, 1, vuvwmap[:, 0])
+    chan = numpy.array(vfrequencymap, dtype='int')
+    ntiley = (ny + tile - 1) // tile
+    ntilex = (nx + tile - 1) // tile
+    key = (chan * ntiley + y // tile) * ntilex + x // tile
+    return numpy.argsort(key, kind='stable')
+
+
+def convolutional_grid_python(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap):
+    """Grid after convolving with frequency and polarisation independent gcf, looping over visibilities
+
+    This is the reference implementation for the other gridding engines.
+
     :param kernel_list: List of oversampled convolution kernels
     :param uvgrid: Grid to add to [nchan, npol, npixel, npixel]
     :param vis: Visibility values
@@ -304,49 +769,521 @@ def convolutional_grid(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequency
     return uvgrid, sumwt
 
 
-def weight_gridding(shape, visweights, vuvwmap, vfrequencymap, vpolarisationmap=None, weighting='uniform'):
+def gridding_coordinates(kernel_list, shape, vuvwmap, vfrequencymap):
+    """Find the grid coordinates and kernel of each visibility
+
+    The kernels are flattened into a table of [kernel, yf, xf] entries so that each visibility needs a single
+    index into the table.
+
+    :param kernel_list: List of oversampled convolution kernels
+    :param shape: Shape of grid [nchan, npol, ny, nx]
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :return: chan, x, y (of the first kernel tap), kernel_table[nkernels, gh, gw], kernel_select
+    """
+    kernel_indices, kernels = kernel_list
+    kernel_oversampling, _, gh, gw = kernels[0].shape
+    assert gh % 2 == 0, "Convolution kernel must have even number of pixels"
+    assert gw % 2 == 0, "Convolution kernel must have even number of pixels"
+    inchan, inpol, ny, nx = shape
+    
+    # uvw -> fraction of grid mapping
+    y, yf = frac_coord(ny, kernel_oversampling, vuvwmap[:, 1])
+    y -= gh // 2
+    x, xf = frac_coord(nx, kernel_oversampling, vuvwmap[:, 0])
+    x -= gw // 2
+    chan = numpy.array(vfrequencymap, dtype='int')
+    
+    if len(kernels) > 1:
+        kernel_table = numpy.array(kernels).reshape([-1, gh, gw])
+        kernel_select = (numpy.array(kernel_indices, dtype='int') * kernel_oversampling + yf) * kernel_oversampling \
+                        + xf
+    else:
+        kernel_table = kernels[0].reshape([-1, gh, gw])
+        kernel_select = yf * kernel_oversampling + xf
+    
+    return chan, x, y, kernel_table, kernel_select
+
+
+def gridding_weights(shape, vis, visweights, chan):
+    """Find the weighted visibilities and the sum of weights per grid channel and polarisation
+
+    :param shape: Shape of grid [nchan, npol, ny, nx]
+    :param vis: Visibility values
+    :param visweights: Visibility weights
+    :param chan: Grid channel for each visibility
+    :return: viswt[nvis, npol], sumwt[nchan, npol]
+    """
+    inchan, inpol, _, _ = shape
+    npol = vis.shape[-1]
+    wts = visweights.reshape([len(chan), npol])
+    viswt = vis.reshape([len(chan), npol]) * wts
+    
+    sumwt = numpy.zeros([inchan, inpol])
+    for pol in range(npol):
+        sumwt[:, pol] += numpy.bincount(chan, weights=wts[..., pol], minlength=inchan)[:inchan]
+    
+    return viswt, sumwt
+
+
+def convolutional_grid_numpy(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap, batch_size=1024):
+    """Grid after convolving with frequency and polarisation independent gcf, using array operations
+
+    See grid_taps_numpy for the method. The result agrees with convolutional_grid_python to within rounding.
+
+    :param kernel_list: List of oversampled convolution kernels
+    :param uvgrid: Grid to add to [nchan, npol, npixel, npixel]
+    :param vis: Visibility values
+    :param visweights: Visibility weights
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param batch_size: Number of visibilities gridded per batch, bounding the temporary memory
+    :return: uv grid[nchan, npol, ny, nx], sumwt[nchan, npol]
+    """
+    chan, x, y, kernel_table, kernel_select = gridding_coordinates(kernel_list, uvgrid.shape, vuvwmap,
+                                                                   vfrequencymap)
+    viswt, sumwt = gridding_weights(uvgrid.shape, vis, visweights, chan)
+    grid_taps_numpy(uvgrid, viswt, kernel_table, kernel_select, chan, x, y, batch_size=batch_size)
+    return uvgrid, sumwt
+
+
+def grid_taps_numpy(uvgrid, viswt, kernel_table, kernel_select, chan, x, y, batch_size=1024):
+    """ Add the kernel taps of weighted visibilities to a grid using array operations
+
+    Every kernel tap of a batch of visibilities is expressed as an index into the flattened grid, and the
+    weighted kernel values are accumulated with numpy.bincount. The rows are first sorted by grid row so
+    that each batch touches only a narrow band of the grid, keeping the accumulation cost proportional to
+    the number of kernel taps rather than the grid size.
+
+    :param uvgrid: Grid to add to [nchan, npol, ny, nx]
+    :param viswt: Weighted visibilities [nvis, npol]
+    :param kernel_table: Kernels [nkernels, gh, gw]
+    :param kernel_select: Index into kernel_table for each visibility
+    :param chan: Grid channel for each visibility
+    :param x: Grid x coordinate of the first kernel tap for each visibility
+    :param y: Grid y coordinate of the first kernel tap for each visibility
+    :param batch_size: Number of visibilities gridded per batch, bounding the temporary memory
+    :return: uvgrid
+    """
+    inchan, inpol, ny, nx = uvgrid.shape
+    _, gh, gw = kernel_table.shape
+    npol = viswt.shape[-1]
+    
+    kernel_table = kernel_table.reshape([-1, gh * gw])
+    # The standard anti-aliasing kernels are real so half the multiplications can then be skipped
+    real_kernel = not numpy.any(numpy.imag(kernel_table))
+    kernel_table_real = numpy.ascontiguousarray(numpy.real(kernel_table))
+    kernel_table_imag = numpy.ascontiguousarray(numpy.imag(kernel_table))
+    
+    # Sort the rows by channel and grid row. A radix sort is used if the key is small enough.
+    key = chan * ny + y
+    if inchan * ny < 65536:
+        key = key.astype('uint16')
+    order = numpy.argsort(key, kind='stable')
+    
+    # Flattened index of the first kernel tap for each row, and the offsets of all taps from it
+    corner = ((chan * inpol * ny + y) * nx + x)[order]
+    kernel_select = kernel_select[order]
+    vis_real = numpy.ascontiguousarray(viswt.real[order].T)
+    vis_imag = numpy.ascontiguousarray(viswt.imag[order].T)
+    tap_offsets = (numpy.arange(gh)[:, numpy.newaxis] * nx + numpy.arange(gw)[numpy.newaxis, :]).flatten()
+    
+    # numpy.bincount needs a contiguous target so work on a copy if needed
+    if uvgrid.flags['C_CONTIGUOUS']:
+        flatgrid = uvgrid.reshape([-1])
+    else:
+        flatgrid = numpy.ascontiguousarray(uvgrid).reshape([-1])
+    
+    for start in range(0, len(order), batch_size):
+        end = min(start + batch_size, len(order))
+        # Since the rows are sorted, the batch is confined to a band starting at low
+        low = numpy.min(corner[start:end])
+        span = int(numpy.max(corner[start:end]) + tap_offsets[-1] - low + 1)
+        taps = ((corner[start:end] - low)[:, numpy.newaxis] + tap_offsets[numpy.newaxis, :]).reshape([-1])
+        kr = kernel_table_real[kernel_select[start:end]]
+        if not real_kernel:
+            ki = kernel_table_imag[kernel_select[start:end]]
+        for pol in range(npol):
+            vr = vis_real[pol, start:end, numpy.newaxis]
+            vi = vis_imag[pol, start:end, numpy.newaxis]
+            if real_kernel:
+                values_real = kr * vr
+                values_imag = kr * vi
+            else:
+                values_real = kr * vr - ki * vi
+                values_imag = kr * vi + ki * vr
+            offset = low + pol * ny * nx
+            flatgrid[offset:offset + span] += \
+                numpy.bincount(taps, weights=values_real.reshape([-1]), minlength=span) \
+                + 1j * numpy.bincount(taps, weights=values_imag.reshape([-1]), minlength=span)
+    
+    if not uvgrid.flags['C_CONTIGUOUS']:
+        uvgrid[...] = flatgrid.reshape(uvgrid.shape)
+    
+    return uvgrid
+
+
+def convolutional_grid_numba(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap):
+    """Grid after convolving with frequency and polarisation independent gcf, using a compiled loop
+
+    The loop over visibilities, polarisations and kernel taps is compiled by numba (see grid_loop_numba). If
+    numba is not available, the work is done by convolutional_grid_numpy instead.
+
+    :param kernel_list: List of oversampled convolution kernels
+    :param uvgrid: Grid to add to [nchan, npol, npixel, npixel]
+    :param vis: Visibility values
+    :param visweights: Visibility weights
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :return: uv grid[nchan, npol, ny, nx], sumwt[nchan, npol]
+    """
+    if not numba_available:
+        warn_numba_unavailable('convolutional_grid_numba', 'convolutional_grid_numpy')
+        return convolutional_grid_numpy(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap)
+    
+    chan, x, y, kernel_table, kernel_select = gridding_coordinates(kernel_list, uvgrid.shape, vuvwmap,
+                                                                   vfrequencymap)
+    viswt, sumwt = gridding_weights(uvgrid.shape, vis, visweights, chan)
+    grid_taps_numba(uvgrid, viswt, kernel_table, kernel_select, chan, x, y)
+    return uvgrid, sumwt
+
+
+def grid_taps_numba(uvgrid, viswt, kernel_table, kernel_select, chan, x, y):
+    """ Add the kernel taps of weighted visibilities to a grid using the compiled grid_loop_numba
+
+    :param uvgrid: Grid to add to [nchan, npol, ny, nx]
+    :param viswt: Weighted visibilities [nvis, npol]
+    :param kernel_table: Kernels [nkernels, gh, gw]
+    :param kernel_select: Index into kernel_table for each visibility
+    :param chan: Grid channel for each visibility
+    :param x: Grid x coordinate of the first kernel tap for each visibility
+    :param y: Grid y coordinate of the first kernel tap for each visibility
+    :return: uvgrid
+    """
+    # The standard anti-aliasing kernels are real so half the multiplications can then be skipped
+    if not numpy.any(numpy.imag(kernel_table)):
+        kernel_table = numpy.ascontiguousarray(numpy.real(kernel_table))
+    return grid_loop_numba(uvgrid, viswt, kernel_table, kernel_select, chan, x, y)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def grid_loop_numba(uvgrid, viswt, kernel_table, kernel_select, chan, x, y):
+    """ Compiled gridding loop used by convolutional_grid_numba
+
+    :param uvgrid: Grid to add to [nchan, npol, ny, nx]
+    :param viswt: Weighted visibilities [nvis, npol]
+    :param kernel_table: Kernels [nkernels, gh, gw]
+    :param kernel_select: Index into kernel_table for each visibility
+    :param chan: Grid channel for each visibility
+    :param x: Grid x coordinate of the first kernel tap for each visibility
+    :param y: Grid y coordinate of the first kernel tap for each visibility
+    :return: uvgrid
+    """
+    nvis, npol = viswt.shape
+    gh, gw = kernel_table.shape[1], kernel_table.shape[2]
+    for row in range(nvis):
+        kernel = kernel_table[kernel_select[row]]
+        for pol in range(npol):
+            grid = uvgrid[chan[row], pol]
+            v = viswt[row, pol]
+            for iy in range(gh):
+                for ix in range(gw):
+                    grid[y[row] + iy, x[row] + ix] += kernel[iy, ix] * v
+    return uvgrid
+
+
+def convolutional_grid_threaded(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap, gridder='numpy',
+                                nthreads=4):
+    """Grid after convolving with frequency and polarisation independent gcf, using a number of threads
+
+    The visibilities are partitioned by grid row into nthreads bands holding equal numbers of visibilities. Each
+    thread grids its band into a private sub-grid covering only the rows it touches, and the sub-grids are then
+    added into uvgrid. Neighbouring sub-grids overlap only by the kernel support, so the extra memory needed is
+    about one grid.
+
+    :param kernel_list: List of oversampled convolution kernels
+    :param uvgrid: Grid to add to [nchan, npol, npixel, npixel]
+    :param vis: Visibility values
+    :param visweights: Visibility weights
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param gridder: Gridding engine used by each thread 'numpy' | 'numba'
+    :param nthreads: Number of threads
+    :return: uv grid[nchan, npol, ny, nx], sumwt[nchan, npol]
+    """
+    if gridder == 'numba' and not numba_available:
+        warn_numba_unavailable('convolutional_grid_threaded', 'grid_taps_numpy')
+        gridder = 'numpy'
+    if gridder == 'numpy':
+        grid_taps = grid_taps_numpy
+    elif gridder == 'numba':
+        grid_taps = grid_taps_numba
+    else:
+        raise ValueError("Unknown gridder %s" % gridder)
+    
+    chan, x, y, kernel_table, kernel_select = gridding_coordinates(kernel_list, uvgrid.shape, vuvwmap,
+                                                                   vfrequencymap)
+    viswt, sumwt = gridding_weights(uvgrid.shape, vis, visweights, chan)
+    inchan, inpol, ny, nx = uvgrid.shape
+    gh = kernel_table.shape[1]
+    
+    # Split the rows, sorted by grid row, into bands with equal numbers of visibilities
+    order = numpy.argsort(y, kind='stable')
+    bands = [rows for rows in numpy.array_split(order, nthreads) if len(rows) > 0]
+    
+    def grid_band(rows):
+        ylow = numpy.min(y[rows])
+        subgrid = numpy.zeros([inchan, inpol, numpy.max(y[rows]) - ylow + gh, nx], dtype=uvgrid.dtype)
+        grid_taps(subgrid, viswt[rows], kernel_table, kernel_select[rows], chan[rows], x[rows], y[rows] - ylow)
+        return ylow, subgrid
+    
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        for ylow, subgrid in executor.map(grid_band, bands):
+            uvgrid[:, :, ylow:ylow + subgrid.shape[2], :] += subgrid
+    
+    return uvgrid, sumwt
+
+
+def weight_gridding(shape, visweights, vuvwmap, vfrequencymap, vpolarisationmap=None, weighting='uniform',
+                    gridder='numpy', robustness=0.0, super_uniform_box=3, densitygrid=None):
     """Reweight data using one of a number of algorithms
 
+    The algorithms are:
+
+        - 'natural': the visibility weights are not changed
+        - 'uniform': each weight is divided by the sum of the weights in its grid cell
+        - 'briggs': each weight w is divided by 1 + f2 * W, where W is the sum of the weights in its grid cell and
+          f2 = (5 * 10**-robustness)**2 / (sum W**2 / sum W). Robustness -2 is close to uniform, +2 to natural.
+        - 'super_uniform': as uniform, but the sum is over a box of super_uniform_box by super_uniform_box cells
+
+    The density of weights on the grid is found by one of the engines:
+
+        - 'numpy': accumulation with numpy.bincount (default)
+        - 'numba': compiled loop over visibilities, falling back to 'numpy' if numba is not available
+        - 'python': reference loop over visibilities
+
+    If densitygrid is given (e.g. summed over many partitions of the data by weight_density) it is used instead,
+    and only the density at each sample is looked up.
+
     :param shape:
     :param visweights: Visibility weights
     :param vuvwmap: map uvw to grid fractions
     :param vfrequencymap: map frequency to image channels
     :param vpolarisationmap: map polarisation to image polarisation
-    :param weighting: '' | 'uniform'
+    :param weighting: 'natural' | 'uniform' | 'briggs' | 'super_uniform'
+    :param gridder: Engine 'numpy' | 'numba' | 'python'
+    :param robustness: Briggs robustness parameter (0.0)
+    :param super_uniform_box: Width of box (cells, odd) for super uniform weighting (3)
+    :param densitygrid: Gridded density of weights [nchan, npol, ny, nx] to use
     :return: visweights, density, densitygrid
     """
+    if weighting in ['', 'natural']:
+        return visweights, None, None
+    if weighting not in ['uniform', 'briggs', 'super_uniform']:
+        raise ValueError("Unknown weighting %s" % weighting)
+    
+    log.info("weight_gridding: Performing %s weighting" % weighting)
+    if densitygrid is None:
+        density, densitygrid = weight_density(shape, visweights, vuvwmap, vfrequencymap, gridder)
+    else:
+        assert list(densitygrid.shape) == list(shape), "Density grid has shape %s, expected %s" % \
+                                                       (str(densitygrid.shape), str(shape))
+        density = weight_density_gather(densitygrid, vuvwmap, vfrequencymap)
+    
+    if weighting == 'super_uniform':
+        assert super_uniform_box % 2 == 1, "Super uniform box must be an odd number of cells"
+        density = weight_density_gather(box_sum(densitygrid, super_uniform_box), vuvwmap, vfrequencymap)
+    
+    # Samples falling off the grid have zero density
+    if numpy.sum(density[:, 0] > 0.0) < visweights.shape[0]:
+        log.warning("weight_gridding: Losing samples in weighting")
+    
+    newvisweights = numpy.zeros_like(visweights)
+    if weighting == 'briggs':
+        # Briggs, D., PhD thesis (1995), the grid density is normalised by its weighted mean
+        f2 = numpy.zeros([densitygrid.shape[1]])
+        for pol in range(densitygrid.shape[1]):
+            sumdensity2 = numpy.sum(densitygrid[:, pol] ** 2)
+            if sumdensity2 > 0.0:
+                f2[pol] = (5.0 * numpy.power(10.0, -robustness)) ** 2 * numpy.sum(densitygrid[:, pol]) / sumdensity2
+        newvisweights[density > 0.0] = (visweights / (1.0 + f2 * density))[density > 0.0]
+    else:
+        # Normalise each visibility weight to sum to one in a grid cell or box
+        newvisweights[density > 0.0] = visweights[density > 0.0] / density[density > 0.0]
+    return newvisweights, density, densitygrid
+
+
+def weight_density(shape, visweights, vuvwmap, vfrequencymap, gridder='numpy'):
+    """Find the gridded density of weights and the density at each sample, using one of the engines
+
+    :param shape: Shape of grid [nchan, npol, ny, nx]
+    :param visweights: Visibility weights
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param gridder: Engine 'numpy' | 'numba' | 'python'
+    :return: density[nvis, npol], densitygrid[nchan, npol, ny, nx]
+    """
+    if gridder == 'numpy':
+        return weight_density_numpy(shape, visweights, vuvwmap, vfrequencymap)
+    elif gridder == 'numba':
+        return weight_density_numba(shape, visweights, vuvwmap, vfrequencymap)
+    elif gridder == 'python':
+        return weight_density_python(shape, visweights, vuvwmap, vfrequencymap)
+    else:
+        raise ValueError("Unknown gridder %s" % gridder)
+
+
+def weight_density_gather(densitygrid, vuvwmap, vfrequencymap):
+    """Look up the gridded density of weights at each sample
+
+    :param densitygrid: Gridded density of weights [nchan, npol, ny, nx]
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :return: density[nvis, npol]
+    """
+    _, _, ny, nx = densitygrid.shape
+    chan = numpy.array(vfrequencymap, dtype='int')
+    y, _ = frac_coord(ny, 1.0, vuvwmap[:, 1])
+    x, _ = frac_coord(nx, 1.0, vuvwmap[:, 0])
+    # The separated index arrays put the visibility axis first
+    return densitygrid[chan, :, y, x]
+
+
+def box_sum(grid, box):
+    """Sum a grid over a square box of cells centred on each cell, using cumulative sums
+
+    Cells beyond the edge of the grid count as zero.
+
+    :param grid: Grid [..., ny, nx]
+    :param box: Width of the box (cells, odd)
+    :return: Summed grid [..., ny, nx]
+    """
+    half = box // 2
+    padded = numpy.pad(grid, [(0, 0)] * (grid.ndim - 2) + [(half + 1, half), (half + 1, half)], mode='constant')
+    csum = padded.cumsum(axis=-2).cumsum(axis=-1)
+    return csum[..., box:, box:] - csum[..., :-box, box:] - csum[..., box:, :-box] + csum[..., :-box, :-box]
+
+
+def weight_density_python(shape, visweights, vuvwmap, vfrequencymap):
+    """Find the gridded density of weights and the density at each sample, looping over visibilities
+
+    Both each sample and its Hermitian conjugate are counted.
+
+    :param shape: Shape of grid [nchan, npol, ny, nx]
+    :param visweights: Visibility weights
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :return: density[nvis, npol], densitygrid[nchan, npol, ny, nx]
+    """
     densitygrid = numpy.zeros(shape, dtype='float')
-    if weighting == 'uniform':
-        log.info("weight_gridding: Performing uniform weighting")
-        inchan, inpol, ny, nx = shape
-
-        wts = visweights[...]
-        # uvw -> fraction of grid mapping
-        for flip in [-1.0, 1.0]:
-            y, yf = frac_coord(ny, 1.0, flip * vuvwmap[:, 1])
-            x, xf = frac_coord(nx, 1.0, flip * vuvwmap[:, 0])
-            coords = list(vfrequencymap), x, y
-            for pol in range(inpol):
-                for vwt, chan, x, y in zip(wts, *coords):
-                    densitygrid[chan, pol, y, x] += vwt[..., pol]
-                    
-        # Find the total weight per sample counting redundancies with other samples
-        newvisweights = numpy.zeros_like(visweights)
-        density = numpy.zeros_like(visweights)
-        y, _ = frac_coord(ny, 1.0, vuvwmap[:, 1])
-        x, _ = frac_coord(nx, 1.0, vuvwmap[:, 0])
+    inchan, inpol, ny, nx = shape
+
+    wts = visweights[...]
+    # uvw -> fraction of grid mapping
+    for flip in [-1.0, 1.0]:
+        y, yf = frac_coord(ny, 1.0, flip * vuvwmap[:, 1])
+        x, xf = frac_coord(nx, 1.0, flip * vuvwmap[:, 0])
         coords = list(vfrequencymap), x, y
         for pol in range(inpol):
-            density[..., pol] += [densitygrid[chan, pol, y, x] for chan, x, y in zip(*coords)]
+            for vwt, chan, x, y in zip(wts, *coords):
+                densitygrid[chan, pol, y, x] += vwt[..., pol]
+                
+    # Find the total weight per sample counting redundancies with other samples
+    density = numpy.zeros_like(visweights)
+    y, _ = frac_coord(ny, 1.0, vuvwmap[:, 1])
+    x, _ = frac_coord(nx, 1.0, vuvwmap[:, 0])
+    coords = list(vfrequencymap), x, y
+    for pol in range(inpol):
+        density[..., pol] += [densitygrid[chan, pol, y, x] for chan, x, y in zip(*coords)]
+    
+    return density, densitygrid
 
-        # Normalise each visibility weight to sum to one in a grid cell
-        if numpy.sum(density[:, 0] > 0.0) < visweights.shape[0]:
-            log.warning("weight_gridding: Losing samples in weighting")
-            
-        newvisweights[density > 0.0] = visweights[density > 0.0] / density[density > 0.0]
-        return newvisweights, density, densitygrid
-    else:
-        return visweights, None, None
+
+def weight_density_numpy(shape, visweights, vuvwmap, vfrequencymap):
+    """Find the gridded density of weights and the density at each sample, using numpy.bincount
+
+    Both each sample and its Hermitian conjugate are counted.
+
+    :param shape: Shape of grid [nchan, npol, ny, nx]
+    :param visweights: Visibility weights
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :return: density[nvis, npol], densitygrid[nchan, npol, ny, nx]
+    """
+    densitygrid = numpy.zeros(shape, dtype='float')
+    inchan, inpol, ny, nx = shape
+    chan = numpy.array(vfrequencymap, dtype='int')
+    
+    for flip in [-1.0, 1.0]:
+        y, _ = frac_coord(ny, 1.0, flip * vuvwmap[:, 1])
+        x, _ = frac_coord(nx, 1.0, flip * vuvwmap[:, 0])
+        cell = (chan * ny + y) * nx + x
+        for pol in range(inpol):
+            densitygrid[:, pol, ...] += numpy.bincount(cell, weights=visweights[..., pol],
+                                                       minlength=inchan * ny * nx).reshape([inchan, ny, nx])
+    
+    # Find the total weight per sample counting redundancies with other samples
+    density = weight_density_gather(densitygrid, vuvwmap, vfrequencymap).reshape(visweights.shape)
+    
+    return density, densitygrid
+
+
+def weight_density_numba(shape, visweights, vuvwmap, vfrequencymap):
+    """Find the gridded density of weights and the density at each sample, using a compiled loop
+
+    Both each sample and its Hermitian conjugate are counted. If numba is not available, the work is done by
+    weight_density_numpy instead.
+
+    :param shape: Shape of grid [nchan, npol, ny, nx]
+    :param visweights: Visibility weights
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :return: density[nvis, npol], densitygrid[nchan, npol, ny, nx]
+    """
+    if not numba_available:
+        warn_numba_unavailable('weight_density_numba', 'weight_density_numpy')
+        return weight_density_numpy(shape, visweights, vuvwmap, vfrequencymap)
+    
+    densitygrid = numpy.zeros(shape, dtype='float')
+    inchan, inpol, ny, nx = shape
+    chan = numpy.array(vfrequencymap, dtype='int')
+    # Visibility weights are stored big-endian, which numba does not accept
+    wts = numpy.ascontiguousarray(visweights, dtype='float').reshape([len(chan), -1])
+    density = numpy.zeros_like(wts)
+    
+    y, _ = frac_coord(ny, 1.0, vuvwmap[:, 1])
+    x, _ = frac_coord(nx, 1.0, vuvwmap[:, 0])
+    yflip, _ = frac_coord(ny, 1.0, -vuvwmap[:, 1])
+    xflip, _ = frac_coord(nx, 1.0, -vuvwmap[:, 0])
+    weight_density_loop_numba(density, densitygrid, wts, chan, x, y, xflip, yflip)
+    
+    return density.reshape(visweights.shape), densitygrid
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def weight_density_loop_numba(density, densitygrid, wts, chan, x, y, xflip, yflip):
+    """ Compiled loops used by weight_density_numba
+
+    :param density: Density at each sample to fill [nvis, npol]
+    :param densitygrid: Grid to add to [nchan, npol, ny, nx]
+    :param wts: Visibility weights [nvis, npol]
+    :param chan: Grid channel for each visibility
+    :param x: Grid x coordinate for each visibility
+    :param y: Grid y coordinate for each visibility
+    :param xflip: Grid x coordinate for the conjugate of each visibility
+    :param yflip: Grid y coordinate for the conjugate of each visibility
+    :return: density, densitygrid
+    """
+    nvis = wts.shape[0]
+    npol = densitygrid.shape[1]
+    for row in range(nvis):
+        for pol in range(npol):
+            densitygrid[chan[row], pol, yflip[row], xflip[row]] += wts[row, pol]
+            densitygrid[chan[row], pol, y[row], x[row]] += wts[row, pol]
+    for row in range(nvis):
+        for pol in range(npol):
+            density[row, pol] = densitygrid[chan[row], pol, y[row], x[row]]
+    return density, densitygrid
 
 
 def visibility_recentre(uvw, dl, dm):
@@ -405,6 +1342,9 @@ def gridder_numba(uvgrid, vis, xs, ys, kernel=numpy.ones((1, 1)), kernel_ixs=Non
     """Grids visibilities at given positions. Convolution kernels are selected per
     visibility using ``kernel_ixs``.
 
+    This has the same interface as :py:func:`gridder` but the loop is done by grid_loop_numba, which is compiled
+    if numba is available.
+
     :param uvgrid: Grid to update (two-dimensional :class:`complex` array)
     :param vis: Visibility values (one-dimensional :class:`complex` array)
     :param xs: Visibility position (one-dimensional :class:`int` array)
@@ -416,16 +1356,40 @@ def gridder_numba(uvgrid, vis, xs, ys, kernel=numpy.ones((1, 1)), kernel_ixs=Non
       Can be omitted if ``kernel`` requires no indices, and can be one-dimensional
       if only one index is needed to identify kernels
     """
+    gh, gw = kernel.shape[-2:]
+    kernel_table = numpy.ascontiguousarray(kernel).reshape([-1, gh, gw])
+    if kernel_ixs is None:
+        kernel_select = numpy.zeros(len(vis), dtype='int')
+    else:
+        kernel_ixs = numpy.array(kernel_ixs, dtype='int').reshape([len(vis), -1])
+        kernel_select = numpy.ravel_multi_index(tuple(kernel_ixs.T), kernel.shape[:-2])
     
-    # if kernel_ixs is None:
-    #     kernel_ixs = numpy.zeros((len(vis), 0))
-    # else:
-    #     kernel_ixs = numpy.array(kernel_ixs)
-    #     if len(kernel_ixs.shape) == 1:
-    #         kernel_ixs = kernel_ixs.reshape(len(kernel_ixs), 1)
+    chan = numpy.zeros(len(vis), dtype='int')
+    viswt = numpy.array(vis, dtype='complex').reshape([len(vis), 1])
+    grid_loop_numba(uvgrid[numpy.newaxis, numpy.newaxis, ...], viswt, kernel_table, kernel_select, chan,
+                    numpy.array(xs, dtype='int'), numpy.array(ys, dtype='int'))
     
-    gh, gw = kernel.shape[-2:]
-    for v, x, y, kern_ix in zip(vis, xs, ys, kernel_ixs):
-        uvgrid[y:y + gh, x:x + gw] += kernel[convert_to_tuple3(kern_ix)] * v
-        
     return uvgrid
+
+
+def numba_warmup():
+    """ Compile the numba gridding loops by running them on small arrays
+
+    The compiled code is cached on disk, so this is quick after the first time on a given node. It can be
+    run on all dask workers using e.g. client.run(numba_warmup) so that the first gridding calls do not
+    pay the compilation time.
+
+    :return: True if numba is available
+    """
+    if not numba_available:
+        return False
+    
+    uvgrid = numpy.zeros([1, 1, 8, 8], dtype='complex')
+    vis = numpy.ones([1, 1], dtype='complex')
+    index = numpy.zeros([1], dtype='int')
+    for kernel_table in [numpy.ones([1, 2, 2]), numpy.ones([1, 2, 2], dtype='complex')]:
+        grid_loop_numba(uvgrid, vis, kernel_table, index, index, index, index)
+        degrid_loop_numba(vis, uvgrid, kernel_table, index, index, index, index)
+    weight_density_loop_numba(numpy.zeros([1, 1]), numpy.zeros([1, 1, 8, 8]), numpy.ones([1, 1]), index, index,
+                              index, index, index)
+    return True
@@ -0,0 +1,68 @@
+""" Direct Fourier transform of point sources to visibilities.
+
+The phasors of a block of components for a block of visibility rows are made as one matrix, by the complex
+exponential of the product of the uvw with the direction cosines of the components, and are then contracted with the
+fluxes of the components by a matrix product. The size of the blocks bounds the memory used. numpy releases the GIL
+in both steps, so the blocks of rows can be done in threads.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+log = logging.getLogger(__name__)
+
+
+def dft_point_sources(uvw, lmn, flux, vis=None, block_size=2 ** 20, nthreads=1):
+    """ Add the visibilities of point sources, calculated by a direct Fourier transform
+
+    The visibility of a component at direction cosines (l, m) is flux * exp(-2 pi i (u l + v m + w (n - 1))), as for
+    :py:func:`libs.util.coordinate_support.simulate_point`.
+
+    :param uvw: uvw of the rows in wavelengths [nrows, 3]
+    :param lmn: Direction cosines of the components [ncomp, 2 or 3], only l and m are used
+    :param flux: Flux of the components [ncomp, npol]
+    :param vis: Visibility values to add to [nrows, npol] (default a new array of zeros)
+    :param block_size: Maximum number of phasors held at once, per thread
+    :param nthreads: Number of threads to do the blocks of rows with
+    :return: vis
+    """
+    uvw = numpy.asarray(uvw)
+    lmn = numpy.asarray(lmn)
+    flux = numpy.asarray(flux)
+    nrows = uvw.shape[0]
+    ncomp, npol = flux.shape
+    if vis is None:
+        vis = numpy.zeros([nrows, npol], dtype='complex')
+    assert vis.shape == (nrows, npol), "Visibility shape %s does not match uvw and flux" % str(vis.shape)
+    if nrows == 0 or ncomp == 0:
+        return vis
+
+    # -2 pi times the vector direction to each component, as columns
+    l, m = lmn[:, 0], lmn[:, 1]
+    s = -2.0 * numpy.pi * numpy.array([l, m, numpy.sqrt(1 - l ** 2 - m ** 2) - 1.0])
+
+    ncomp_block = max(1, min(ncomp, block_size))
+    nrows_block = max(1, block_size // ncomp_block)
+
+    def dft_rows(start):
+        end = min(start + nrows_block, nrows)
+        for cstart in range(0, ncomp, ncomp_block):
+            cend = min(cstart + ncomp_block, ncomp)
+            # Filling the real and imaginary parts is much faster than the complex exponential
+            phase = numpy.dot(uvw[start:end], s[:, cstart:cend])
+            phasor = numpy.empty(phase.shape, dtype='complex')
+            numpy.cos(phase, out=phasor.real)
+            numpy.sin(phase, out=phasor.imag)
+            vis[start:end] += numpy.dot(phasor, flux[cstart:cend])
+
+    starts = range(0, nrows, nrows_block)
+    if nthreads > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            list(executor.map(dft_rows, starts))
+    else:
+        for start in starts:
+            dft_rows(start)
+
+    return vis
@@ -1,43 +1,321 @@
 """ FFT support functions
 
+The transforms are done by one of several backends, chosen with set_fft_backend: numpy.fft, scipy.fft (with
+workers threads) or pyFFTW (with planning and cached plans and wisdom). All planes of a cube are transformed in one
+call. For even sized axes the fftshift and ifftshift around the transform are replaced by multiplying the copy of the
+input and the output by a checkerboard of +1 and -1, so that no further copies of the grid are made.
+
+The transforms keep single precision (float32/complex64) inputs in single precision. numpy.fft always works in
+double precision so scipy.fft is used for these if it is available.
+
 """
 
+import logging
+import os
+import pickle
+
 import numpy
 
+log = logging.getLogger(__name__)
+
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft as pyfftw_fft
+except ImportError:
+    pyfftw = None
+    pyfftw_fft = None
+
+fft_backend = {'backend': 'scipy' if scipy_fft is not None else 'numpy', 'workers': 1}
+
+
+def set_fft_backend(backend='auto', workers=1, wisdom_file=None):
+    """ Choose the FFT backend used by fft, ifft and the half plane transforms in this process
+
+    'auto' is pyfftw if it is installed, otherwise scipy if it is available, otherwise numpy. The pyfftw backend
+    keeps the plans it makes in memory; wisdom_file (if it exists) is loaded so that plans made by earlier runs
+    can be reused, see save_fft_wisdom.
+
+    :param backend: 'auto', 'numpy', 'scipy' or 'pyfftw'
+    :param workers: Number of threads used by the scipy and pyfftw backends for each transform
+    :param wisdom_file: pyFFTW wisdom file to load
+    """
+    if backend == 'auto':
+        if pyfftw is not None:
+            backend = 'pyfftw'
+        elif scipy_fft is not None:
+            backend = 'scipy'
+        else:
+            backend = 'numpy'
+    if backend not in ['numpy', 'scipy', 'pyfftw']:
+        raise ValueError("Unknown FFT backend %s" % backend)
+    if backend == 'scipy' and scipy_fft is None:
+        raise ValueError("FFT backend scipy needs scipy >= 1.4")
+    if backend == 'pyfftw':
+        if pyfftw is None:
+            raise ValueError("FFT backend pyfftw needs pyFFTW to be installed")
+        pyfftw.interfaces.cache.enable()
+        if wisdom_file is not None and os.path.exists(wisdom_file):
+            with open(wisdom_file, 'rb') as f:
+                pyfftw.import_wisdom(pickle.load(f))
+            log.debug("set_fft_backend: loaded FFTW wisdom from %s" % wisdom_file)
+    assert workers > 0, "Number of FFT workers must be positive"
+    fft_backend['backend'] = backend
+    fft_backend['workers'] = workers
+
+
+def save_fft_wisdom(wisdom_file):
+    """ Save the pyFFTW wisdom accumulated by this process so that set_fft_backend can load it
+
+    :param wisdom_file: Name of file
+    """
+    assert pyfftw is not None, "Saving FFT wisdom needs pyFFTW to be installed"
+    with open(wisdom_file, 'wb') as f:
+        pickle.dump(pyfftw.export_wisdom(), f)
+
+
+def fft_module(a):
+    """ Get the FFT module of the current backend for an array
+
+    numpy.fft is only used for double precision; single precision arrays use scipy.fft if it is available.
+
+    :param a: array to be transformed
+    :return: module providing fft2, ifft2, rfft2, irfft2
+    """
+    if fft_backend['backend'] == 'pyfftw':
+        return pyfftw_fft
+    if scipy_fft is not None and (fft_backend['backend'] == 'scipy' or a.dtype in [numpy.float32, numpy.complex64]):
+        return scipy_fft
+    return numpy.fft
+
+
+def _transform(name, a, workers=None, **kwargs):
+    """ Call fft2, ifft2, rfft2 or irfft2 of the current backend on the two innermost axes of a
+
+    :param name: Name of transform
+    :param a: array to be transformed. May be overwritten.
+    :param workers: Number of threads, default set by set_fft_backend
+    :return: transformed array
+    """
+    module = fft_module(a)
+    if module is not numpy.fft:
+        kwargs['workers'] = fft_backend['workers'] if workers is None else workers
+        kwargs['overwrite_x'] = True
+    return getattr(module, name)(a, axes=(-2, -1), **kwargs)
+
+
+def _checkerboard(a, odd=False):
+    """ Multiply the two innermost axes of a in place by (-1)**(row+column), negated if odd
+
+    For an even number of samples, fftshift(x) (= ifftshift(x)) has transform (-1)**k times the transform of x.
+    """
+    if odd:
+        a[..., 0::2, 0::2] *= -1
+        a[..., 1::2, 1::2] *= -1
+    else:
+        a[..., 0::2, 1::2] *= -1
+        a[..., 1::2, 0::2] *= -1
+    return a
+
 
-def fft(a):
+def _centred_transform(name, a, workers=None, out=None):
+    """ fftshift(transform(ifftshift(a))) over the two innermost axes
+
+    :param name: 'fft2' or 'ifft2'
+    :param a: array to be transformed, not changed unless it is out
+    :param workers: Number of threads, default set by set_fft_backend
+    :param out: Optional complex array of the shape of a to hold the result, and used as the work array
+    :return: complex array
+    """
+    dtype = numpy.result_type(a.dtype, numpy.complex64) if out is None else out.dtype
+    ny, nx = a.shape[-2:]
+    if ny % 2 == 0 and nx % 2 == 0:
+        if out is None:
+            work = numpy.array(a, dtype=dtype)
+        else:
+            assert out.shape == a.shape, "Output shape %s differs from input %s" % (out.shape, a.shape)
+            work = out
+            if out is not a:
+                work[...] = a
+        # The shifts of an axis of length n multiply the transform by (-1)**(n/2) as well. The scipy and pyfftw
+        # backends transform the work array in place.
+        result = _checkerboard(_transform(name, _checkerboard(work), workers).astype(dtype, copy=False),
+                               odd=(ny // 2 + nx // 2) % 2 == 1)
+    else:
+        result = numpy.fft.fftshift(_transform(name, numpy.fft.ifftshift(a, axes=[-2, -1]).astype(dtype), workers),
+                                    axes=[-2, -1]).astype(dtype, copy=False)
+    if out is not None and result is not out:
+        out[...] = result
+        return out
+    return result
+
+
+def fft(a, workers=None, out=None):
     """ Fourier transformation from image to grid space
     
     .. note::
     
-        If there are four axes then the last outer axes are not transformed
+        If there are more than two axes then the outer axes are not transformed
 
     :param a: image in `lm` coordinate space
+    :param workers: Number of threads, default set by set_fft_backend
+    :param out: Optional complex array to hold the result (may be a, to transform in place)
     :return: `uv` grid
     """
-    if (len(a.shape) == 4):
-        return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(a, axes=[2, 3])), axes=[2, 3])
-    else:
-        return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(a)))
+    return _centred_transform('fft2', a, workers, out)
 
 
-def ifft(a):
+def ifft(a, workers=None, out=None):
     """ Fourier transformation from grid to image space
 
     .. note::
     
-        If there are four axes then the last outer axes are not transformed
+        If there are more than two axes then the outer axes are not transformed
 
     :param a: `uv` grid to transform
+    :param workers: Number of threads, default set by set_fft_backend
+    :param out: Optional complex array to hold the result (may be a, to transform in place)
     :return: an image in `lm` coordinate space
     """
-    if (len(a.shape) == 4):
-        return numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(a, axes=[2, 3])), axes=[2, 3])
-    else:
-        return numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(a)))
+    return _centred_transform('ifft2', a, workers, out)
+
+
+def _centred_transform_axis(name, a, axis, workers=None):
+    """ fftshift(transform(ifftshift(a))) along one axis
 
+    :param name: 'fft' or 'ifft'
+    :param a: array to be transformed, not changed
+    :param axis: Axis to transform
+    :param workers: Number of threads, default set by set_fft_backend
+    :return: complex array
+    """
+    dtype = numpy.result_type(a.dtype, numpy.complex64)
+    shifted = numpy.fft.ifftshift(a, axes=axis).astype(dtype)
+    module = fft_module(shifted)
+    kwargs = {}
+    if module is not numpy.fft:
+        kwargs['workers'] = fft_backend['workers'] if workers is None else workers
+        kwargs['overwrite_x'] = True
+    result = getattr(module, name)(shifted, axis=axis, **kwargs)
+    return numpy.fft.fftshift(result, axes=axis).astype(dtype, copy=False)
+
+
+def fft_axis(a, axis=-1, workers=None):
+    """ Fourier transformation from image to grid space along one axis
+
+    Transforming along the two innermost axes in turn gives fft(a). This allows a transform to be pruned, e.g.
+    transforming only the rows of a padded image that are not zero.
+
+    :param a: array to be transformed
+    :param axis: Axis to transform
+    :param workers: Number of threads, default set by set_fft_backend
+    :return: transformed array
+    """
+    return _centred_transform_axis('fft', a, axis, workers)
+
+
+def ifft_axis(a, axis=-1, workers=None):
+    """ Fourier transformation from grid to image space along one axis
+
+    Transforming along the two innermost axes in turn gives ifft(a).
+
+    :param a: array to be transformed
+    :param axis: Axis to transform
+    :param workers: Number of threads, default set by set_fft_backend
+    :return: transformed array
+    """
+    return _centred_transform_axis('ifft', a, axis, workers)
+
+
+def ifft_half_plane(a, nx, margin, workers=None):
+    """ Fourier transformation from a half plane grid to a real image
+
+    The half plane grid holds columns nx//2 - margin to nx - 1 of a grid whose other columns are zero. The real
+    part of ifft of that grid is the inverse FFT of its Hermitian part, which only needs the non-negative u half.
+    This is calculated from the grid plus its conjugate reflection and transformed by a real inverse FFT.
+
+    .. note::
+
+        Only the two innermost axes are transformed
+
+    :param a: half plane `uv` grid [..., ny, nx//2 + margin]
+    :param nx: Number of columns in the full grid (even)
+    :param margin: Number of columns of the half plane grid at negative u
+    :param workers: Number of threads, default set by set_fft_backend
+    :return: real image in `lm` coordinate space [..., ny, nx]
+    """
+    ny = a.shape[-2]
+    assert nx % 2 == 0, "Half plane transform needs an even number of columns"
+    assert a.shape[-1] == nx // 2 + margin, "Half plane grid has %d columns, expected %d" % \
+                                            (a.shape[-1], nx // 2 + margin)
+    mirror_rows = (ny - numpy.arange(ny)) % ny
+    
+    half = numpy.zeros(list(a.shape[:-1]) + [nx // 2 + 1], dtype=a.dtype)
+    half[..., :nx // 2] = a[..., margin:]
+    half[..., :margin + 1] += numpy.conj(a[..., mirror_rows, margin::-1])
+    half *= 0.5
+    
+    result = numpy.fft.fftshift(_transform('irfft2', numpy.fft.ifftshift(half, axes=-2), workers, s=[ny, nx]),
+                                axes=[-2, -1])
+    return result.astype(numpy.finfo(a.dtype).dtype, copy=False)
+
+
+def fft_half_plane(a, margin, workers=None):
+    """ Fourier transformation from a real image to a half plane grid
+
+    Returns columns nx//2 - margin to nx - 1 of fft(a), calculated using a real FFT. The margin columns at
+    negative u are filled using the Hermitian symmetry of the transform of a real image.
+
+    .. note::
+
+        Only the two innermost axes are transformed
+
+    :param a: real image in `lm` coordinate space [..., ny, nx]
+    :param margin: Number of columns of the half plane grid at negative u
+    :param workers: Number of threads, default set by set_fft_backend
+    :return: half plane `uv` grid [..., ny, nx//2 + margin]
+    """
+    assert numpy.isrealobj(a), "Half plane transform needs a real image"
+    ny, nx = a.shape[-2:]
+    assert nx % 2 == 0, "Half plane transform needs an even number of columns"
+    mirror_rows = (ny - numpy.arange(ny)) % ny
+    
+    half = numpy.fft.fftshift(_transform('rfft2', numpy.fft.ifftshift(a, axes=[-2, -1]), workers), axes=-2)
+    result = numpy.zeros(list(a.shape[:-1]) + [nx // 2 + margin],
+                         dtype=numpy.result_type(a.dtype, numpy.complex64))
+    result[..., margin:] = half[..., :nx // 2]
+    result[..., :margin] = numpy.conj(half[..., mirror_rows, margin:0:-1])
+    return result
+
+
+def fft_friendly_size(n, parity=0):
+    """ Smallest length not less than n whose only prime factors are 2, 3, 5 and 7
 
-def pad_mid(ff, npixel):
+    The FFT of such a length is fast for all the FFT backends. Lengths with large prime factors can be several
+    times slower.
+
+    :param n: Smallest acceptable length
+    :param parity: Remainder of the length modulo 2 (e.g. 0 for even lengths, as needed by pad_mid), or None for
+        any length
+    :return: length
+    """
+    n = max(int(n), 1)
+    while True:
+        if parity is None or n % 2 == parity:
+            m = n
+            for p in (2, 3, 5, 7):
+                while m % p == 0:
+                    m //= p
+            if m == 1:
+                return n
+        n += 1
+
+
+def pad_mid(ff, npixel, out=None):
     """
     Pad a far field image with zeroes to make it the given size.
 
@@ -55,10 +333,17 @@ def pad_mid(ff, npixel):
 
     :param npixel:  The desired far field size
 
+    :param out: Optional array of the padded shape to hold the result
+
     """
     ny, nx = ff.shape[-2:]
     cx = nx // 2
     cy = ny // 2
+    if out is not None:
+        assert out.shape[-2:] == (npixel, npixel), "Output shape %s is not padded to %d" % (out.shape, npixel)
+        out.fill(0)
+        out[..., npixel // 2 - cy:npixel // 2 - cy + ny, npixel // 2 - cx:npixel // 2 - cx + nx] = ff
+        return out
     if npixel == nx:
         return ff
     assert npixel > nx and npixel > ny
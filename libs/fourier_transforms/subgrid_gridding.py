@@ -0,0 +1,252 @@
+"""
+Image domain gridding onto small subgrids.
+
+The visibilities are grouped into chunks that lie close together on the uv grid. For each chunk a small subgrid
+image (subgrid_size pixels square, covering the whole padded field of view) is formed by a direct Fourier sum of
+the visibilities, in which the w term (and optionally the A terms of the two stations) is applied exactly at each
+pixel. The subgrid image is multiplied by the taper (the inverse of the grid correction function), Fourier
+transformed, and added into the master uv grid. Degridding is the adjoint: the subgrid is cut from the master grid,
+transformed to the image domain, tapered, and each visibility is found by a direct Fourier sum.
+
+The cost per visibility is subgrid_size ** 2, independent of the size of the image and of the w kernels. The
+subgrid must hold the taper support and the w support of the largest w, so subgrid_size is increased if it is too
+small for the data.
+
+See van der Tol, Veenboer and Offringa, A&A 616, A27 (2018).
+"""
+
+import logging
+
+import numpy
+
+from libs.fourier_transforms.convolutional_gridding import anti_aliasing_calculate, coordinates, gridding_weights
+from libs.fourier_transforms.fft_support import fft, ifft
+
+log = logging.getLogger(__name__)
+
+
+def subgrid_w_support(field_of_view, w):
+    """ Half width (in grid cells) of the transform of the w term
+
+    :param field_of_view: Field of view of the (padded) grid (radians)
+    :param w: Absolute w (wavelengths), scalar or array
+    :return: half width in cells
+    """
+    lmax = min(field_of_view / numpy.sqrt(2.0), 0.99)
+    return numpy.ceil(numpy.abs(w) * field_of_view * lmax / numpy.sqrt(1.0 - lmax ** 2)).astype('int')
+
+
+def subgrid_size_required(field_of_view, w, subgrid_size=32, support=3):
+    """ Size of subgrid needed to hold the taper support and the w support, and the margin they need
+
+    If subgrid_size is less than four times the margin, it is increased to the next power of two that is not.
+
+    :param field_of_view: Field of view of the (padded) grid (radians)
+    :param w: Absolute w (wavelengths), scalar or array
+    :param subgrid_size: Smallest size of subgrid (pixels)
+    :param support: Support of the taper kernel (pixels)
+    :return: subgrid size, margin (pixels)
+    """
+    margin = support + 1 + subgrid_w_support(field_of_view, w)
+    size = numpy.maximum(subgrid_size, 2 ** numpy.ceil(numpy.log2(4 * margin))).astype('int')
+    return size, margin
+
+
+def subgrid_layout(shape, vuvwmap, vfrequencymap, vw, field_of_view, subgrid_size=32, support=3):
+    """ Group the visibilities into chunks, each to be gridded through one subgrid
+
+    The visibilities are first divided by the size of subgrid needed for their w, so that the few with large w do
+    not make the subgrids of all the others large. For each size, the grid is divided into square tiles of
+    size - 2 * margin cells, where the margin holds the taper support and the largest w support. Each chunk holds
+    the visibilities of one size and channel that fall in one tile.
+
+    :param shape: Shape of grid [nchan, npol, ny, nx]
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param vw: w of visibilities (wavelengths)
+    :param field_of_view: Field of view of the grid (radians)
+    :param subgrid_size: Smallest size of subgrid (pixels)
+    :param support: Support of the taper kernel (pixels)
+    :return: list, for each subgrid size, of (size, row order, start of each chunk in the ordered rows
+        [nchunks + 1], channel, y and x of the lower corner of the subgrid of each chunk)
+    """
+    _, _, ny, nx = shape
+    rowsize, _ = subgrid_size_required(field_of_view, vw, subgrid_size, support)
+    chan = numpy.array(vfrequencymap, dtype='int')
+    layouts = []
+    for size in numpy.unique(rowsize):
+        rows = numpy.nonzero(rowsize == size)[0]
+        margin = support + 1 + numpy.max(subgrid_w_support(field_of_view, vw[rows]))
+        tile = size - 2 * margin
+        x = numpy.floor(nx // 2 + vuvwmap[rows, 0] * nx).astype('int') // tile
+        y = numpy.floor(ny // 2 + vuvwmap[rows, 1] * ny).astype('int') // tile
+        ntx = nx // tile + 1
+        nty = ny // tile + 1
+        key = (chan[rows] * nty + y) * ntx + x
+        order = numpy.argsort(key, kind='stable')
+        keys, starts = numpy.unique(key[order], return_index=True)
+        starts = numpy.append(starts, len(order))
+        log.debug("subgrid_layout: %d visibilities in %d subgrids of size %d" % (len(rows), len(keys), size))
+        layouts.append((int(size), rows[order], starts, keys // (nty * ntx), (keys // ntx) % nty * tile - margin,
+                        keys % ntx * tile - margin))
+    return layouts
+
+
+def subgrid_taper(subgrid_size):
+    """ Taper applied to each subgrid image: the inverse of the grid correction function
+
+    Its transform is the spheroidal function used by anti_aliasing_calculate, so the subgrid image is corrected by
+    the same gcf as for convolutional gridding.
+
+    :param subgrid_size: Size of subgrid (pixels)
+    :return: taper [subgrid_size, subgrid_size]
+    """
+    gcf, _ = anti_aliasing_calculate((subgrid_size, subgrid_size))
+    taper = numpy.zeros_like(gcf)
+    taper[gcf > 0.0] = 1.0 / gcf[gcf > 0.0]
+    return taper
+
+
+def subgrid_n_minus_one(subgrid_size, field_of_view):
+    """ n - 1 at the pixels of a subgrid image covering the field of view
+
+    Outside the unit circle the value is zero, as for w_beam.
+
+    :param subgrid_size: Size of subgrid (pixels)
+    :param field_of_view: Field of view of the grid (radians)
+    :return: n - 1 [subgrid_size, subgrid_size]
+    """
+    l = field_of_view * coordinates(subgrid_size)
+    r2 = l[numpy.newaxis, :] ** 2 + l[:, numpy.newaxis] ** 2
+    nm1 = numpy.zeros_like(r2)
+    nm1[r2 < 1.0] = numpy.sqrt(1.0 - r2[r2 < 1.0]) - 1.0
+    return nm1
+
+
+def subgrid_phasors(subgrid_size, nm1, dx, dy, w, dtype='complex'):
+    """ Image domain phasors of visibilities on a subgrid, including the w term
+
+    :param subgrid_size: Size of subgrid (pixels)
+    :param nm1: n - 1 at the subgrid pixels
+    :param dx: Offset of visibilities from the subgrid centre (cells)
+    :param dy: Offset of visibilities from the subgrid centre (cells)
+    :param w: w of visibilities (wavelengths)
+    :param dtype: Complex dtype of phasors
+    :return: phasors [nvis, subgrid_size * subgrid_size]
+    """
+    pix = 2.0 * numpy.pi * (numpy.arange(subgrid_size) - subgrid_size // 2) / subgrid_size
+    phase = w[:, numpy.newaxis, numpy.newaxis] * (2.0 * numpy.pi * nm1)[numpy.newaxis, ...]
+    phase += (dy[:, numpy.newaxis] * pix[numpy.newaxis, :])[..., numpy.newaxis]
+    phase += (dx[:, numpy.newaxis] * pix[numpy.newaxis, :])[:, numpy.newaxis, :]
+    return numpy.exp(1j * phase).astype(dtype, copy=False).reshape([len(w), subgrid_size * subgrid_size])
+
+
+def subgrid_aterm_products(aterms, vantennas, rows):
+    """ Product of the A term of the first station and the conjugate A term of the second for some rows
+
+    :param aterms: A term of each station on the subgrid [nant, subgrid_size, subgrid_size]
+    :param vantennas: Station indices of visibilities [nvis, 2]
+    :param rows: Rows to use
+    :return: products [nrows, subgrid_size * subgrid_size]
+    """
+    nant = aterms.shape[0]
+    a = aterms.reshape([nant, -1])
+    return a[vantennas[rows, 0]] * numpy.conj(a[vantennas[rows, 1]])
+
+
+def subgrid_grid(uvgrid, vis, visweights, vuvwmap, vfrequencymap, vw, field_of_view, subgrid_size=32,
+                 aterm_function=None, vantennas=None, batch_size=256):
+    """ Grid visibilities through image domain subgrids
+
+    Other arguments are as for convolutional_grid. The gridding correction function for the result is that of
+    anti_aliasing_calculate for the grid shape.
+
+    :param uvgrid: Grid to add to [nchan, npol, ny, nx]
+    :param vis: Visibility values
+    :param visweights: Visibility weights
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param vw: w of visibilities (wavelengths)
+    :param field_of_view: Field of view of the grid (radians)
+    :param subgrid_size: Smallest size of subgrid (pixels)
+    :param aterm_function: Optional function of the subgrid size returning the A term of each station on the
+        subgrid [nant, size, size]
+    :param vantennas: Station indices of visibilities [nvis, 2], required with aterm_function
+    :param batch_size: Number of visibilities for which phasors are held at once
+    :return: uv grid[nchan, npol, ny, nx], sumwt[nchan, npol]
+    """
+    inchan, inpol, ny, nx = uvgrid.shape
+    viswt, sumwt = gridding_weights(uvgrid.shape, vis, visweights, numpy.array(vfrequencymap, dtype='int'))
+    x = nx // 2 + vuvwmap[:, 0] * nx
+    y = ny // 2 + vuvwmap[:, 1] * ny
+
+    for size, order, starts, chunkchan, y0, x0 in subgrid_layout(uvgrid.shape, vuvwmap, vfrequencymap, vw,
+                                                                 field_of_view, subgrid_size):
+        taper = subgrid_taper(size).reshape([1, -1])
+        nm1 = subgrid_n_minus_one(size, field_of_view)
+        aterms = None if aterm_function is None else aterm_function(size)
+        # Subgrids near the edge are added to a grid with a border, which is then discarded
+        master = numpy.zeros([inchan, inpol, ny + 2 * size, nx + 2 * size], dtype=uvgrid.dtype)
+        subgrid = numpy.zeros([inpol, size * size], dtype=uvgrid.dtype)
+        for chunk in range(len(starts) - 1):
+            subgrid[...] = 0.0
+            for start in range(starts[chunk], starts[chunk + 1], batch_size):
+                rows = order[start:min(start + batch_size, starts[chunk + 1])]
+                phasors = subgrid_phasors(size, nm1, x[rows] - x0[chunk] - size // 2,
+                                          y[rows] - y0[chunk] - size // 2, vw[rows], dtype=uvgrid.dtype)
+                if aterms is not None:
+                    phasors *= numpy.conj(subgrid_aterm_products(aterms, vantennas, rows))
+                subgrid += viswt[rows].T @ phasors
+            ys = slice(y0[chunk] + size, y0[chunk] + 2 * size)
+            xs = slice(x0[chunk] + size, x0[chunk] + 2 * size)
+            master[chunkchan[chunk], :, ys, xs] += fft((subgrid * taper).reshape([inpol, size, size])) / (size * size)
+        uvgrid += master[..., size:size + ny, size:size + nx]
+
+    return uvgrid, sumwt
+
+
+def subgrid_degrid(vshape, uvgrid, vuvwmap, vfrequencymap, vw, field_of_view, subgrid_size=32,
+                   aterm_function=None, vantennas=None, batch_size=256):
+    """ Degrid visibilities through image domain subgrids
+
+    This is the adjoint of subgrid_grid. The model transformed to the uv grid should have been multiplied by the
+    gridding correction function of anti_aliasing_calculate for the grid shape.
+
+    :param vshape: Shape of visibility [nvis, npol]
+    :param uvgrid: Grid to degrid from [nchan, npol, ny, nx]
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param vw: w of visibilities (wavelengths)
+    :param field_of_view: Field of view of the grid (radians)
+    :param subgrid_size: Smallest size of subgrid (pixels)
+    :param aterm_function: Optional function of the subgrid size returning the A term of each station on the
+        subgrid [nant, size, size]
+    :param vantennas: Station indices of visibilities [nvis, 2], required with aterm_function
+    :param batch_size: Number of visibilities for which phasors are held at once
+    :return: Array of visibilities.
+    """
+    inchan, inpol, ny, nx = uvgrid.shape
+    x = nx // 2 + vuvwmap[:, 0] * nx
+    y = ny // 2 + vuvwmap[:, 1] * ny
+    vis = numpy.zeros([vshape[0], inpol], dtype=uvgrid.dtype)
+
+    for size, order, starts, chunkchan, y0, x0 in subgrid_layout(uvgrid.shape, vuvwmap, vfrequencymap, vw,
+                                                                 field_of_view, subgrid_size):
+        taper = subgrid_taper(size).reshape([1, -1])
+        nm1 = subgrid_n_minus_one(size, field_of_view)
+        aterms = None if aterm_function is None else aterm_function(size)
+        master = numpy.zeros([inchan, inpol, ny + 2 * size, nx + 2 * size], dtype=uvgrid.dtype)
+        master[..., size:size + ny, size:size + nx] = uvgrid
+        for chunk in range(len(starts) - 1):
+            ys = slice(y0[chunk] + size, y0[chunk] + 2 * size)
+            xs = slice(x0[chunk] + size, x0[chunk] + 2 * size)
+            image = ifft(master[chunkchan[chunk], :, ys, xs]).reshape([inpol, size * size]) * taper
+            for start in range(starts[chunk], starts[chunk + 1], batch_size):
+                rows = order[start:min(start + batch_size, starts[chunk + 1])]
+                phasors = subgrid_phasors(size, nm1, x[rows] - x0[chunk] - size // 2,
+                                          y[rows] - y0[chunk] - size // 2, vw[rows], dtype=uvgrid.dtype)
+                if aterms is not None:
+                    phasors *= numpy.conj(subgrid_aterm_products(aterms, vantennas, rows))
+                vis[rows] = numpy.conj(phasors) @ image.T
+
+    return vis.reshape(vshape)
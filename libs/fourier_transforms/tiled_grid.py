@@ -0,0 +1,323 @@
+""" A uv grid held as square tiles that are allocated only where visibilities fall.
+
+When the uv coverage of the visibilities is small, e.g. for one time slice or for the short baselines, most of a
+dense [nchan, npol, ny, nx] grid is never touched. A TiledGrid holds only the tiles that are touched, so the memory
+needed and the cost of allocating and clearing it scale with the uv coverage rather than the image size.
+
+Each tile is stored with a halo of extra rows and columns, at least as wide as the convolution kernel, so that every
+visibility is gridded into a single tile (the one holding its first kernel tap) by the existing gridding engines. The
+halos overlap the neighbouring tiles and are added to them when the grid is made dense or transformed.
+
+The transforms between a tiled grid and an image are pruned: ifft_tiled transforms each column band of occupied
+tiles along v and keeps only the rows of the unpadded image, before the transform along u. fft_tiled does the
+reverse, filling only the allocated tiles. Neither makes a dense padded grid.
+"""
+
+import logging
+
+import numpy
+
+from libs.fourier_transforms.convolutional_gridding import gridding_coordinates, gridding_weights, \
+    grid_taps_numpy, grid_taps_numba, degrid_taps_numpy, degrid_loop_numba, ExactKernel
+from libs.fourier_transforms.fft_support import fft_axis, ifft_axis
+from libs.util.numba_support import numba_available, warn_numba_unavailable
+
+log = logging.getLogger(__name__)
+
+
+def _mid_slice(n, npixel):
+    """ Slice of the middle npixel samples of an axis of length n, as used by pad_mid and extract_mid
+    """
+    start = n // 2 - npixel // 2
+    return slice(start, start + npixel)
+
+
+class TiledGrid:
+    """ uv grid [nchan, npol, ny, nx] held as the tiles of tile x tile cells that have been allocated
+
+    The tiles are stacked in data [ntiles, npol, tile + halo, tile + halo], in the order allocated. Tile i holds
+    channel chan[i], rows ty[i] * tile onwards and columns tx[i] * tile onwards of the dense grid. For example::
+
+        tiledgrid = TiledGrid([nchan, npol, ny, nx], tile=64, halo=8)
+        tiledgrid, sumwt = convolutional_grid_tiled(kernel_list, tiledgrid, vis, visweights, vuvwmap, vfrequencymap)
+        image = ifft_tiled(tiledgrid, npixel)
+    """
+
+    def __init__(self, shape, tile=64, halo=8, dtype='complex'):
+        """ Create a grid with no tiles
+
+        :param shape: Shape of the dense grid [nchan, npol, ny, nx]
+        :param tile: Size of tiles (cells)
+        :param halo: Extra rows and columns of each tile, at least the width of the convolution kernel
+        :param dtype: Complex dtype of grid
+        """
+        nchan, npol, ny, nx = shape
+        assert tile > 0 and halo >= 0, "Invalid tile %d or halo %d" % (tile, halo)
+        self.shape = tuple(shape)
+        self.tile = tile
+        self.halo = halo
+        self.dtype = dtype
+        self.ntiles_y = (ny + tile - 1) // tile
+        self.ntiles_x = (nx + tile - 1) // tile
+        self.keys = numpy.zeros([0], dtype='int')
+        self.data = numpy.zeros([0, npol, tile + halo, tile + halo], dtype=dtype)
+        self._index = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    @property
+    def occupancy(self):
+        """ Fraction of the tiles of the dense grid that are allocated
+        """
+        return len(self) / float(self.shape[0] * self.ntiles_y * self.ntiles_x)
+
+    @property
+    def chan(self):
+        return self.keys // (self.ntiles_y * self.ntiles_x)
+
+    @property
+    def ty(self):
+        return (self.keys // self.ntiles_x) % self.ntiles_y
+
+    @property
+    def tx(self):
+        return self.keys % self.ntiles_x
+
+    def tile_keys(self, chan, x, y):
+        """ Key of the tile holding each of the given cells
+
+        :param chan: Channel of cells
+        :param x: Column of cells
+        :param y: Row of cells
+        :return: keys
+        """
+        _, _, ny, nx = self.shape
+        assert numpy.all((x >= 0) & (x < nx) & (y >= 0) & (y < ny)), "Cells lie outside the grid"
+        return (numpy.asarray(chan, dtype='int') * self.ntiles_y + y // self.tile) * self.ntiles_x + x // self.tile
+
+    def allocate(self, keys):
+        """ Allocate (as zero) the tiles with the given keys that are not yet allocated
+
+        :param keys: Tile keys, see tile_keys
+        :return: index of the tile in data for each key
+        """
+        unique, inverse = numpy.unique(keys, return_inverse=True)
+        new = numpy.array([key for key in unique if key not in self._index], dtype='int')
+        if len(new) > 0:
+            for i, key in enumerate(new):
+                self._index[key] = len(self.keys) + i
+            self.keys = numpy.concatenate([self.keys, new])
+            self.data = numpy.concatenate([self.data, numpy.zeros([len(new)] + list(self.data.shape[1:]),
+                                                                  dtype=self.dtype)])
+        positions = numpy.array([self._index[key] for key in unique], dtype='int')
+        return positions[inverse]
+
+    def tile_extent(self, i):
+        """ Rows and columns of the dense grid covered by tile i, including its halo
+
+        :param i: index of tile in data
+        :return: channel, slice of rows, slice of columns
+        """
+        _, _, ny, nx = self.shape
+        size = self.tile + self.halo
+        y0, x0 = self.ty[i] * self.tile, self.tx[i] * self.tile
+        return self.chan[i], slice(y0, min(y0 + size, ny)), slice(x0, min(x0 + size, nx))
+
+    def to_dense(self):
+        """ Add the tiles (and their halos) into a dense grid
+
+        :return: dense grid [nchan, npol, ny, nx]
+        """
+        grid = numpy.zeros(self.shape, dtype=self.dtype)
+        for i in range(len(self)):
+            chan, rows, cols = self.tile_extent(i)
+            grid[chan, :, rows, cols] += self.data[i, :, :rows.stop - rows.start, :cols.stop - cols.start]
+        return grid
+
+
+def tiled_grid_coordinates(kernel_list, tiledgrid, vuvwmap, vfrequencymap):
+    """ Find the tile and the coordinates within it of the first kernel tap of each visibility
+
+    The tiles needed are allocated.
+
+    :param kernel_list: List of oversampled convolution kernels
+    :param tiledgrid: TiledGrid
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :return: tile index, x, y (of the first kernel tap within the tile), kernel_table[nkernels, gh, gw],
+        kernel_select, chan
+    """
+    chan, x, y, kernel_table, kernel_select = gridding_coordinates(kernel_list, tiledgrid.shape, vuvwmap,
+                                                                   vfrequencymap)
+    _, gh, gw = kernel_table.shape
+    assert max(gh, gw) <= tiledgrid.halo, "Halo of tiles %d is smaller than kernel %d" % (tiledgrid.halo, gw)
+    index = tiledgrid.allocate(tiledgrid.tile_keys(chan, x, y))
+    x = x - tiledgrid.tx[index] * tiledgrid.tile
+    y = y - tiledgrid.ty[index] * tiledgrid.tile
+    return index, x, y, kernel_table, kernel_select, chan
+
+
+def convolutional_grid_tiled(kernel_list, tiledgrid, vis, visweights, vuvwmap, vfrequencymap, gridder='numpy'):
+    """Grid after convolving with frequency and polarisation independent gcf onto a tiled grid
+
+    The tiles that the visibilities fall in are allocated as needed, and the stack of tiles is gridded onto as if
+    each tile were a channel of a small grid, by grid_taps_numpy or grid_taps_numba.
+
+    :param kernel_list: List of oversampled convolution kernels
+    :param tiledgrid: TiledGrid to add to
+    :param vis: Visibility values
+    :param visweights: Visibility weights
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param gridder: Gridding engine 'numpy' | 'numba'
+    :return: tiledgrid, sumwt[nchan, npol]
+    """
+    exact = kernel_list[1][0]
+    if isinstance(exact, ExactKernel):
+        sumwt = numpy.zeros(tiledgrid.shape[:2])
+        for rows in exact.chunks(len(vuvwmap)):
+            tiledgrid, chunk_sumwt = convolutional_grid_tiled(exact.kernel_list(tiledgrid.shape[-2:], vuvwmap[rows]),
+                                                              tiledgrid, vis[rows], visweights[rows], vuvwmap[rows],
+                                                              numpy.array(vfrequencymap)[rows], gridder=gridder)
+            sumwt += chunk_sumwt
+        return tiledgrid, sumwt
+    
+    index, x, y, kernel_table, kernel_select, chan = tiled_grid_coordinates(kernel_list, tiledgrid, vuvwmap,
+                                                                            vfrequencymap)
+    viswt, sumwt = gridding_weights(tiledgrid.shape, vis, visweights, chan)
+    if gridder == 'numba' and not numba_available:
+        warn_numba_unavailable('convolutional_grid_tiled', 'grid_taps_numpy')
+        gridder = 'numpy'
+    if gridder == 'numpy':
+        grid_taps_numpy(tiledgrid.data, viswt, kernel_table, kernel_select, index, x, y)
+    elif gridder == 'numba':
+        grid_taps_numba(tiledgrid.data, viswt, kernel_table, kernel_select, index, x, y)
+    else:
+        raise ValueError("Unknown gridder %s" % gridder)
+    return tiledgrid, sumwt
+
+
+def convolutional_degrid_tiled(kernel_list, vshape, tiledgrid, vuvwmap, vfrequencymap, gridder='numpy'):
+    """Convolutional degridding with frequency and polarisation independent gcf from a tiled grid
+
+    The tiles needed should have been filled, see tiled_grid_allocate and fft_tiled.
+
+    :param kernel_list: list of oversampled convolution kernel
+    :param vshape: Shape of visibility
+    :param tiledgrid: TiledGrid to degrid from
+    :param vuvwmap: function to map uvw to grid fractions
+    :param vfrequencymap: function to map frequency to image channels
+    :param gridder: Degridding engine 'numpy' | 'numba'
+    :return: Array of visibilities.
+    """
+    exact = kernel_list[1][0]
+    if isinstance(exact, ExactKernel):
+        vis = numpy.zeros([vshape[0], vshape[-1]], dtype='complex')
+        for rows in exact.chunks(vshape[0]):
+            vis[rows] = convolutional_degrid_tiled(exact.kernel_list(tiledgrid.shape[-2:], vuvwmap[rows]),
+                                                   (len(vis[rows]), vshape[-1]), tiledgrid, vuvwmap[rows],
+                                                   numpy.array(vfrequencymap)[rows], gridder=gridder)
+        return vis.reshape(vshape)
+    
+    index, x, y, kernel_table, kernel_select, _ = tiled_grid_coordinates(kernel_list, tiledgrid, vuvwmap,
+                                                                         vfrequencymap)
+    kernel_table = numpy.conjugate(kernel_table)
+    vis = numpy.zeros([vshape[0], vshape[-1]], dtype='complex')
+    if gridder == 'numba' and not numba_available:
+        warn_numba_unavailable('convolutional_degrid_tiled', 'degrid_taps_numpy')
+        gridder = 'numpy'
+    if gridder == 'numpy':
+        degrid_taps_numpy(vis, tiledgrid.data, kernel_table, kernel_select, index, x, y)
+    elif gridder == 'numba':
+        if not numpy.any(numpy.imag(kernel_table)):
+            kernel_table = numpy.ascontiguousarray(numpy.real(kernel_table))
+        degrid_loop_numba(vis, tiledgrid.data, kernel_table, kernel_select, index, x, y)
+    else:
+        raise ValueError("Unknown gridder %s" % gridder)
+    return vis.reshape(vshape)
+
+
+def tiled_grid_allocate(kernel_list, tiledgrid, vuvwmap, vfrequencymap):
+    """ Allocate the tiles needed to degrid the visibilities
+
+    :param kernel_list: list of oversampled convolution kernel
+    :param tiledgrid: TiledGrid
+    :param vuvwmap: function to map uvw to grid fractions
+    :param vfrequencymap: function to map frequency to image channels
+    :return: tiledgrid
+    """
+    exact = kernel_list[1][0]
+    if isinstance(exact, ExactKernel):
+        for rows in exact.chunks(len(vuvwmap)):
+            tiled_grid_allocate(exact.kernel_list(tiledgrid.shape[-2:], vuvwmap[rows]), tiledgrid, vuvwmap[rows],
+                                numpy.array(vfrequencymap)[rows])
+        return tiledgrid
+    
+    tiled_grid_coordinates(kernel_list, tiledgrid, vuvwmap, vfrequencymap)
+    return tiledgrid
+
+
+def ifft_tiled(tiledgrid, npixel, workers=None):
+    """ Fourier transformation from a tiled grid to the middle npixel x npixel of the image
+
+    The result is extract_mid(ifft(tiledgrid.to_dense()), npixel). Each column band of tiles is transformed along v
+    and only the middle npixel rows are kept, so the largest array made is [npol, npixel, nx] for one channel.
+    Bands with no tiles are not transformed.
+
+    :param tiledgrid: TiledGrid to transform
+    :param npixel: Size of image
+    :param workers: Number of threads, default set by set_fft_backend
+    :return: complex image [nchan, npol, npixel, npixel]
+    """
+    nchan, npol, ny, nx = tiledgrid.shape
+    rows_mid, cols_mid = _mid_slice(ny, npixel), _mid_slice(nx, npixel)
+    result = numpy.zeros([nchan, npol, npixel, npixel], dtype=tiledgrid.dtype)
+    chans, txs = tiledgrid.chan, tiledgrid.tx
+    for chan in numpy.unique(chans):
+        rowspace = numpy.zeros([npol, npixel, nx], dtype=tiledgrid.dtype)
+        for tx in numpy.unique(txs[chans == chan]):
+            band = numpy.nonzero((chans == chan) & (txs == tx))[0]
+            _, _, cols = tiledgrid.tile_extent(band[0])
+            strip = numpy.zeros([npol, ny, cols.stop - cols.start], dtype=tiledgrid.dtype)
+            for i in band:
+                _, rows, _ = tiledgrid.tile_extent(i)
+                strip[:, rows, :] += tiledgrid.data[i, :, :rows.stop - rows.start, :strip.shape[-1]]
+            rowspace[:, :, cols] += ifft_axis(strip, axis=-2, workers=workers)[:, rows_mid, :]
+        result[chan] = ifft_axis(rowspace, axis=-1, workers=workers)[..., cols_mid]
+    return result
+
+
+def fft_tiled(tiledgrid, image, workers=None):
+    """ Fourier transformation from an image to the allocated tiles of a tiled grid
+
+    The tiles are filled with the values of fft(pad_mid(image, nx)), including their halos. The image is
+    transformed along l, and then only the column bands holding tiles are transformed along m.
+
+    :param tiledgrid: TiledGrid with the tiles needed allocated (see tiled_grid_allocate)
+    :param image: image [nchan, npol, npixel, npixel]
+    :param workers: Number of threads, default set by set_fft_backend
+    :return: tiledgrid
+    """
+    nchan, npol, ny, nx = tiledgrid.shape
+    npixel = image.shape[-1]
+    rows_mid, cols_mid = _mid_slice(ny, npixel), _mid_slice(nx, npixel)
+    chans, txs = tiledgrid.chan, tiledgrid.tx
+    for chan in numpy.unique(chans):
+        colspace = numpy.zeros([npol, npixel, nx], dtype=tiledgrid.dtype)
+        colspace[..., cols_mid] = image[chan]
+        colspace = fft_axis(colspace, axis=-1, workers=workers)
+        for tx in numpy.unique(txs[chans == chan]):
+            band = numpy.nonzero((chans == chan) & (txs == tx))[0]
+            _, _, cols = tiledgrid.tile_extent(band[0])
+            strip = numpy.zeros([npol, ny, cols.stop - cols.start], dtype=tiledgrid.dtype)
+            strip[:, rows_mid, :] = colspace[..., cols]
+            strip = fft_axis(strip, axis=-2, workers=workers)
+            for i in band:
+                _, rows, _ = tiledgrid.tile_extent(i)
+                tiledgrid.data[i, :, :rows.stop - rows.start, :strip.shape[-1]] = strip[:, rows, :]
+    return tiledgrid
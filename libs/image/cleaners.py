@@ -6,6 +6,8 @@ import numpy
 import logging
 import time
 
+from ..fourier_transforms.fft_support import fft, ifft
+
 log = logging.getLogger(__name__)
 
 
@@ -37,7 +39,7 @@ def hogbom(dirty, psf, window, gain, thresh, niter, fracthresh, prefix=''):
     log.info("hogbom %s This minor cycle will stop at %d iterations or peak < %.6f (Jy/beam)" %
              (prefix, niter, absolutethresh))
 
-    comps = numpy.zeros(dirty.shape)
+    comps = numpy.zeros(dirty.shape, dtype=dirty.dtype)
     res = numpy.array(dirty)
     pmax = psf.max()
     assert pmax > 0.0
@@ -124,7 +126,7 @@ def msclean(dirty, psf, window, gain, thresh, niter, scales, fracthresh, prefix=
     assert niter > 0
     assert len(scales) > 0
 
-    comps = numpy.zeros(dirty.shape)
+    comps = numpy.zeros(dirty.shape, dtype=dirty.dtype)
 
     pmax = psf.max()
     assert pmax > 0.0
@@ -257,20 +259,16 @@ def create_scalestack(scaleshape, scales, norm=True):
 def convolve_scalestack(scalestack, img):
     """Convolve img by the specified scalestack, returning the resulting stack
 
+    The stack has the same dtype as img.
+
     :param scalestack: stack containing the scales
     :param img: Image to be convolved
     :return: stack
     """
 
-    convolved = numpy.zeros(scalestack.shape)
-    ximg = numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.fftshift(img)))
-
-    nscales = scalestack.shape[0]
-    for iscale in range(nscales):
-        xscale = numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.fftshift(scalestack[iscale, :, :])))
-        xmult = ximg * numpy.conjugate(xscale)
-        convolved[iscale, :, :] = numpy.real(numpy.fft.ifftshift(numpy.fft.ifft2(numpy.fft.ifftshift(xmult))))
-    return convolved
+    ximg = fft(img)
+    xscale = fft(scalestack)
+    return numpy.real(ifft(ximg[numpy.newaxis, ...] * numpy.conjugate(xscale))).astype(img.dtype)
 
 
 def convolve_convolve_scalestack(scalestack, img):
@@ -278,23 +276,17 @@ def convolve_convolve_scalestack(scalestack, img):
 
     :param scalestack: stack containing the scales
     :param img: Image to be convolved
-    :return: Twice convolved image [nscales, nscales, nx, ny]
+    :return: Twice convolved image [nscales, nscales, nx, ny], with the same dtype as img
     """
 
     nscales, nx, ny = scalestack.shape
     convolved_shape = [nscales, nscales, nx, ny]
-    convolved = numpy.zeros(convolved_shape)
-    ximg = numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.fftshift(img)))
-
-    xscaleshape = [nscales, nx, ny]
-    xscale = numpy.zeros(xscaleshape, dtype='complex')
-    for s in range(nscales):
-        xscale[s] = numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.fftshift(scalestack[s, ...])))
+    convolved = numpy.zeros(convolved_shape, dtype=img.dtype)
+    ximg = fft(img)
+    xscale = fft(scalestack)
 
     for s in range(nscales):
-        for p in range(nscales):
-            xmult = ximg * xscale[p] * numpy.conjugate(xscale[s])
-            convolved[s, p, ...] = numpy.real(numpy.fft.ifftshift(numpy.fft.ifft2(numpy.fft.ifftshift(xmult))))
+        convolved[s, ...] = numpy.real(ifft(ximg[numpy.newaxis, ...] * xscale * numpy.conjugate(xscale[s])))
     return convolved
 
 
@@ -238,17 +238,18 @@ def copy_image(im: Image) -> Image:
     return fim
 
 
-def create_empty_image_like(im: Image) -> Image:
+def create_empty_image_like(im: Image, dtype=None) -> Image:
     """ Create an empty image like another in shape and wcs
 
     :param im:
+    :param dtype: dtype of the new image (default that of im)
     :return: Image
     
     """
     assert isinstance(im, Image), im
     fim = Image()
     fim.polarisation_frame = im.polarisation_frame
-    fim.data = numpy.zeros_like(im.data)
+    fim.data = numpy.zeros_like(im.data, dtype=dtype)
     if im.wcs is None:
         fim.wcs = None
     else:
@@ -284,7 +285,7 @@ def fft_image(im, template_image=None):
         ft_wcs.wcs.ctype[1] = 'VV'
         ft_wcs.wcs.cdelt[0] = 1.0 / (ft_shape[3] * d2r * im.wcs.wcs.cdelt[0])
         ft_wcs.wcs.cdelt[1] = 1.0 / (ft_shape[2] * d2r * im.wcs.wcs.cdelt[1])
-        ft_data = ifft(im.data.astype('complex'))
+        ft_data = ifft(im.data)
         return create_image_from_array(ft_data, wcs=ft_wcs, polarisation_frame=im.polarisation_frame)
     elif im.wcs.wcs.ctype[0] == 'UU' and im.wcs.wcs.ctype[1] == 'VV':
         ft_wcs.wcs.crval[0] = template_image.wcs.wcs.crval[0]
@@ -295,7 +296,7 @@ def fft_image(im, template_image=None):
         ft_wcs.wcs.ctype[1] = template_image.wcs.wcs.ctype[1]
         ft_wcs.wcs.cdelt[0] = template_image.wcs.wcs.cdelt[0]
         ft_wcs.wcs.cdelt[1] = template_image.wcs.wcs.cdelt[1]
-        ft_data = fft(im.data.astype('complex'))
+        ft_data = fft(im.data)
         return create_image_from_array(ft_data, wcs=ft_wcs, polarisation_frame=im.polarisation_frame)
     else:
         raise NotImplementedError("Cannot FFT specified axes")
@@ -2,23 +2,148 @@
 Functions that aid definition of fourier transform processing.
 """
 
+import functools
+import hashlib
 import logging
 import warnings
 
 from astropy.wcs import FITSFixedWarning
 
 import numpy
+from scipy.ndimage import map_coordinates
 
 from data_models.memory_data_models import Visibility, Image
-from data_models.parameters import get_parameter
+from data_models.parameters import get_parameter, get_precision_dtypes
 from data_models.polarisation import PolarisationFrame
 
-from ..fourier_transforms.convolutional_gridding import anti_aliasing_calculate
+from ..fourier_transforms.convolutional_gridding import anti_aliasing_calculate, gridding_order, es_calculate, \
+    es_kernel_parameters, es_kernels_exact, es_padding, es_table_width, ExactKernel
+from ..fourier_transforms.fft_support import fft_friendly_size
 from ..image.operations import convert_image_to_kernel
 from ..image.operations import copy_image, fft_image, pad_image, create_w_term_like
+from ..util.array_cache import ArrayCache
+from ..util.coordinate_support import parallactic_angle
 
 log = logging.getLogger(__name__)
 
+# Process-wide cache of anti-aliasing functions, shared by all imaging calls in e.g. a Dask worker
+kernel_cache = ArrayCache(max_bytes=2 ** 30, name='kernel_cache')
+
+
+def set_kernel_cache_size(max_bytes):
+    """ Set the memory cap of the process-wide kernel cache, discarding entries as needed
+
+    :param max_bytes: Maximum total size of cached kernels and grid correction functions (bytes)
+    """
+    kernel_cache.resize(max_bytes)
+
+
+def get_anti_aliasing(shape, oversampling=1, support=3, dtype='complex'):
+    """ Get the grid correction function and anti-aliasing kernel from the process-wide kernel cache
+
+    The arrays are calculated by anti_aliasing_calculate on the first call for a given shape, oversampling,
+    support and kernel dtype, and are read-only. The gcf has the matching real dtype.
+
+    :param shape: (height, width) pair
+    :param oversampling: Number of sub-samples per grid pixel
+    :param support: Support of kernel (in pixels) width is 2*support+2
+    :param dtype: dtype of the kernel
+    :return: gcf, kernel
+    """
+    key = ('anti_aliasing', tuple(int(n) for n in shape), oversampling, support, numpy.dtype(dtype).str)
+    
+    def calculate():
+        gcf, kernel = anti_aliasing_calculate(shape, oversampling, support)
+        return gcf.astype(numpy.finfo(dtype).dtype, copy=False), kernel.astype(dtype, copy=False)
+    
+    return kernel_cache.get(key, calculate)
+
+
+def get_es_kernel(shape, width, beta, oversampling=1, dtype='complex'):
+    """ Get the grid correction function and exponential of semicircle kernel table from the process-wide cache
+
+    :param shape: (height, width) pair of the padded grid
+    :param width: Width of kernel (grid cells)
+    :param beta: Shape parameter
+    :param oversampling: Number of sub-samples per grid pixel
+    :param dtype: dtype of the kernel
+    :return: gcf, kernel
+    """
+    key = ('es', tuple(int(n) for n in shape), width, float(beta), oversampling, numpy.dtype(dtype).str)
+
+    def calculate():
+        gcf, kernel = es_calculate(shape, width, beta, oversampling)
+        return gcf.astype(numpy.finfo(dtype).dtype, copy=False), kernel.astype(dtype, copy=False)
+
+    return kernel_cache.get(key, calculate)
+
+
+def get_padding(vis: Visibility, im: Image, **kwargs):
+    """ Get the padding of the grid
+
+    This starts from the padding parameter if given. Otherwise for the exponential of semicircle kernel
+    (kernel='es') it is chosen by es_padding for the target accuracy epsilon, and for other kernels it is 2.
+
+    Unless fft_friendly=False, the padding is then increased so that the padded grid size
+    int(round(padding * npixel)) is the next length with only prime factors 2, 3, 5 and 7 (see fft_friendly_size).
+    The padded size always has the parity of npixel, as needed by pad_mid. The image keeps its requested shape.
+
+    :param vis: Visibility
+    :param im: Image template
+    :return: padding
+    """
+    npixel = im.shape[3]
+    padding = get_parameter(kwargs, "padding", None)
+    if not padding:
+        if get_parameter(kwargs, "kernel", "2d") == 'es':
+            padding = es_padding(get_parameter(kwargs, "epsilon", 1e-6), vis.nvis, npixel)
+        else:
+            padding = 2
+    npad = int(round(padding * npixel))
+    if get_parameter(kwargs, "fft_friendly", True):
+        npad = fft_friendly_size(npad, parity=npixel % 2)
+    elif npad % 2 != npixel % 2:
+        npad += 1
+    if npad != int(round(padding * npixel)):
+        log.debug("get_padding: padded grid size increased from %d to %d" % (int(round(padding * npixel)), npad))
+        padding = npad / npixel
+    return padding
+
+
+def es_kernel_list(vis: Visibility, im: Image, epsilon=1e-6, padding=2, oversampling=None, max_table_bytes=2 ** 26,
+                   dtype='complex'):
+    """ Get the exponential of semicircle kernels and grid correction function for a target accuracy
+
+    The kernel width and shape, and the oversampling of the kernel table, are found from epsilon by
+    es_kernel_parameters unless oversampling is given. If the table would be larger than max_table_bytes, the
+    kernel is instead an ExactKernel, evaluated at the exact uv position of each visibility by the gridding functions
+    in chunks of rows holding no more than max_table_bytes of kernels.
+
+    :param vis: Visibility
+    :param im: Image template
+    :param epsilon: Target relative accuracy
+    :param padding: Padding of the grid
+    :param oversampling: Oversampling of the kernel table (default from epsilon)
+    :param max_table_bytes: Largest kernel table to use
+    :param dtype: dtype of the kernels
+    :return: gcf, kernel list
+    """
+    width, beta, es_oversampling = es_kernel_parameters(epsilon, padding)
+    if oversampling is None:
+        oversampling = es_oversampling
+    shape = (int(round(padding * im.shape[2])), int(round(padding * im.shape[3])))
+    table_bytes = (oversampling * es_table_width(width)) ** 2 * numpy.dtype(dtype).itemsize
+    if table_bytes <= max_table_bytes:
+        log.debug("es_kernel_list: width %d, beta %.3f, oversampling %d" % (width, beta, oversampling))
+        gcf, kernel = get_es_kernel(shape, width, beta, oversampling, dtype=dtype)
+        return gcf, (numpy.zeros_like(vis.w, dtype='int'), [kernel])
+
+    log.debug("es_kernel_list: width %d, beta %.3f, evaluating kernels for each visibility" % (width, beta))
+    gcf, _ = get_es_kernel(shape, width, beta, 1, dtype=dtype)
+    kernel = ExactKernel(functools.partial(es_kernels_exact, width=width, beta=beta, dtype=dtype),
+                         es_table_width(width), dtype=dtype, max_bytes=max_table_bytes)
+    return gcf, (numpy.zeros_like(vis.w, dtype='int'), [kernel])
+
 
 def get_frequency_map(vis, im: Image = None):
     """ Map channels from visibilities to image
@@ -32,7 +157,8 @@ def get_frequency_map(vis, im: Image = None):
     if im is None:
         spectral_mode = 'channel'
         vfrequencymap = get_rowmap(vis.frequency, ufrequency)
-        assert min(vfrequencymap) >= 0, "Invalid frequency map: visibility channel < 0: %s" % str(vfrequencymap)
+        assert numpy.min(vfrequencymap) >= 0, "Invalid frequency map: visibility channel < 0: %s" % \
+                                              str(vfrequencymap)
     
     elif im.data.shape[0] == 1 and vnchan >= 1:
         spectral_mode = 'mfs'
@@ -45,13 +171,11 @@ def get_frequency_map(vis, im: Image = None):
             v2im_map = im.wcs.sub(['spectral']).wcs_world2pix(ufrequency, 0)[0].astype('int')
         
         spectral_mode = 'channel'
-        nrows = len(vis.frequency)
-        row2vis = numpy.array(get_rowmap(vis.frequency, ufrequency))
-        vfrequencymap = [v2im_map[row2vis[row]] for row in range(nrows)]
+        vfrequencymap = v2im_map[get_rowmap(vis.frequency, ufrequency)]
         
-        assert min(vfrequencymap) >= 0, "Invalid frequency map: image channel < 0 %s" % str(vfrequencymap)
-        assert max(vfrequencymap) < im.shape[0], "Invalid frequency map: image channel > number image channels %s" % \
-                                                 str(vfrequencymap)
+        assert numpy.min(vfrequencymap) >= 0, "Invalid frequency map: image channel < 0 %s" % str(vfrequencymap)
+        assert numpy.max(vfrequencymap) < im.shape[0], \
+            "Invalid frequency map: image channel > number image channels %s" % str(vfrequencymap)
     
     return spectral_mode, vfrequencymap
 
@@ -71,25 +195,29 @@ def get_polarisation_map(vis: Visibility, im: Image = None):
 
 def get_rowmap(col, ucol=None):
     """ Map to unique cols
-    
+
+    Values are matched after rounding to integers. The map is found by a binary search over the sorted unique
+    values, so the cost is small even for many rows.
+
     :param col: Data column
     :param ucol: Unique values in col
+    :return: Index into ucol of each value of col
     """
-    pdict = {}
-    
-    def phash(f):
-        return numpy.round(f).astype('int')
-    
     if ucol is None:
         ucol = numpy.unique(col)
-        
-    for i, f in enumerate(ucol):
-        pdict[phash(f)] = i
-    vmap = []
-    for p in col:
-        vmap.append(pdict[phash(p)])
+    if len(col) == 0:
+        return numpy.zeros([0], dtype='int')
 
-    return vmap
+    ukeys = numpy.round(ucol).astype('int')
+    # Where rounded values coincide, the last one is used
+    keys, last = numpy.unique(ukeys[::-1], return_index=True)
+    index = len(ukeys) - 1 - last
+    colkeys = numpy.round(col).astype('int')
+    pos = numpy.clip(numpy.searchsorted(keys, colkeys), 0, len(keys) - 1)
+    missing = keys[pos] != colkeys
+    if numpy.any(missing):
+        raise KeyError(colkeys[missing][0])
+    return index[pos]
 
 
 def get_uvw_map(vis: Visibility, im: Image, padding=2):
@@ -116,20 +244,48 @@ def get_uvw_map(vis: Visibility, im: Image, padding=2):
     return uvw_mode, shape, padding, vuvwmap
 
 
-def standard_kernel_list(vis: Visibility, shape, oversampling=8, support=3):
+def get_gridding_order(vis: Visibility, shape, vuvwmap, vfrequencymap, tile=32):
+    """ Get the order in which to grid the visibilities, cached on the Visibility
+
+    The permutation from gridding_order is stored in vis.gridding_order together with a digest of the uvw and
+    frequency mappings, so that repeated calls on unchanged uvw (e.g. in successive major cycles) reuse it.
+
+    :param vis: Visibility holding the cache
+    :param shape: Shape of grid [nchan, npol, ny, nx]
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param tile: Size of uv tile (pixels)
+    :return: Permutation of the visibilities
+    """
+    digest = hashlib.sha1(numpy.ascontiguousarray(vuvwmap).tobytes())
+    digest.update(numpy.ascontiguousarray(vfrequencymap, dtype='int').tobytes())
+    key = (tuple(shape), tile, digest.hexdigest())
+    
+    if vis.gridding_order is not None and vis.gridding_order[0] == key:
+        return vis.gridding_order[1]
+    
+    log.debug("get_gridding_order: sorting %d visibilities into %d x %d pixel uv tiles" % (len(vuvwmap), tile, tile))
+    order = gridding_order(shape, vuvwmap, vfrequencymap, tile=tile)
+    vis.gridding_order = (key, order)
+    return order
+
+
+def standard_kernel_list(vis: Visibility, shape, oversampling=8, support=3, dtype='complex'):
     """Return a generator to calculate the standard visibility kernel
 
     :param vis: visibility
     :param shape: tuple with 2D shape of grid
     :param oversampling: Oversampling factor
     :param support: Support of kernel
+    :param dtype: dtype of the kernel
     :return: Function to look up gridding kernel
     """
-    return numpy.zeros_like(vis.w, dtype='int'), [anti_aliasing_calculate(shape, oversampling, support)[1]]
+    return numpy.zeros_like(vis.w, dtype='int'), [get_anti_aliasing(shape, oversampling, support, dtype=dtype)[1]]
 
 
 # noinspection PyTypeChecker
-def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernelwidth=16, **kwargs):
+def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernelwidth=16, cache_dir=None,
+                  dtype='complex', **kwargs):
     """ Calculate w convolution kernels
     
     Uses create_w_term_like to calculate the w screen. This is exactly as wstacking does.
@@ -140,16 +296,22 @@ def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernel
     convolution function for all channels and polarisations. Changing that behaviour would
     require modest changes here and to the gridding/degridding routines.
 
+    The kernels are held in the process-wide kernel_cache, keyed by the image geometry, oversampling,
+    kernelwidth, dtype, w and the create_w_term_like arguments. If cache_dir is given they are also saved there,
+    so that later processes and pipeline runs with the same geometry load them instead of recalculating.
+
     :param im:
     :param kernelwidth:
     :param vis: visibility
     :param oversampling: Oversampling factor
     :param wstep: Step in w between cached functions
+    :param cache_dir: Optional directory in which to persist the kernels
+    :param dtype: dtype of the kernels (calculated in double precision)
     :return: (indices to the w kernel for each row, kernels)
     """
 
     nchan, npol, ny, nx = im.shape
-    gcf, _ = anti_aliasing_calculate((ny, nx))
+    gcf, _ = get_anti_aliasing((ny, nx))
 
     assert oversampling % 2 == 0 or oversampling == 1, "oversampling must be unity or even"
     assert kernelwidth % 2 == 0, "kernelwidth must be even"
@@ -164,28 +326,34 @@ def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernel
     nwsteps = digitise(wmaxabs, wstep) + 1
     w_list = numpy.linspace(-wmaxabs, +wmaxabs, nwsteps)
     
+    # Only the first channel and polarisation of the kernel are used
     wtemplate = copy_image(im)
     
-    wtemplate.data = numpy.zeros(wtemplate.shape, dtype=im.data.dtype)
+    wtemplate.data = numpy.zeros([1, npol, ny, nx], dtype=im.data.dtype)
     
     padded_shape = list(wtemplate.shape)
     padded_shape[3] *= oversampling
     padded_shape[2] *= oversampling
-
-    # For all the unique indices, calculate the corresponding w kernel
-    kernels = list()
-    for w in w_list:
+    
+    def calculate_kernel(w):
         # Make a w screen
         wscreen = create_w_term_like(wtemplate, w, vis.phasecentre, **kwargs)
         wscreen.data /= gcf
         assert numpy.max(numpy.abs(wscreen.data)) > 0.0, 'w screen is empty'
         wscreen_padded = pad_image(wscreen, padded_shape)
-
+        
         wconv = fft_image(wscreen_padded)
-        wconv.data *= float(oversampling)**2
+        wconv.data *= float(oversampling) ** 2
         # For the moment, ignore the polarisation and channel axes
-        kernels.append(convert_image_to_kernel(wconv, oversampling,
-                                               kernelwidth).data[0, 0, ...])
+        return convert_image_to_kernel(wconv, oversampling, kernelwidth).data[0, 0, ...].astype(dtype)
+    
+    geometry = (ny, nx, float(im.wcs.wcs.cdelt[0]), float(im.wcs.wcs.cdelt[1]), float(im.wcs.wcs.crpix[0]),
+                float(im.wcs.wcs.crpix[1]), oversampling, kernelwidth, numpy.dtype(dtype).str,
+                tuple(sorted(kwargs.items())))
+    
+    # For all the unique indices, get the corresponding w kernel
+    kernels = [kernel_cache.get_persistent(('wkernel', geometry, float(w)), cache_dir, calculate_kernel, w)
+               for w in w_list]
     
     # Now make a lookup table from row number of vis to the kernel
     kernel_indices = digitise(vis.w, wstep)
@@ -194,9 +362,178 @@ def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernel
     return kernel_indices, kernels
 
 
+def get_parallactic_angle(vis: Visibility):
+    """ Get the parallactic angle of each row of a visibility
+
+    The hour angle is found from the time (seconds of hour angle, as made by create_visibility). If the
+    configuration has no location, or all of its mounts are equatorial, the beams do not rotate on the sky and the
+    angles are zero.
+
+    :param vis: Visibility
+    :return: parallactic angles (radians) [nvis]
+    """
+    config = vis.configuration
+    if config is None or config.location is None or \
+            all(str(mount).lower().startswith('equat') for mount in numpy.atleast_1d(config.mount)):
+        return numpy.zeros(vis.nvis)
+    ha = vis.time * numpy.pi / 43200.0
+    return parallactic_angle(ha, vis.phasecentre.dec.rad, config.location.lat.rad)
+
+
+def rotate_beam(beam, angle, cx, cy, niter=16):
+    """ Rotate a beam pattern anticlockwise (in pixel coordinates) about a pixel, by linear interpolation
+
+    Near the corners the rotated position of a pixel can fall outside the beam. There the beam is sampled instead
+    at the position rotated by the largest smaller angle that stays inside, found by bisection. That position is at
+    the same distance from the centre, so this is exact for a circularly symmetric beam and keeps the rotated beam
+    continuous.
+
+    :param beam: beam [ny, nx]
+    :param angle: Angle of rotation (radians)
+    :param cx: x pixel of centre of rotation
+    :param cy: y pixel of centre of rotation
+    :param niter: Number of bisection steps for pixels rotated outside the beam
+    :return: rotated beam [ny, nx]
+    """
+    if angle == 0.0:
+        return beam
+    ny, nx = beam.shape
+    yy, xx = numpy.meshgrid(numpy.arange(ny) - cy, numpy.arange(nx) - cx, indexing='ij')
+    
+    # Sample the beam at the positions rotated back by angle
+    def position(a):
+        c, s = numpy.cos(a), numpy.sin(a)
+        return cy + c * yy - s * xx, cx + s * yy + c * xx
+    
+    def inside(y, x):
+        return (y >= 0.0) & (y <= ny - 1.0) & (x >= 0.0) & (x <= nx - 1.0)
+    
+    low = inside(*position(angle)).astype('float')
+    high = numpy.ones_like(low)
+    for _ in range(niter):
+        mid = 0.5 * (low + high)
+        ok = inside(*position(mid * angle))
+        low, high = numpy.where(ok, mid, low), numpy.where(ok, high, mid)
+    return map_coordinates(beam, position(low * angle), order=1, mode='nearest')
+
+
+def extend_beam(beam, ny, nx):
+    """ Continue a beam pattern from the unpadded image over the padded field, tapering it smoothly to zero
+
+    Zero padding a beam that is not zero at the edge of the image makes a step, whose transform is much wider than
+    an A-projection kernel. Instead the beam is continued outwards from the edge of the image and multiplied by a
+    taper that falls as cos^2 from one at the edge of the image to zero at the edge of the padded field. Inside the
+    image the beam is unchanged.
+
+    :param beam: beam [ny0, nx0] on the unpadded image
+    :param ny: Number of rows of the padded field
+    :param nx: Number of columns of the padded field
+    :return: beam [ny, nx], with the unpadded image placed as by pad_image
+    """
+    by, bx = beam.shape
+    ystart, xstart = ny // 2 - by // 2, nx // 2 - bx // 2
+    extended = numpy.pad(beam, [(ystart, ny - by - ystart), (xstart, nx - bx - xstart)], mode='edge')
+    
+    def taper(n, start, length):
+        i = numpy.arange(n)
+        outside = numpy.maximum(start - i, i - (start + length - 1)).clip(0, None)
+        margin = numpy.where(i < start, start, n - start - length).clip(1, None)
+        return numpy.cos(0.5 * numpy.pi * outside / margin) ** 2
+    
+    return extended * numpy.outer(taper(ny, ystart, by), taper(nx, xstart, bx))
+
+
+# noinspection PyTypeChecker
+def a_kernel_list(vis: Visibility, im: Image, pb: Image, oversampling=1, wstep=0.0, pastep=numpy.pi / 36.0,
+                  kernelwidth=16, cache_dir=None, dtype='complex', **kwargs):
+    """ Calculate A-projection convolution kernels from a primary beam model, optionally including the w term
+
+    Each kernel is the transform of the primary beam (rotated by the parallactic angle) times the w screen, divided
+    by the grid correction function, so that degridding a model image gives the visibilities of the model
+    multiplied by the beam, and gridding gives the dirty image multiplied by the beam. All the stations are taken
+    to have the same beam, given as the power pattern pb (e.g. from create_pb) on the unpadded image grid.
+
+    A kernel is made for each beam channel (the channel of pb that each row maps to), parallactic angle bin (of
+    width pastep radians, none if pastep is zero) and w bin (of width wstep, none if wstep is zero) that has rows.
+    The kernels are held in the process-wide kernel_cache, and also in cache_dir if it is given, as for
+    w_kernel_list.
+
+    :param vis: visibility
+    :param im: padded image template
+    :param pb: primary beam image [nchan, npol, ny, nx], of which the first polarisation is used
+    :param oversampling: Oversampling factor
+    :param wstep: Step in w between kernels
+    :param pastep: Step in parallactic angle between kernels (radians)
+    :param kernelwidth: Width of kernels
+    :param cache_dir: Optional directory in which to persist the kernels
+    :param dtype: dtype of the kernels (calculated in double precision)
+    :return: (indices to the kernel for each row, kernels)
+    """
+    nchan, npol, ny, nx = im.shape
+    gcf, _ = get_anti_aliasing((ny, nx))
+    
+    assert oversampling % 2 == 0 or oversampling == 1, "oversampling must be unity or even"
+    assert kernelwidth % 2 == 0, "kernelwidth must be even"
+    
+    pbdata = numpy.real(pb.data[:, 0, ...])
+    _, vpbchan = get_frequency_map(vis, pb)
+    
+    pa = get_parallactic_angle(vis)
+    if pastep > 0.0:
+        pabin = numpy.round(pa / pastep).astype('int')
+    else:
+        pabin = numpy.zeros(vis.nvis, dtype='int')
+    
+    wmaxabs = numpy.max(numpy.abs(vis.w))
+    if wstep > 0.0 and wmaxabs > 0.0:
+        wbin = numpy.round((vis.w + wmaxabs) / wstep).astype('int')
+    else:
+        wstep = 0.0
+        wbin = numpy.zeros(vis.nvis, dtype='int')
+    
+    # Find all the unique bins for which we need a kernel
+    bins, kernel_indices = numpy.unique(numpy.stack([numpy.array(vpbchan, dtype='int'), pabin, wbin], axis=1),
+                                        axis=0, return_inverse=True)
+    log.debug("a_kernel_list: %d kernels for %d beam channels, %d parallactic angle bins and %d w bins" %
+              (len(bins), len(numpy.unique(bins[:, 0])), len(numpy.unique(bins[:, 1])), len(numpy.unique(bins[:, 2]))))
+    
+    # Only the first channel and polarisation of the kernel are used
+    wtemplate = copy_image(im)
+    wtemplate.data = numpy.zeros([1, npol, ny, nx], dtype=im.data.dtype)
+    padded_shape = [1, npol, ny * oversampling, nx * oversampling]
+    cx, cy = pb.wcs.wcs.crpix[0] - 1.0, pb.wcs.wcs.crpix[1] - 1.0
+    
+    def calculate_kernel(chan, angle, w):
+        screen = create_w_term_like(wtemplate, w, vis.phasecentre, **kwargs)
+        screen.data *= extend_beam(rotate_beam(pbdata[chan], angle, cx, cy), ny, nx) / gcf
+        assert numpy.max(numpy.abs(screen.data)) > 0.0, 'A screen is empty'
+        aconv = fft_image(pad_image(screen, padded_shape))
+        aconv.data *= float(oversampling) ** 2
+        return convert_image_to_kernel(aconv, oversampling, kernelwidth).data[0, 0, ...].astype(dtype)
+    
+    pbdigest = hashlib.sha1(numpy.ascontiguousarray(pb.data).tobytes()).hexdigest()
+    geometry = (ny, nx, float(im.wcs.wcs.cdelt[0]), float(im.wcs.wcs.cdelt[1]), float(im.wcs.wcs.crpix[0]),
+                float(im.wcs.wcs.crpix[1]), oversampling, kernelwidth, numpy.dtype(dtype).str, pbdigest,
+                tuple(sorted(kwargs.items())))
+    
+    kernels = []
+    for chan, ipa, iw in bins:
+        angle = float(ipa * pastep)
+        w = float(iw * wstep - wmaxabs) if wstep > 0.0 else 0.0
+        kernels.append(kernel_cache.get_persistent(('akernel', geometry, int(chan), angle, w), cache_dir,
+                                                   calculate_kernel, chan, angle, w))
+    return kernel_indices, kernels
+
+
 def get_kernel_list(vis: Visibility, im: Image, **kwargs):
     """Get the list of kernels, one per visibility
     
+    With kernel='es' the exponential of semicircle kernel is used, with parameters set by the target accuracy
+    epsilon (see es_kernel_list).
+
+    With kernel='aprojection' the kernels are made from the primary beam image pb (see a_kernel_list), binned in
+    parallactic angle by pastep (default 5 degrees) and, if wstep is given, in w. The default kernelwidth is 16
+    plus the width of the w kernel.
     """
     
     shape = im.data.shape
@@ -205,12 +542,37 @@ def get_kernel_list(vis: Visibility, im: Image, **kwargs):
     
     wstep = get_parameter(kwargs, "wstep", 0.0)
     oversampling = get_parameter(kwargs, "oversampling", 8)
-    padding = get_parameter(kwargs, "padding", 2)
+    padding = get_padding(vis, im, **kwargs)
+    
+    _, dtype = get_precision_dtypes(kwargs)
+    
+    if get_parameter(kwargs, "kernel", "2d") == 'es':
+        gcf, kernel_list = es_kernel_list(vis, im, epsilon=get_parameter(kwargs, "epsilon", 1e-6), padding=padding,
+                                          oversampling=get_parameter(kwargs, "oversampling", None),
+                                          max_table_bytes=get_parameter(kwargs, "max_table_bytes", 2 ** 26),
+                                          dtype=dtype)
+        return 'es', gcf, kernel_list
     
-    gcf, _ = anti_aliasing_calculate((padding * npixel, padding * npixel), oversampling)
+    npad = int(round(padding * npixel))
+    gcf, _ = get_anti_aliasing((npad, npad), oversampling, dtype=dtype)
     
     wabsmax = numpy.max(numpy.abs(vis.w))
-    if wstep > 0.0 and wabsmax > 0.0:
+    if get_parameter(kwargs, "kernel", "2d") == 'aprojection':
+        kernelname = 'aprojection'
+        pb = get_parameter(kwargs, "pb", None)
+        assert pb is not None, "A-projection needs the primary beam pb"
+        fov = cellsize * npixel * padding
+        wkernelwidth = 2 * int(round(numpy.sin(0.5 * fov) * npixel * wabsmax * cellsize)) if wstep > 0.0 else 0
+        kernelwidth = get_parameter(kwargs, "kernelwidth", 16 + wkernelwidth)
+        assert kernelwidth % 2 == 0
+        log.debug("get_kernel_list: Using A-projection with kernel full width = %d pixels" % kernelwidth)
+        padded_shape = [im.shape[0], im.shape[1], int(round(im.shape[2] * padding)), npad]
+        kernel_list = a_kernel_list(vis, pad_image(im, padded_shape), pb, oversampling=oversampling, wstep=wstep,
+                                    pastep=get_parameter(kwargs, "pastep", numpy.pi / 36.0),
+                                    kernelwidth=kernelwidth,
+                                    cache_dir=get_parameter(kwargs, "wkernel_cache_dir", None), dtype=dtype,
+                                    remove_shift=get_parameter(kwargs, "remove_shift", True))
+    elif wstep > 0.0 and wabsmax > 0.0:
         kernelname = 'wprojection'
         # wprojection needs a lot of commentary!
         log.debug("get_kernel_list: Using w projection with wstep = %f" % wstep)
@@ -227,15 +589,16 @@ def get_kernel_list(vis: Visibility, im: Image, **kwargs):
         kernelwidth = max(kernelwidth, 8)
         assert kernelwidth % 2 == 0
         log.debug("get_kernel_list: Maximum w kernel full width = %d pixels" % kernelwidth)
-        padded_shape = [im.shape[0], im.shape[1], im.shape[2] * padding, im.shape[3] * padding]
+        padded_shape = [im.shape[0], im.shape[1], int(round(im.shape[2] * padding)), npad]
 
         remove_shift = get_parameter(kwargs, "remove_shift", True)
         padded_image = pad_image(im, padded_shape)
+        wkernel_cache_dir = get_parameter(kwargs, "wkernel_cache_dir", None)
         kernel_list = w_kernel_list(vis, padded_image, oversampling=oversampling, wstep=wstep,
-                                    kernelwidth=kernelwidth, remove_shift=remove_shift)
+                                    kernelwidth=kernelwidth, cache_dir=wkernel_cache_dir, dtype=dtype,
+                                    remove_shift=remove_shift)
     else:
         kernelname = '2d'
-        kernel_list = standard_kernel_list(vis, (padding * npixel, padding * npixel),
-                                           oversampling=oversampling)
+        kernel_list = standard_kernel_list(vis, (npad, npad), oversampling=oversampling, dtype=dtype)
     
     return kernelname, gcf, kernel_list
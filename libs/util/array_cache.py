@@ -0,0 +1,177 @@
+"""Least recently used cache of numpy arrays with a memory cap.
+
+Used to share expensive, read-only arrays such as convolution kernels between the many calls made by one process
+(e.g. one Dask worker). The cached arrays are made read-only so that a caller cannot change the copy seen by others.
+Single arrays can also be persisted to a directory of .npy files so that they survive between processes and runs.
+
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+import numpy
+
+log = logging.getLogger(__name__)
+
+
+def _nbytes(value):
+    """ Total size of the numpy arrays in a value that may be nested in tuples and lists
+    """
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    elif isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    return 0
+
+
+def _freeze(value):
+    """ Make all numpy arrays in a value read-only
+    """
+    if isinstance(value, numpy.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, (tuple, list)):
+        for v in value:
+            _freeze(v)
+    return value
+
+
+class ArrayCache:
+    """ Least recently used cache of arrays with a cap on the total memory held
+
+    For example::
+
+        cache = ArrayCache(max_bytes=2 ** 30)
+        gcf, kernel = cache.get(('anti_aliasing', shape, oversampling), anti_aliasing_calculate, shape, oversampling)
+    """
+
+    def __init__(self, max_bytes=2 ** 30, name='ArrayCache'):
+        """ Create an empty cache
+
+        :param max_bytes: Maximum total size of the cached arrays (bytes)
+        :param name: Name used in log messages
+        """
+        self.max_bytes = max_bytes
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, compute, *args, **kwargs):
+        """ Return the value for key, calling compute(*args, **kwargs) to make it if it is not cached
+
+        :param key: Hashable key
+        :param compute: Function to calculate the value
+        :return: value (numpy arrays in it are read-only)
+        """
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            self.misses += 1
+
+        value = _freeze(compute(*args, **kwargs))
+        self.put(key, value)
+        return value
+
+    def get_persistent(self, key, directory, compute, *args, **kwargs):
+        """ As get, but for a single array that is also looked for in and saved to directory
+
+        The file name is a digest of repr(key), so the key should be made of strings, numbers and tuples. Files
+        are written atomically so that several processes can share the directory. If directory is None this is
+        the same as get.
+
+        :param key: Hashable key
+        :param directory: Directory of .npy files, created if necessary
+        :param compute: Function to calculate the array
+        :return: read-only array
+        """
+        if directory is None:
+            return self.get(key, compute, *args, **kwargs)
+        
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            self.misses += 1
+        
+        filename = os.path.join(directory, "%s.npy" % hashlib.sha1(repr(key).encode()).hexdigest())
+        if os.path.exists(filename):
+            log.debug("%s: loading %s from %s" % (self.name, str(key), filename))
+            value = numpy.load(filename)
+        else:
+            value = compute(*args, **kwargs)
+            os.makedirs(directory, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=directory, suffix='.npy.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                numpy.save(f, value)
+            os.replace(tmpname, filename)
+        
+        value = _freeze(value)
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        """ Add a value to the cache, removing the least recently used entries to stay within max_bytes
+
+        Values larger than max_bytes are not cached.
+
+        :param key: Hashable key
+        :param value: numpy array or tuple/list of them
+        """
+        size = _nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                log.debug("%s: not caching %s of %d bytes" % (self.name, str(key), size))
+                return
+            self._evict(self.max_bytes - size)
+            self._entries[key] = (value, size)
+            self.nbytes += size
+
+    def resize(self, max_bytes):
+        """ Change the memory cap, removing the least recently used entries to stay within it
+
+        :param max_bytes: Maximum total size of the cached arrays (bytes)
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict(max_bytes)
+
+    def _evict(self, limit):
+        """ Remove least recently used entries until at most limit bytes are held. Call with the lock held.
+        """
+        while self._entries and self.nbytes > limit:
+            _, (_, oldsize) = self._entries.popitem(last=False)
+            self.nbytes -= oldsize
+
+    def clear(self):
+        """ Remove all entries and reset the counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """ Return a dictionary of the cache statistics
+
+        :return: dict with hits, misses, entries, nbytes, max_bytes
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes}
@@ -1,19 +1,19 @@
 """Useful array functions.
 
 """
-# import numba
 import numpy
 
+from libs.util.numba_support import jit
 
-# @numba.jit([numba.types.Tuple((numba.float64[:], numba.float64[:]))
-#                 (numba.float64[:], numba.float64[:], numba.int64)], nopython=True)
+
+@jit(nopython=True, cache=True)
 def average_chunks_jit(arr, wts, chunksize):
     """ Average the array arr with weights by chunks
 
     Array len does not have to be multiple of chunksize
     
-    This is a version written for numba. When used with numba.jit, it's about 25 - 30% faster than the
-    numpy version without jit.
+    This is a version written for numba. When numba is available it is compiled, and is then about 25 - 30%
+    faster than the numpy version. Otherwise it runs as plain python.
     
     :param arr: 1D array of values
     :param wts: 1D array of weights
@@ -0,0 +1,174 @@
+"""Pool of reusable work arrays, keyed by shape and dtype.
+
+The padded grids and images made by each invert and predict are hundreds of MB for large images. Loops such as the
+major cycles of solve_image and ical make the same sized arrays again and again, so instead of allocating (and page
+faulting) them each time, the imaging functions take them from a process-wide pool and give them back when done.
+
+A buffer taken from the pool belongs to the caller until it is released, and must not be used after that. Buffers
+are never handed out to user code, only used inside a function.
+
+"""
+
+import collections
+import contextlib
+import logging
+import threading
+
+import numpy
+
+log = logging.getLogger(__name__)
+
+
+class BufferPool:
+    """ Pool of work arrays with a cap on the total memory held while not in use
+
+    For example::
+
+        grid = buffer_pool.get([nchan, npol, ny, nx], 'complex', zero=True)
+        ...
+        buffer_pool.release(grid)
+
+    or, with the release done automatically::
+
+        with buffer_pool.borrow([nchan, npol, ny, nx], 'complex', zero=True) as grid:
+            ...
+    """
+
+    def __init__(self, max_bytes=2 ** 30, name='BufferPool'):
+        """ Create an empty pool
+
+        :param max_bytes: Maximum total size of the free arrays held (bytes)
+        :param name: Name used in log messages
+        """
+        self.max_bytes = max_bytes
+        self.name = name
+        self.nbytes = 0
+        self._free = collections.OrderedDict()
+        # Arrays in use by id, holding a reference so that the id is not reused by another array until release
+        self._in_use = {}
+        self._lock = threading.Lock()
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self.reuses = 0
+        self.allocations = 0
+        self.allocated_bytes = 0
+        self.in_use_bytes = 0
+        self.peak_bytes = 0
+
+    def get(self, shape, dtype='complex', zero=False):
+        """ Take an array from the pool, allocating it if there is no free array of that shape and dtype
+
+        :param shape: Shape of array
+        :param dtype: dtype of array
+        :param zero: Set the array to zero (otherwise its contents are undefined)
+        :return: array, to be given back with release
+        """
+        key = (tuple(int(n) for n in shape), numpy.dtype(dtype).str)
+        with self._lock:
+            buffers = self._free.get(key)
+            if buffers:
+                a = buffers.pop()
+                if not buffers:
+                    del self._free[key]
+                self.nbytes -= a.nbytes
+                self.reuses += 1
+            else:
+                a = None
+        if a is None:
+            a = numpy.empty(key[0], dtype=key[1])
+            with self._lock:
+                self.allocations += 1
+                self.allocated_bytes += a.nbytes
+        with self._lock:
+            self._in_use[id(a)] = a
+            self.in_use_bytes += a.nbytes
+            self.peak_bytes = max(self.peak_bytes, self.in_use_bytes + self.nbytes)
+        if zero:
+            a.fill(0)
+        return a
+
+    def release(self, a):
+        """ Give an array taken by get back to the pool
+
+        The least recently released arrays are discarded to keep the free arrays within max_bytes. Arrays that did
+        not come from get are ignored.
+
+        :param a: array
+        """
+        with self._lock:
+            if self._in_use.get(id(a)) is not a:
+                log.debug("%s: ignoring release of an array not taken from the pool" % self.name)
+                return
+            del self._in_use[id(a)]
+            self.in_use_bytes -= a.nbytes
+            if a.nbytes > self.max_bytes:
+                return
+            key = (a.shape, a.dtype.str)
+            self._free.setdefault(key, []).append(a)
+            self._free.move_to_end(key)
+            self.nbytes += a.nbytes
+            self._evict(self.max_bytes)
+
+    @contextlib.contextmanager
+    def borrow(self, shape, dtype='complex', zero=False):
+        """ Context manager taking an array from the pool and releasing it at the end of the block
+
+        :param shape: Shape of array
+        :param dtype: dtype of array
+        :param zero: Set the array to zero
+        """
+        a = self.get(shape, dtype, zero)
+        try:
+            yield a
+        finally:
+            self.release(a)
+
+    def resize(self, max_bytes):
+        """ Change the memory cap, discarding free arrays to stay within it
+
+        :param max_bytes: Maximum total size of the free arrays held (bytes), 0 to hold none
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict(max_bytes)
+
+    def _evict(self, limit):
+        """ Discard the least recently released arrays until at most limit bytes are held. Call with the lock held.
+        """
+        while self._free and self.nbytes > limit:
+            key, buffers = next(iter(self._free.items()))
+            self.nbytes -= buffers.pop(0).nbytes
+            if not buffers:
+                del self._free[key]
+
+    def clear(self):
+        """ Discard all free arrays and reset the counters
+        """
+        with self._lock:
+            self._free.clear()
+            self.nbytes = 0
+            self._reset_counters()
+            self.in_use_bytes = sum(a.nbytes for a in self._in_use.values())
+
+    def stats(self):
+        """ Return a dictionary of the pool statistics
+
+        :return: dict with reuses, allocations, allocated_bytes (total allocated), peak_bytes (peak held in use and
+            free), in_use_bytes, nbytes (held free), max_bytes
+        """
+        return {'reuses': self.reuses, 'allocations': self.allocations, 'allocated_bytes': self.allocated_bytes,
+                'peak_bytes': self.peak_bytes, 'in_use_bytes': self.in_use_bytes, 'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes}
+
+
+# Process-wide pool of work arrays, shared by all imaging calls in e.g. a Dask worker
+buffer_pool = BufferPool(max_bytes=2 ** 30, name='buffer_pool')
+
+
+def set_buffer_pool_size(max_bytes):
+    """ Set the memory cap of the process-wide buffer pool, discarding free arrays as needed
+
+    :param max_bytes: Maximum total size of free arrays held between calls (bytes), 0 to hold none
+    """
+    buffer_pool.resize(max_bytes)
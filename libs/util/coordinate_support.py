@@ -56,6 +56,19 @@ def xyz_at_latitude(local_xyz, lat):
     return numpy.hstack([x, y2, z2])
 
 
+def parallactic_angle(ha, dec, lat):
+    """
+    Calculate the parallactic angle of a direction, the angle at the source between the directions to the
+    celestial pole and to the zenith. It is positive west of the meridian.
+
+    :param ha: Hour angle (radians)
+    :param dec: Declination (radians)
+    :param lat: Latitude of the observatory (radians)
+    :return: Parallactic angle (radians)
+    """
+    return numpy.arctan2(numpy.sin(ha), numpy.tan(lat) * numpy.cos(dec) - numpy.sin(dec) * numpy.cos(ha))
+
+
 def xyz_to_uvw(xyz, ha, dec):
     """
     Rotate :math:`(x,y,z)` positions in earth coordinates to
@@ -0,0 +1,45 @@
+"""Optional support for numba.
+
+numba is not a requirement of ARL. If it can be imported, functions decorated with :py:func:`jit` are compiled by
+numba. Otherwise they are left as plain python, and callers can test numba_available to choose a numpy code path
+instead.
+
+"""
+
+import logging
+
+try:
+    import numba
+    numba_available = True
+except ImportError:
+    numba = None
+    numba_available = False
+
+log = logging.getLogger(__name__)
+
+_warned = set()
+
+
+def jit(*args, **kwargs):
+    """ Apply numba.jit if numba is available, otherwise leave the function unchanged
+
+    Can be used as @jit or with arguments e.g. @jit(nopython=True, cache=True)
+
+    :return: decorated function
+    """
+    if numba_available:
+        return numba.jit(*args, **kwargs)
+    if len(args) == 1 and callable(args[0]) and not kwargs:
+        return args[0]
+    return lambda func: func
+
+
+def warn_numba_unavailable(name, fallback):
+    """ Log (once per name) that numba is not available and a fallback is being used
+
+    :param name: Name of the function requesting numba
+    :param fallback: Name of the function used instead
+    """
+    if name not in _warned:
+        _warned.add(name)
+        log.warning("%s: numba is not available, using %s instead" % (name, fallback))
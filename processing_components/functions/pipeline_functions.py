@@ -14,7 +14,8 @@ from ..calibration.calibration import solve_gaintable
 from ..calibration.calibration_control import calibrate_function, create_calibration_controls
 from ..image.deconvolution import deconvolve_cube, restore_cube
 from ..imaging.base import predict_skycomponent_visibility
-from ..imaging.imaging_functions import predict_function, invert_function
+from ..imaging.imaging_functions import predict_function, invert_function, invert_dirty_psf_function, \
+    residual_function
 from ..visibility.base import copy_visibility
 from ..visibility.coalesce import convert_blockvisibility_to_visibility
 
@@ -56,24 +57,25 @@ def ical(block_vis: BlockVisibility, model: Image, components=None, context='2d'
         vis, gaintables = calibrate_function(vis, vispred, 'TGB', controls, iteration=-1)
     
     visres.data['vis'] = vis.data['vis'] - vispred.data['vis']
-    dirty, sumwt = invert_function(visres, model, context=context, **kwargs)
+    (dirty, sumwt), (psf, _) = invert_dirty_psf_function(visres, model, context=context, **kwargs)
     log.info("Maximum in residual image is %.6f" % (numpy.max(numpy.abs(dirty.data))))
     
-    psf, sumwt = invert_function(visres, model, dopsf=True, context=context, **kwargs)
-    
     thresh = get_parameter(kwargs, "threshold", 0.0)
     
     for i in range(nmajor):
         log.info("ical: Start of major cycle %d of %d" % (i, nmajor))
         cc, res = deconvolve_cube(dirty, psf, **kwargs)
         model.data += cc.data
-        vispred.data['vis'][...] = 0.0
-        vispred = predict_function(vispred, model, context=context, **kwargs)
         if do_selfcal:
+            vispred.data['vis'][...] = 0.0
+            vispred = predict_function(vispred, model, context=context, **kwargs)
             vis, gaintables = calibrate_function(vis, vispred, 'TGB', controls, iteration=i)
-        visres.data['vis'] = vis.data['vis'] - vispred.data['vis']
+            visres.data['vis'] = vis.data['vis'] - vispred.data['vis']
+            dirty, sumwt = invert_function(visres, model, context=context, **kwargs)
+        else:
+            # Without selfcal the model visibility is not needed, so predict, subtract and invert in one pass
+            visres, dirty, sumwt = residual_function(vis, model, context=context, residual=visres, **kwargs)
         
-        dirty, sumwt = invert_function(visres, model, context=context, **kwargs)
         log.info("Maximum in residual image is %s" % (numpy.max(numpy.abs(dirty.data))))
         if numpy.abs(dirty.data).max() < 1.1 * thresh:
             log.info("ical: Reached stopping threshold %.6f Jy" % thresh)
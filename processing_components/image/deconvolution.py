@@ -30,7 +30,7 @@ from astropy.convolution import Gaussian2DKernel, convolve
 from photutils import fit_2dgaussian
 
 from data_models.memory_data_models import Image
-from data_models.parameters import get_parameter
+from data_models.parameters import get_parameter, get_precision_dtypes
 from libs.image.cleaners import hogbom, msclean, msmfsclean
 from libs.image.operations import create_image_from_array, copy_image
 from ..image.operations import calculate_image_frequency_moments, calculate_image_from_frequency_moments
@@ -69,6 +69,7 @@ def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Im
     :param scales: Scales (in pixels) for multiscale ([0, 3, 10, 30])
     :param nmoments: Number of frequency moments (default 3)
     :param findpeak: Method of finding peak in mfsclean: 'Algorithm1'|'ASKAPSoft'|'CASA'|'ARL', Default is ARL.
+    :param precision: 'double' or 'single': dtype of the hogbom and msclean work arrays and results ('double')
     :return: componentimage, residual
     
     """
@@ -76,6 +77,12 @@ def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Im
     assert isinstance(dirty, Image), dirty
     assert isinstance(psf, Image), psf
     
+    real_dtype, _ = get_precision_dtypes(kwargs)
+    if dirty.data.dtype != real_dtype:
+        dirty = create_image_from_array(dirty.data.astype(real_dtype), dirty.wcs, dirty.polarisation_frame)
+    if psf.data.dtype != real_dtype:
+        psf = create_image_from_array(psf.data.astype(real_dtype), psf.wcs, psf.polarisation_frame)
+    
     window_shape = get_parameter(kwargs, 'window_shape', None)
     if window_shape == 'quarter':
         qx = dirty.shape[3] // 4
@@ -204,8 +211,8 @@ def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Im
         fracthresh = get_parameter(kwargs, 'fractional_threshold', 0.1)
         assert 0.0 < fracthresh < 1.0
         
-        comp_array = numpy.zeros(dirty.data.shape)
-        residual_array = numpy.zeros(dirty.data.shape)
+        comp_array = numpy.zeros_like(dirty.data)
+        residual_array = numpy.zeros_like(dirty.data)
         for channel in range(dirty.data.shape[0]):
             for pol in range(dirty.data.shape[1]):
                 if psf.data[channel, pol, :, :].max():
@@ -11,7 +11,7 @@ from data_models.parameters import get_parameter
 from ..image.deconvolution import deconvolve_cube
 from ..visibility.base import copy_visibility
 from ..imaging.base import predict_skycomponent_visibility
-from ..imaging.imaging_functions import predict_function, invert_function
+from ..imaging.imaging_functions import predict_function, invert_dirty_psf_function, residual_function
 
 import logging
 
@@ -47,19 +47,16 @@ def solve_image(vis: Visibility, model: Image, components=None, context='2d', **
         vispred = predict_skycomponent_visibility(vispred, components)
     
     visres.data['vis'] = vis.data['vis'] - vispred.data['vis']
-    dirty, sumwt = invert_function(visres, model, context=context, dopsf=False, **kwargs)
-    assert sumwt.any() > 0.0, "Sum of weights is zero"
-    psf, sumwt = invert_function(visres, model, context=context, dopsf=True, **kwargs)
+    # Make the dirty image and PSF in one pass over the data where the context allows
+    (dirty, sumwt), (psf, _) = invert_dirty_psf_function(visres, model, context=context, **kwargs)
     assert sumwt.any() > 0.0, "Sum of weights is zero"
     
     for i in range(nmajor):
         log.info("solve_image: Start of major cycle %d" % i)
         cc, res = deconvolve_cube(dirty, psf, **kwargs)
         model.data += cc.data
-        vispred.data['vis'][...]=0.0
-        vispred = predict_function(vispred, model, context=context, **kwargs)
-        visres.data['vis'] = vis.data['vis'] - vispred.data['vis']
-        dirty, sumwt = invert_function(visres, model, context=context, dopsf=False, **kwargs)
+        # Predict, subtract and invert in one pass where the context allows, reusing the residual visibility
+        visres, dirty, sumwt = residual_function(vis, model, context=context, residual=visres, **kwargs)
         if numpy.abs(dirty.data).max() < 1.1 * thresh:
             log.info("Reached stopping threshold %.6f Jy" % thresh)
             break
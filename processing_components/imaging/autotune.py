@@ -0,0 +1,296 @@
+"""Automatic choice of the imaging context and its parameters.
+
+The fastest way to image an observation to a given accuracy depends on the field of view, the range of w and the
+amount of data, and on the relative cost of gridding, FFTs and w corrections on the machine used. advise_wide_field
+gives the theoretical sampling, but not which strategy is fastest. autotune_imaging measures this instead: it
+predicts unit point sources near the corners of the image from a subsample of the visibility rows with each
+candidate set of parameters, and compares with the direct Fourier transform to find the error. The candidates that
+are accurate enough are then timed (predict and invert) on subsamples of two sizes, and the time for all the rows is
+extrapolated from these.
+
+The search is in two stages. The gridding kernel and padding are chosen first, with w set to zero so that only the
+gridding error is seen. The w correction (none, w stacking, time slices, facets or w projection) is then chosen with
+that kernel, using for each strategy the smallest number of slices, facets or w kernels that meets the error budget.
+
+For example::
+
+    params = autotune_imaging(vis, model, max_error=1e-3)
+    dirty, sumwt = invert_function(vis, model, **params)
+    vis = predict_function(vis, model, **params)
+    residual_imagelist = residual_workflow(vis_list, model_imagelist, **params)
+
+"""
+
+import logging
+import time
+import tracemalloc
+
+import numpy
+from astropy.wcs.utils import pixel_to_skycoord
+
+from data_models.memory_data_models import Visibility, Image
+
+from libs.imaging.imaging_params import get_padding
+from libs.util.buffer_pool import buffer_pool
+
+from ..image.operations import create_empty_image_like
+from ..imaging.base import predict_skycomponent_visibility
+from ..imaging.imaging_functions import invert_function, predict_function
+from ..skycomponent.operations import create_skycomponent
+from ..visibility.base import copy_visibility, create_visibility_from_rows
+from ..visibility.coalesce import convert_blockvisibility_to_visibility
+
+log = logging.getLogger(__name__)
+
+
+def autotune_strategies():
+    """ The w correction strategies tried by autotune_imaging
+
+    :return: list of names
+    """
+    return ['2d', 'wstack', 'wstack_multi', 'timeslice', 'facets', 'wprojection']
+
+
+def create_autotune_model(im: Image, offset=0.4):
+    """ Make a model of unit point sources near the corners of an image, on pixel centres
+
+    The sources are offset from the centre by offset times the image size on each axis, where the w and aliasing
+    errors are large. The flux is in the first polarisation only.
+
+    :param im: Image template
+    :param offset: Offset of the sources from the centre, as a fraction of the image size
+    :return: model image, list of the Skycomponents
+    """
+    model = create_empty_image_like(im)
+    nchan, npol, ny, nx = im.shape
+    dx, dy = int(offset * nx), int(offset * ny)
+    flux = numpy.zeros([nchan, npol])
+    flux[:, 0] = 1.0
+    components = list()
+    for x, y in [(nx // 2 + dx, ny // 2 + dy), (nx // 2 - dx, ny // 2 + dy), (nx // 2 + dx, ny // 2 - dy),
+                 (nx // 2 - dx, ny // 2 - dy)]:
+        model.data[:, 0, y, x] = 1.0
+        components.append(create_skycomponent(direction=pixel_to_skycoord(x, y, im.wcs, origin=0), flux=flux,
+                                              frequency=im.frequency, polarisation_frame=im.polarisation_frame))
+    return model, components
+
+
+def autotune_benchmark(vis: Visibility, im: Image, params, nrows=4096, measure_memory=False, seed=1234567,
+                       **kwargs):
+    """ Time invert_function and predict_function for one set of parameters, extrapolating to all the rows
+
+    The time (and, if measure_memory is True, the peak memory traced by tracemalloc) is measured for subsamples of
+    nrows // 2 and nrows rows, after a first call to fill the caches, and is extrapolated linearly to vis.nvis rows.
+
+    :param vis: Visibility
+    :param im: Image template
+    :param params: Imaging parameters e.g. {'context': 'wstack', 'vis_slices': 8}
+    :param nrows: Number of rows in the larger subsample
+    :param measure_memory: Measure the peak memory as well as the time
+    :param seed: Seed for choosing the subsample
+    :param kwargs: Other imaging parameters
+    :return: estimated time (s), estimated peak memory (bytes, None if not measured)
+    """
+    model, _ = create_autotune_model(im)
+    sizes = [max(1, min(nrows, vis.nvis) // 2), min(nrows, vis.nvis)]
+    subvis = [autotune_subsample(vis, n, seed=seed) for n in sizes]
+
+    def run(svis):
+        pvis = predict_function(copy_visibility(svis, zero=True), model, **dict(kwargs, **params))
+        invert_function(pvis, im, **dict(kwargs, **params))
+
+    run(subvis[-1])
+    times = list()
+    for svis in subvis:
+        start = time.time()
+        run(svis)
+        times.append(time.time() - start)
+    estimated_time = _extrapolate(sizes, times, vis.nvis)
+
+    estimated_memory = None
+    if measure_memory:
+        if tracemalloc.is_tracing():
+            log.warning("autotune_benchmark: tracemalloc is already in use, memory not measured")
+        else:
+            # Empty the buffer pool so that the grids are allocated, and so traced
+            max_bytes = buffer_pool.max_bytes
+            peaks = list()
+            for svis in subvis:
+                buffer_pool.resize(0)
+                buffer_pool.resize(max_bytes)
+                tracemalloc.start()
+                try:
+                    run(svis)
+                    peaks.append(tracemalloc.get_traced_memory()[1])
+                finally:
+                    tracemalloc.stop()
+            estimated_memory = _extrapolate(sizes, peaks, vis.nvis)
+
+    return estimated_time, estimated_memory
+
+
+def autotune_error(vis: Visibility, im: Image, params, nrows=4096, seed=1234567, **kwargs):
+    """ Find the error of predict_function for one set of parameters
+
+    The unit point sources of create_autotune_model are predicted for a subsample of nrows rows, and compared with
+    the visibilities from the direct Fourier transform. The error is the rms difference divided by the rms of the
+    direct Fourier transform.
+
+    :param vis: Visibility
+    :param im: Image template
+    :param params: Imaging parameters e.g. {'context': 'wstack', 'vis_slices': 8}
+    :param nrows: Number of rows in the subsample
+    :param seed: Seed for choosing the subsample
+    :param kwargs: Other imaging parameters
+    :return: relative rms error
+    """
+    model, components = create_autotune_model(im)
+    svis = autotune_subsample(vis, nrows, seed=seed)
+    reference = predict_skycomponent_visibility(copy_visibility(svis, zero=True), components).data['vis']
+    predicted = predict_function(copy_visibility(svis, zero=True), model, **dict(kwargs, **params)).data['vis']
+    return numpy.sqrt(numpy.sum(numpy.abs(predicted - reference) ** 2) / numpy.sum(numpy.abs(reference) ** 2))
+
+
+def autotune_subsample(vis: Visibility, nrows, seed=1234567) -> Visibility:
+    """ Select nrows rows at random from a visibility, keeping their order
+
+    :param vis: Visibility
+    :param nrows: Number of rows
+    :param seed: Seed for the random choice
+    :return: Visibility
+    """
+    if nrows >= vis.nvis:
+        return copy_visibility(vis)
+    choice = numpy.random.RandomState(seed).choice(vis.nvis, nrows, replace=False)
+    rows = numpy.zeros(vis.nvis, dtype='bool')
+    rows[choice] = True
+    return create_visibility_from_rows(vis, rows)
+
+
+def autotune_imaging(vis, im: Image, max_error=1e-3, max_memory=None, strategies=None, nrows=4096, max_slices=64,
+                     paddings=(1.2, 1.5, 2.0), seed=1234567, **kwargs):
+    """ Choose the imaging context and parameters expected to be fastest within an error budget
+
+    The gridding kernel is chosen first, from the prolate spheroidal kernel with each of paddings and the exponential
+    of semicircle kernel ('es'), as the fastest with a gridding error below max_error / 2. Then for each of the
+    strategies, the number of slices (or facets, or w kernels for w projection) is doubled from 2 up to max_slices
+    until the error is below max_error, and that candidate is timed. The fastest candidate within max_error and
+    max_memory is returned, or if none is, the most accurate one. If none of the strategies gives a candidate (e.g.
+    w projection when all w are zero) the '2d' context is used. The memory is measured with tracemalloc, so
+    max_memory cannot be used while tracemalloc is already tracing.
+
+    The result can be passed to invert_function, predict_function, residual_function and the imaging workflows.
+
+    :param vis: Visibility or BlockVisibility
+    :param im: Image template
+    :param max_error: Largest rms error of the predicted visibility, relative to the rms visibility
+    :param max_memory: Largest estimated peak memory (bytes), None for no limit
+    :param strategies: w correction strategies to try (default all of autotune_strategies())
+    :param nrows: Number of rows in the subsamples
+    :param max_slices: Largest number of slices, facets or w kernels to try
+    :param paddings: Paddings to try with the prolate spheroidal kernel
+    :param seed: Seed for choosing the subsamples
+    :param kwargs: Other imaging parameters used for all candidates e.g. gridder, precision
+    :return: dict of context, vis_slices, facets, padding, kernel and, for w projection, wstep, or for the 'es'
+        kernel, epsilon
+    """
+    if not isinstance(vis, Visibility):
+        vis = convert_blockvisibility_to_visibility(vis)
+    if strategies is None:
+        strategies = autotune_strategies()
+    for strategy in strategies:
+        assert strategy in autotune_strategies(), "Unknown strategy %s" % strategy
+    assert max_memory is None or not tracemalloc.is_tracing(), \
+        "autotune_imaging: max_memory needs tracemalloc, which is already in use"
+
+    def measure(params, error_budget, evis=vis):
+        error = autotune_error(evis, im, params, nrows=nrows, seed=seed, **kwargs)
+        result = {'params': params, 'error': error, 'time': None, 'memory': None}
+        if error <= error_budget:
+            result['time'], result['memory'] = autotune_benchmark(evis, im, params, nrows=nrows, seed=seed,
+                                                                  measure_memory=max_memory is not None, **kwargs)
+        log.info("autotune_imaging: %s error %.2g time %s" % (params, error, _format_time(result['time'])))
+        return result
+
+    def select(results, error_budget):
+        passed = [r for r in results if r['time'] is not None and r['error'] <= error_budget and
+                  (max_memory is None or (r['memory'] is not None and r['memory'] <= max_memory))]
+        if passed:
+            return min(passed, key=lambda r: r['time'])
+        best = min(results, key=lambda r: r['error'])
+        log.warning("autotune_imaging: no candidate meets the error and memory targets, using the most accurate %s"
+                    % best['params'])
+        return best
+
+    # Stage 1: the gridding kernel and padding, for w = 0
+    zvis = copy_visibility(vis)
+    zvis.data['uvw'][:, 2] = 0.0
+    gridding = [{'kernel': '2d', 'padding': padding} for padding in paddings]
+    gridding.append({'kernel': 'es', 'epsilon': max_error / 4.0,
+                     'padding': get_padding(vis, im, kernel='es', epsilon=max_error / 4.0, **kwargs)})
+    gridding_results = [measure(dict(context='2d', **g), max_error / 2.0, evis=zvis) for g in gridding]
+    best_gridding = dict(select(gridding_results, max_error / 2.0)['params'])
+    best_gridding.pop('context')
+
+    # w projection uses the prolate spheroidal kernel
+    pswf = [r for r in gridding_results if r['params']['kernel'] == '2d' and r['time'] is not None]
+    wprojection_padding = min(pswf, key=lambda r: r['time'])['params']['padding'] if pswf else 2.0
+
+    # Stage 2: the w correction
+    wmax = numpy.max(numpy.abs(vis.w))
+    ntimes = len(numpy.unique(vis.time))
+    nx = im.shape[3]
+    results = list()
+    for strategy in strategies:
+        if strategy == '2d':
+            candidates = [dict(context='2d', vis_slices=1, facets=1, **best_gridding)]
+        elif strategy in ['wstack', 'wstack_multi']:
+            candidates = [dict(context=strategy, vis_slices=n, facets=1, **best_gridding)
+                          for n in _doubling(max_slices)]
+        elif strategy == 'timeslice':
+            slices = [n for n in _doubling(min(max_slices, ntimes))] + ([ntimes] if ntimes <= max_slices else [])
+            candidates = [dict(context='timeslice', vis_slices=n, facets=1, **best_gridding)
+                          for n in sorted(set(slices))]
+        elif strategy == 'facets':
+            candidates = [dict(context='facets', vis_slices=1, facets=n, **best_gridding)
+                          for n in _doubling(max_slices) if nx % n == 0 and nx // n >= 16]
+        else:
+            if wmax == 0.0:
+                continue
+            candidates = [dict(context='2d', vis_slices=1, facets=1, kernel='wprojection', padding=wprojection_padding,
+                               wstep=2.0 * wmax / n) for n in _doubling(max_slices)]
+
+        # The error falls as the slices increase, so only the first candidate within the budget is timed
+        for params in candidates:
+            result = measure(params, max_error)
+            results.append(result)
+            if result['time'] is not None:
+                break
+
+    # e.g. only w projection was asked for and all w are zero
+    if not results:
+        log.info("autotune_imaging: no candidates for strategies %s, trying 2d" % list(strategies))
+        results.append(measure(dict(context='2d', vis_slices=1, facets=1, **best_gridding), max_error))
+
+    best = select(results, max_error)
+    log.info("autotune_imaging: chose %s, error %.2g, estimated time %s" % (best['params'], best['error'],
+                                                                          _format_time(best['time'])))
+    return best['params']
+
+
+def _doubling(nmax):
+    """ 2, 4, 8, ... up to nmax
+    """
+    return [2 ** i for i in range(1, int(numpy.log2(max(nmax, 1))) + 1)]
+
+
+def _extrapolate(sizes, values, n):
+    """ Fit values = a + b * sizes to the two points, with a and b not negative, and evaluate at n
+    """
+    slope = max(0.0, (values[1] - values[0]) / (sizes[1] - sizes[0])) if sizes[1] > sizes[0] else 0.0
+    intercept = max(0.0, values[1] - slope * sizes[1])
+    return intercept + slope * n
+
+
+def _format_time(t):
+    return 'not measured' if t is None else '%.3f s' % t
@@ -27,17 +27,25 @@ import numpy
 from astropy import constants as constants
 from astropy import units as units
 from astropy import wcs
+from astropy.coordinates import SkyCoord
 from astropy.wcs.utils import pixel_to_skycoord
 
 from data_models.memory_data_models import Visibility, BlockVisibility, Image, Skycomponent, assert_same_chan_pol
-from data_models.parameters import get_parameter
+from data_models.parameters import get_parameter, get_precision_dtypes
 from data_models.polarisation import convert_pol_frame, PolarisationFrame
 
-from libs.fourier_transforms.convolutional_gridding import convolutional_grid, convolutional_degrid
-from libs.fourier_transforms.fft_support import fft, ifft, pad_mid, extract_mid
-from libs.image.operations import create_image_from_array
-from libs.imaging.imaging_params import get_frequency_map, get_polarisation_map, get_uvw_map, get_kernel_list
-from libs.util.coordinate_support import simulate_point, skycoord_to_lmn
+from libs.fourier_transforms.convolutional_gridding import convolutional_grid, convolutional_degrid, \
+    half_plane_uvwmap
+from libs.fourier_transforms.dft_support import dft_point_sources
+from libs.fourier_transforms.fft_support import fft, ifft, pad_mid, extract_mid, fft_half_plane, ifft_half_plane, \
+    fft_friendly_size
+from libs.fourier_transforms.tiled_grid import TiledGrid, convolutional_grid_tiled, convolutional_degrid_tiled, \
+    tiled_grid_allocate, fft_tiled, ifft_tiled
+from libs.image.operations import create_image_from_array, copy_image
+from libs.imaging.imaging_params import get_frequency_map, get_polarisation_map, get_uvw_map, get_kernel_list, \
+    get_gridding_order, get_padding
+from libs.util.buffer_pool import buffer_pool
+from libs.util.coordinate_support import skycoord_to_lmn
 
 from ..visibility.base import copy_visibility, phaserotate_visibility
 from ..visibility.coalesce import coalesce_visibility, decoalesce_visibility, convert_blockvisibility_to_visibility
@@ -91,15 +99,103 @@ def normalize_sumwt(im: Image, sumwt) -> Image:
     assert sumwt is not None
     assert nchan == sumwt.shape[0]
     assert npol == sumwt.shape[1]
-    for chan in range(nchan):
-        for pol in range(npol):
-            if sumwt[chan, pol] > 0.0:
-                im.data[chan, pol, :, :] /= sumwt[chan, pol]
-            else:
-                im.data[chan, pol, :, :] = 0.0
+    # Divide all planes in place in one call, and zero the planes with no weight
+    positive = (sumwt > 0.0)[..., numpy.newaxis, numpy.newaxis]
+    numpy.divide(im.data, sumwt[..., numpy.newaxis, numpy.newaxis], out=im.data, where=positive)
+    im.data[~positive[..., 0, 0]] = 0.0
     return im
 
 
+class ImageAccumulator:
+    """ Weighted sum of (image, sum of weights) pairs, such as the results of invert for parts of the data
+
+    The sum is held in one image that is added to in place, and is normalised once at the end. For example::
+
+        accumulator = ImageAccumulator()
+        for im, sumwt in results:
+            accumulator.add(im, sumwt)
+        im, sumwt = accumulator.result()
+    """
+
+    def __init__(self, dtype=None):
+        """ Create an empty accumulator
+
+        :param dtype: dtype of the sum (default that of the first image added)
+        """
+        self.dtype = dtype
+        self.image = None
+        self.sumwt = None
+        self.count = 0
+
+    def __len__(self):
+        """ Number of images added
+        """
+        return self.count
+
+    def add(self, im: Image, sumwt, normalized=True):
+        """ Add an image and its sum of weights
+
+        The image is not changed.
+
+        :param im: Image
+        :param sumwt: Sum of weights [nchan, npol] (or a scalar)
+        :param normalized: The image has been normalised by sumwt, so is weighted by sumwt before adding
+        """
+        self.count += 1
+        if self.image is None:
+            self.image = copy_image(im)
+            if self.dtype is not None:
+                self.image.data = self.image.data.astype(self.dtype, copy=False)
+            self.sumwt = numpy.zeros(im.data.shape[:2]) + sumwt
+            if normalized:
+                self.image.data *= self._scale(sumwt)
+        elif normalized:
+            # The weighted image is made in a work array from the buffer pool, rather than a new array per add
+            with buffer_pool.borrow(im.data.shape, dtype=self.image.data.dtype) as work:
+                numpy.multiply(im.data, self._scale(sumwt), out=work)
+                self.image.data += work
+            self.sumwt += sumwt
+        else:
+            self.image.data += im.data
+            self.sumwt += sumwt
+
+    @staticmethod
+    def _scale(sumwt):
+        if isinstance(sumwt, numpy.ndarray):
+            return sumwt[..., numpy.newaxis, numpy.newaxis]
+        return sumwt
+
+    def result(self, normalize=True) -> (Image, numpy.ndarray):
+        """ Return the sum
+
+        :param normalize: Normalize by the total sum of weights (True)
+        :return: image, sum of weights
+        """
+        assert self.image is not None, "No images have been added"
+        if normalize:
+            self.image = normalize_sumwt(self.image, self.sumwt)
+        return self.image, self.sumwt
+
+
+def hermitian_flip_visibility(vis: Visibility, im: Image) -> (Visibility, numpy.ndarray):
+    """Move the rows on the negative u half of the grid of im to the conjugate point in place
+
+    For a real sky, the visibility at (-u, -v, -w) is the conjugate of that at (u, v, w). The flipped rows are
+    therefore equivalent to the originals when making or predicting a real image, and can all be gridded onto
+    the non-negative half of the grid (which is u <= 0 for the usual negative RA increment). With w projection the
+    flipped rows use the kernel nearest -w, so results agree with the unflipped rows to within the w sampling error.
+
+    :param vis: Visibility
+    :param im: Image whose grid is used
+    :return: visibility with rows flipped, boolean array marking the flipped rows
+    """
+    assert isinstance(vis, Visibility), vis
+    flip = vis.data['uvw'][:, 0] * im.wcs.wcs.cdelt[0] < 0.0
+    vis.data['uvw'][flip] *= -1.0
+    vis.data['vis'][flip] = numpy.conj(vis.data['vis'][flip])
+    return vis, flip
+
+
 def predict_2d(vis: Union[BlockVisibility, Visibility], model: Image,
                     **kwargs) -> Union[BlockVisibility, Visibility]:
     """ Predict using convolutional degridding.
@@ -107,6 +203,20 @@ def predict_2d(vis: Union[BlockVisibility, Visibility], model: Image,
     This is at the bottom of the layering i.e. all transforms are eventually expressed in terms of
     this function. Any shifting needed is performed here.
 
+    If hermitian=True, the real model is transformed by a real FFT to one half of the grid, and the rows on the
+    other half are degridded at their conjugate points (see hermitian_flip_visibility).
+
+    If uvgrid_tile is given (and hermitian is not set), only the tiles of uvgrid_tile x uvgrid_tile cells of the
+    grid that the visibilities need are made, by a pruned FFT (see :mod:`libs.fourier_transforms.tiled_grid`). This
+    saves memory and time when the uv coverage is small, e.g. for one time slice.
+
+    If precision='single', the grid and kernels are held in complex64.
+
+    The padded grid is taken from the process-wide buffer pool (see :mod:`libs.util.buffer_pool`) and transformed in
+    place, so that repeated calls reuse the same memory.
+
+    The FFT uses the backend chosen by set_fft_backend, with nthreads threads if given.
+
     :param vis: Visibility to be predicted
     :param model: model image
     :return: resulting visibility (in place works)
@@ -119,19 +229,8 @@ def predict_2d(vis: Union[BlockVisibility, Visibility], model: Image,
     
     assert isinstance(avis, Visibility), avis
     
-    _, _, ny, nx = model.data.shape
-    
-    padding = {}
-    if get_parameter(kwargs, "padding", False):
-        padding = {'padding': get_parameter(kwargs, "padding", False)}
-    spectral_mode, vfrequencymap = get_frequency_map(avis, model)
-    polarisation_mode, vpolarisationmap = get_polarisation_map(avis, model)
-    uvw_mode, shape, padding, vuvwmap = get_uvw_map(avis, model, **padding)
-    kernel_name, gcf, vkernellist = get_kernel_list(avis, model, **kwargs)
-    
-    uvgrid = fft((pad_mid(model.data, int(round(padding * nx))) * gcf).astype(dtype=complex))
-    
-    avis.data['vis'] = convolutional_degrid(vkernellist, avis.data['vis'].shape, uvgrid, vuvwmap, vfrequencymap)
+    vis_values = predict_2d_degrid(avis, model, **kwargs)
+    avis.data['vis'] = vis_values
     
     # Now we can shift the visibility from the image frame to the original visibility frame
     svis = shift_vis_to_image(avis, model, tangent=True, inverse=True)
@@ -143,15 +242,233 @@ def predict_2d(vis: Union[BlockVisibility, Visibility], model: Image,
         return svis
 
 
+def predict_2d_degrid(avis: Visibility, model: Image, vfrequencymap=None, modeldata=None, **kwargs) -> numpy.ndarray:
+    """ Transform a model to the uv grid and degrid visibility values, as used by predict_2d and predict_2d_cube
+
+    The visibility must already be in the phase frame of the model image.
+
+    :param avis: Visibility giving the uvw and frequencies
+    :param model: model image giving the grid parameters
+    :param vfrequencymap: Model channel of each row, if not that of get_frequency_map (e.g. for predict_2d_cube)
+    :param modeldata: Model pixels [nchan, npol, ny, nx] to use instead of model.data
+    :return: visibility values [nvis, npol]
+    """
+    if modeldata is None:
+        modeldata = model.data
+    _, _, ny, nx = modeldata.shape
+
+    padding = get_padding(avis, model, **kwargs)
+    hermitian = get_parameter(kwargs, "hermitian", False)
+    if hermitian:
+        kvis, flip = hermitian_flip_visibility(copy_visibility(avis), model)
+    else:
+        kvis = avis
+
+    if vfrequencymap is None:
+        spectral_mode, vfrequencymap = get_frequency_map(kvis, model)
+    polarisation_mode, vpolarisationmap = get_polarisation_map(kvis, model)
+    uvw_mode, shape, padding, vuvwmap = get_uvw_map(kvis, model, padding=padding)
+    kernel_name, gcf, vkernellist = get_kernel_list(kvis, model, **kwargs)
+
+    real_dtype, complex_dtype = get_precision_dtypes(kwargs)
+    uvgrid_tile = get_parameter(kwargs, "uvgrid_tile", None)
+    gridder = get_parameter(kwargs, "gridder", "numpy")
+    if hermitian:
+        margin = vkernellist[1][0].shape[-1] // 2
+        uvgrid = fft_half_plane((pad_mid(modeldata, int(round(padding * nx))) * gcf).astype(dtype=real_dtype),
+                                margin, workers=get_parameter(kwargs, "nthreads", None))
+        vuvwmap = half_plane_uvwmap(vuvwmap, int(round(padding * nx)), margin)
+        vis_values = convolutional_degrid(vkernellist, avis.data['vis'].shape, uvgrid, vuvwmap, vfrequencymap,
+                                          gridder=gridder)
+    elif uvgrid_tile is not None:
+        npad = int(round(padding * nx))
+        uvgrid = TiledGrid(list(modeldata.shape[:2]) + [npad, npad], tile=uvgrid_tile,
+                           halo=vkernellist[1][0].shape[-1], dtype=complex_dtype)
+        uvgrid = tiled_grid_allocate(vkernellist, uvgrid, vuvwmap, vfrequencymap)
+        log.debug("predict_2d: using %d tiles, %.1f%% of grid" % (len(uvgrid), 100.0 * uvgrid.occupancy))
+        uvgrid = fft_tiled(uvgrid, (modeldata * extract_mid(gcf, npixel=nx)).astype(dtype=complex_dtype),
+                           workers=get_parameter(kwargs, "nthreads", None))
+        vis_values = convolutional_degrid_tiled(vkernellist, avis.data['vis'].shape, uvgrid, vuvwmap,
+                                                vfrequencymap, gridder=gridder)
+    else:
+        # The padded model is transformed in place in a work array from the buffer pool
+        npad = int(round(padding * nx))
+        with buffer_pool.borrow(list(modeldata.shape[:2]) + [npad, npad], dtype=complex_dtype) as uvgrid:
+            pad_mid(modeldata, npad, out=uvgrid)
+            uvgrid *= gcf
+            fft(uvgrid, workers=get_parameter(kwargs, "nthreads", None), out=uvgrid)
+            vis_values = convolutional_degrid(vkernellist, avis.data['vis'].shape, uvgrid, vuvwmap, vfrequencymap,
+                                              gridder=gridder)
+
+    if hermitian:
+        vis_values[flip] = numpy.conj(vis_values[flip])
+    return vis_values
+
+
+def cube_groups(im_list) -> List[List[int]]:
+    """ Group images that can be gridded onto one cube of channels, i.e. that have the same shape and cellsize
+
+    :param im_list: List of images
+    :return: List of lists of indices into im_list, in order of the first image of each group
+    """
+    groups = collections.OrderedDict()
+    for i, im in enumerate(im_list):
+        groups.setdefault((im.data.shape[1:], tuple(im.wcs.wcs.cdelt[:2])), []).append(i)
+    return list(groups.values())
+
+
+def cube_visibility(vis_list, im_list) -> (Visibility, numpy.ndarray, numpy.ndarray):
+    """ Join a list of visibilities, each with its image, into one visibility gridded onto a cube of channels
+
+    The images should be one group of cube_groups, and the visibilities have the same polarisation frame. The grid
+    parameters are those of the first image. The channels of all the images are stacked, and each row is mapped to
+    its channel in the stack.
+
+    :param vis_list: List of Visibility, e.g. one per frequency window, already in the frame of the images
+    :param im_list: List of images, one per visibility
+    :return: joined Visibility, channel in the stack of each row, first channel in the stack of each image
+    """
+    assert len(vis_list) == len(im_list), "Need one image per visibility"
+    chan_offsets = numpy.cumsum([0] + [im.data.shape[0] for im in im_list])
+    vfrequencymap = numpy.concatenate([numpy.array(get_frequency_map(vis, im)[1], dtype='int') + chan_offsets[i]
+                                       for i, (vis, im) in enumerate(zip(vis_list, im_list))])
+    cvis = Visibility(data=numpy.concatenate([vis.data for vis in vis_list]), phasecentre=vis_list[0].phasecentre,
+                      configuration=vis_list[0].configuration, polarisation_frame=vis_list[0].polarisation_frame)
+    return cvis, vfrequencymap, chan_offsets
+
+
+def invert_2d_cube(vis_list, im_list, dopsf: bool = False, normalize: bool = True, **kwargs) \
+        -> List[Tuple[Image, numpy.ndarray]]:
+    """ Invert a list of visibilities, e.g. the frequency windows of a spectral line observation, in one call
+
+    The rows of all the visibilities are gridded onto one grid holding the channels of all the images, with the grid
+    coordinates, kernels and sort done once, and all channels are transformed by one batched FFT. Images with
+    different shapes or cellsizes (e.g. from advise_wide_field for each frequency) are gridded onto separate cubes,
+    one for each group of cube_groups. The results are the same as calling invert_2d for each visibility and image.
+    The options are as for invert_2d, except that imaginary is not used and kernel='aprojection' is not supported.
+
+    :param vis_list: List of visibility, one per image
+    :param im_list: List of image templates (not changed)
+    :param dopsf: Make the psf instead of the dirty image
+    :param normalize: Normalize by the sum of weights (True)
+    :return: List of (image, sum of weights), one per image
+    """
+    assert get_parameter(kwargs, "kernel", "2d") != 'aprojection', "invert_2d_cube: A-projection is not supported"
+    kwargs.pop('imaginary', None)
+    groups = cube_groups(im_list)
+    if len(groups) > 1:
+        results = [None for im in im_list]
+        for group in groups:
+            group_results = invert_2d_cube([vis_list[i] for i in group], [im_list[i] for i in group], dopsf=dopsf,
+                                           normalize=normalize, **kwargs)
+            for i, result in zip(group, group_results):
+                results[i] = result
+        return results
+
+    hermitian = get_parameter(kwargs, "hermitian", False)
+    svis_list = list()
+    for vis, im in zip(vis_list, im_list):
+        if not isinstance(vis, Visibility):
+            svis = coalesce_visibility(vis, **kwargs)
+        else:
+            svis = copy_visibility(vis)
+        if dopsf:
+            svis.data['vis'] = numpy.ones_like(svis.data['vis'])
+        svis = shift_vis_to_image(svis, im, tangent=True, inverse=False)
+        if hermitian:
+            svis, _ = hermitian_flip_visibility(svis, im)
+        svis_list.append(svis)
+
+    cvis, vfrequencymap, chan_offsets = cube_visibility(svis_list, im_list)
+    log.debug("invert_2d_cube: gridding %d visibilities onto %d channels" % (cvis.nvis, chan_offsets[-1]))
+    result, sumwt = invert_2d_grid(cvis, im_list[0], cvis.data['vis'], cvis.data['imaging_weight'],
+                                   vfrequencymap=vfrequencymap, nchan=chan_offsets[-1], **kwargs)
+
+    results = list()
+    for i, im in enumerate(im_list):
+        chans = slice(chan_offsets[i], chan_offsets[i + 1])
+        resultimage = create_image_from_array(numpy.ascontiguousarray(numpy.real(result[chans])), im.wcs,
+                                              im.polarisation_frame)
+        imwt = numpy.ascontiguousarray(sumwt[chans])
+        if normalize:
+            resultimage = normalize_sumwt(resultimage, imwt)
+        results.append((resultimage, imwt))
+    return results
+
+
+def predict_2d_cube(vis_list, model_list, **kwargs) -> List[Union[BlockVisibility, Visibility]]:
+    """ Predict a list of visibilities, e.g. the frequency windows of a spectral line observation, in one call
+
+    The channels of all the models are transformed by one batched FFT, and the rows of all the visibilities are
+    degridded in one call. Models with different shapes or cellsizes are transformed and degridded separately, one
+    group of cube_groups at a time. The results are the same as calling predict_2d for each visibility and model.
+    The options are as for predict_2d, except that kernel='aprojection' is not supported.
+
+    :param vis_list: List of visibility to be predicted, one per model
+    :param model_list: List of model images
+    :return: List of resulting visibility (in place works)
+    """
+    assert get_parameter(kwargs, "kernel", "2d") != 'aprojection', "predict_2d_cube: A-projection is not supported"
+    groups = cube_groups(model_list)
+    if len(groups) > 1:
+        results = [None for model in model_list]
+        for group in groups:
+            group_results = predict_2d_cube([vis_list[i] for i in group], [model_list[i] for i in group], **kwargs)
+            for i, result in zip(group, group_results):
+                results[i] = result
+        return results
+
+    avis_list = list()
+    for vis in vis_list:
+        if isinstance(vis, BlockVisibility):
+            avis_list.append(coalesce_visibility(vis, **kwargs))
+        else:
+            avis_list.append(vis)
+
+    cvis, vfrequencymap, chan_offsets = cube_visibility(avis_list, model_list)
+    log.debug("predict_2d_cube: degridding %d visibilities from %d channels" % (cvis.nvis, chan_offsets[-1]))
+    modeldata = numpy.concatenate([model.data for model in model_list])
+    vis_values = predict_2d_degrid(cvis, model_list[0], vfrequencymap=vfrequencymap, modeldata=modeldata, **kwargs)
+
+    results = list()
+    row = 0
+    for vis, avis, model in zip(vis_list, avis_list, model_list):
+        avis.data['vis'] = vis_values[row:row + avis.nvis]
+        row += avis.nvis
+        # Now we can shift the visibility from the image frame to the original visibility frame
+        svis = shift_vis_to_image(avis, model, tangent=True, inverse=True)
+        if isinstance(vis, BlockVisibility) and isinstance(svis, Visibility):
+            results.append(decoalesce_visibility(svis))
+        else:
+            results.append(svis)
+    return results
+
+
 def invert_2d(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool = True, **kwargs) \
         -> (Image, numpy.ndarray):
     """ Invert using 2D convolution function, including w projection optionally
 
-    Use the image im as a template. Do PSF in a separate call.
+    Use the image im as a template. Do PSF in a separate call, or use invert_2d_dirty_psf to make both in one pass.
 
     This is at the bottom of the layering i.e. all transforms are eventually expressed in terms
     of this function. . Any shifting needed is performed here.
 
+    If hermitian=True (and imaginary=False), the rows on one half of the grid are gridded at their conjugate
+    points (see hermitian_flip_visibility) onto the other half, and the real image is made by a real FFT. This
+    halves the grid memory and the FFT time.
+
+    If uvgrid_tile is given (and hermitian is not set), the visibilities are gridded onto tiles of uvgrid_tile x
+    uvgrid_tile cells that are allocated only where needed, and transformed by a pruned FFT that never makes the
+    dense padded grid (see :mod:`libs.fourier_transforms.tiled_grid`). This saves memory and time when the uv
+    coverage is small, e.g. for one time slice.
+
+    If precision='single', the grid, kernels and resulting image are held in complex64 and float32.
+
+    The padded grid is taken from the process-wide buffer pool (see :mod:`libs.util.buffer_pool`) and transformed in
+    place, so that repeated calls (e.g. in the major cycles) reuse the same memory.
+
+    The FFT uses the backend chosen by set_fft_backend, with nthreads threads if given.
+
     :param vis: Visibility to be inverted
     :param im: image template (not changed)
     :param dopsf: Make the psf instead of the dirty image
@@ -169,31 +486,15 @@ def invert_2d(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool =
     
     svis = shift_vis_to_image(svis, im, tangent=True, inverse=False)
     
-    nchan, npol, ny, nx = im.data.shape
-    
-    padding = {}
-    if get_parameter(kwargs, "padding", False):
-        padding = {'padding': get_parameter(kwargs, "padding", False)}
-    spectral_mode, vfrequencymap = get_frequency_map(svis, im)
-    polarisation_mode, vpolarisationmap = get_polarisation_map(svis, im)
-    uvw_mode, shape, padding, vuvwmap = get_uvw_map(svis, im, **padding)
-    kernel_name, gcf, vkernellist = get_kernel_list(svis, im, **kwargs)
-    
-    # Optionally pad to control aliasing
-    imgridpad = numpy.zeros([nchan, npol, int(round(padding * ny)), int(round(padding * nx))], dtype='complex')
-    imgridpad, sumwt = convolutional_grid(vkernellist, imgridpad, svis.data['vis'], svis.data['imaging_weight'],
-                                          vuvwmap, vfrequencymap)
-    
-    # Fourier transform the padded grid to image, multiply by the gridding correction
-    # function, and extract the unpadded inner part.
-    
-    # Normalise weights for consistency with transform
-    sumwt /= float(padding * int(round(padding * nx)) * ny)
-    
     imaginary = get_parameter(kwargs, "imaginary", False)
+    hermitian = get_parameter(kwargs, "hermitian", False) and not imaginary
+    if hermitian:
+        svis, _ = hermitian_flip_visibility(svis, im)
+    
+    result, sumwt = invert_2d_grid(svis, im, svis.data['vis'], svis.data['imaging_weight'], cachevis=vis, **kwargs)
+
     if imaginary:
         log.debug("invert_2d: retaining imaginary part of dirty image")
-        result = extract_mid(ifft(imgridpad) * gcf, npixel=nx)
         resultreal = create_image_from_array(result.real, im.wcs, im.polarisation_frame)
         resultimag = create_image_from_array(result.imag, im.wcs, im.polarisation_frame)
         if normalize:
@@ -201,61 +502,356 @@ def invert_2d(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool =
             resultimag = normalize_sumwt(resultimag, sumwt)
         return resultreal, sumwt, resultimag
     else:
-        result = extract_mid(numpy.real(ifft(imgridpad)) * gcf, npixel=nx)
-        resultimage = create_image_from_array(result, im.wcs, im.polarisation_frame)
+        resultimage = create_image_from_array(numpy.ascontiguousarray(numpy.real(result)), im.wcs,
+                                              im.polarisation_frame)
         if normalize:
             resultimage = normalize_sumwt(resultimage, sumwt)
         return resultimage, sumwt
 
 
+def invert_2d_dirty_psf(vis: Visibility, im: Image, normalize: bool = True, **kwargs) \
+        -> ((Image, numpy.ndarray), (Image, numpy.ndarray)):
+    """ Invert to make both the dirty image and the PSF in one pass over the data
+
+    The visibilities and unit visibilities are gridded together, as the two halves of a grid with twice the number
+    of polarisations, so that the grid coordinates, kernels and weights are found once and the data are traversed
+    once. Both halves are then transformed by one FFT. The results are the same as from two calls of invert_2d with
+    dopsf False and True. The options are as for invert_2d, but only the real images are returned.
+
+    :param vis: Visibility to be inverted
+    :param im: image template (not changed)
+    :param normalize: Normalize by the sum of weights (True)
+    :return: (dirty image, sum of weights), (psf, sum of weights)
+    """
+    if not isinstance(vis, Visibility):
+        svis = coalesce_visibility(vis, **kwargs)
+    else:
+        svis = copy_visibility(vis)
+
+    # The unit visibilities must have the same phase shift and flips as the data
+    psfvis = copy_visibility(svis)
+    psfvis.data['vis'] = numpy.ones_like(psfvis.data['vis'])
+    svis = shift_vis_to_image(svis, im, tangent=True, inverse=False)
+    psfvis = shift_vis_to_image(psfvis, im, tangent=True, inverse=False)
+
+    hermitian = get_parameter(kwargs, "hermitian", False) and not get_parameter(kwargs, "imaginary", False)
+    if hermitian:
+        svis, _ = hermitian_flip_visibility(svis, im)
+        psfvis, _ = hermitian_flip_visibility(psfvis, im)
+
+    npol = svis.data['vis'].shape[-1]
+    visdata = numpy.concatenate([svis.data['vis'], psfvis.data['vis']], axis=-1)
+    visweights = numpy.concatenate([svis.data['imaging_weight'], svis.data['imaging_weight']], axis=-1)
+    result, sumwt = invert_2d_grid(svis, im, visdata, visweights, cachevis=vis, **kwargs)
+
+    results = list()
+    for part in [slice(0, npol), slice(npol, 2 * npol)]:
+        resultimage = create_image_from_array(numpy.ascontiguousarray(numpy.real(result[:, part])), im.wcs,
+                                              im.polarisation_frame)
+        partwt = numpy.ascontiguousarray(sumwt[:, part])
+        if normalize:
+            resultimage = normalize_sumwt(resultimage, partwt)
+        results.append((resultimage, partwt))
+    return results[0], results[1]
+
+
+def invert_2d_grid(svis: Visibility, im: Image, visdata, visweights, cachevis=None, vfrequencymap=None, nchan=None,
+                   **kwargs) -> (numpy.ndarray, numpy.ndarray):
+    """ Grid visibility values and transform to the image plane, as used by invert_2d and invert_2d_dirty_psf
+
+    The values may have more polarisations than the image, e.g. the data followed by unit visibilities, in which
+    case the grid and result have the same number of polarisations as the values. The visibility must already be
+    shifted to the image phase centre and, if hermitian is True (and imaginary is False), flipped (see
+    hermitian_flip_visibility).
+
+    :param svis: Visibility giving the uvw and frequencies
+    :param im: image template (not changed)
+    :param visdata: Visibility values [nvis, ngpol]
+    :param visweights: Visibility weights [nvis, ngpol]
+    :param cachevis: Visibility on which to cache the gridding order if uvsort is set (default svis)
+    :param vfrequencymap: Grid channel of each row, if not that of get_frequency_map (e.g. for invert_2d_cube)
+    :param nchan: Number of grid channels if vfrequencymap is given (default that of im)
+    :return: complex image [nchan, ngpol, ny, nx] (not normalised), sum of weights [nchan, ngpol]
+    """
+    _, _, ny, nx = im.data.shape
+    if vfrequencymap is None or nchan is None:
+        nchan = im.data.shape[0]
+    ngpol = visdata.shape[-1]
+    hermitian = get_parameter(kwargs, "hermitian", False) and not get_parameter(kwargs, "imaginary", False)
+
+    padding = get_padding(svis, im, **kwargs)
+    if vfrequencymap is None:
+        spectral_mode, vfrequencymap = get_frequency_map(svis, im)
+    polarisation_mode, vpolarisationmap = get_polarisation_map(svis, im)
+    uvw_mode, shape, padding, vuvwmap = get_uvw_map(svis, im, padding=padding)
+    kernel_name, gcf, vkernellist = get_kernel_list(svis, im, **kwargs)
+    
+    # Optionally pad to control aliasing
+    _, complex_dtype = get_precision_dtypes(kwargs)
+    uvgrid_tile = get_parameter(kwargs, "uvgrid_tile", None)
+    if hermitian:
+        margin = vkernellist[1][0].shape[-1] // 2
+        imgridpad = buffer_pool.get([nchan, ngpol, int(round(padding * ny)), int(round(padding * nx)) // 2 + margin],
+                                    dtype=complex_dtype, zero=True)
+        vuvwmap = half_plane_uvwmap(vuvwmap, int(round(padding * nx)), margin)
+    elif uvgrid_tile is not None:
+        imgridpad = TiledGrid([nchan, ngpol, int(round(padding * ny)), int(round(padding * nx))], tile=uvgrid_tile,
+                              halo=vkernellist[1][0].shape[-1], dtype=complex_dtype)
+    else:
+        imgridpad = buffer_pool.get([nchan, ngpol, int(round(padding * ny)), int(round(padding * nx))],
+                                    dtype=complex_dtype, zero=True)
+    gridder = get_parameter(kwargs, "gridder", "numpy")
+    nthreads = get_parameter(kwargs, "nthreads", 1)
+    try:
+        if isinstance(imgridpad, TiledGrid):
+            imgridpad, sumwt = convolutional_grid_tiled(vkernellist, imgridpad, visdata, visweights, vuvwmap,
+                                                        vfrequencymap, gridder=gridder)
+            log.debug("invert_2d: gridded onto %d tiles, %.1f%% of grid" % (len(imgridpad),
+                                                                             100.0 * imgridpad.occupancy))
+        else:
+            order = None
+            if get_parameter(kwargs, "uvsort", False):
+                # Cache the order on the caller's Visibility so that later calls can reuse it
+                if not isinstance(cachevis, Visibility):
+                    cachevis = svis
+                order = get_gridding_order(cachevis, imgridpad.shape, vuvwmap, vfrequencymap,
+                                           tile=get_parameter(kwargs, "uvsort_tile", 32))
+            imgridpad, sumwt = convolutional_grid(vkernellist, imgridpad, visdata, visweights, vuvwmap,
+                                                  vfrequencymap, gridder=gridder, nthreads=nthreads, order=order)
+
+        # Normalise weights for consistency with transform
+        sumwt /= float(padding * int(round(padding * nx)) * ny)
+
+        result = transform_grid_to_image(imgridpad, gcf, nx, int(round(padding * nx)), hermitian=hermitian,
+                                         margin=vkernellist[1][0].shape[-1] // 2,
+                                         workers=get_parameter(kwargs, "nthreads", None))
+    finally:
+        if not isinstance(imgridpad, TiledGrid):
+            buffer_pool.release(imgridpad)
+    return result, sumwt
+
+
+def transform_grid_to_image(imgridpad, gcf, nx, npad, hermitian=False, margin=0, workers=None) -> numpy.ndarray:
+    """ Fourier transform the padded grid to image, multiply by the gridding correction function, and extract the
+    unpadded inner part, as used by invert_2d_grid and residual_2d
+
+    The grid is overwritten, and should be given back to the buffer pool by the caller if it came from there.
+
+    :param imgridpad: Padded grid, half plane grid if hermitian, or TiledGrid
+    :param gcf: Gridding correction function for the padded image
+    :param nx: Number of pixels in the image
+    :param npad: Number of pixels in the padded grid
+    :param hermitian: The grid is a half plane grid (see ifft_half_plane)
+    :param margin: Number of columns of the half plane grid at negative u
+    :param workers: Number of FFT threads, default set by set_fft_backend
+    :return: complex image [nchan, npol, ny, nx] (real if hermitian)
+    """
+    if hermitian:
+        result = extract_mid(ifft_half_plane(imgridpad, npad, margin, workers=workers) * gcf, npixel=nx)
+    elif isinstance(imgridpad, TiledGrid):
+        result = ifft_tiled(imgridpad, nx, workers=workers) * extract_mid(gcf, npixel=nx)
+    else:
+        # Transform in place, and copy out the unpadded part before the grid goes back to the pool
+        result = extract_mid(ifft(imgridpad, workers=workers, out=imgridpad), npixel=nx) * \
+                 extract_mid(gcf, npixel=nx)
+    return result
+
+
+def residual_2d(vis: Union[BlockVisibility, Visibility], model: Image, normalize: bool = True, residual=None,
+                **kwargs) -> (Union[BlockVisibility, Visibility], Image, numpy.ndarray):
+    """ Calculate the residual visibility and residual image in one pass over the data
+
+    This is the same as predicting the model, subtracting it from the visibility, and inverting the result (see
+    residual_image), but the grid coordinates and kernels are found once, for both the degridding and the gridding.
+    The model is transformed to the padded grid, the model visibilities are degridded and subtracted in the frame
+    of the image, and the residual is then gridded onto the same grid array and transformed back. The options are
+    as for predict_2d and invert_2d, except that imaginary is not used.
+
+    The residual visibility is written into residual if given (e.g. the residual of the previous major cycle), so
+    that loops such as solve_image do not allocate new visibilities.
+
+    If the visibility and model have different numbers of polarisations, predict_2d and invert_2d are used.
+
+    :param vis: Visibility
+    :param model: model image, also used as the template of the residual image
+    :param normalize: Normalize by the sum of weights (True)
+    :param residual: Visibility like vis to hold the residual (default a new copy of vis)
+    :return: residual visibility, residual image, sum of weights
+    """
+    kwargs.pop('imaginary', None)
+    if isinstance(vis, BlockVisibility):
+        avis = coalesce_visibility(vis, **kwargs)
+    else:
+        avis = vis
+    if residual is None:
+        visres = copy_visibility(avis)
+    elif isinstance(residual, BlockVisibility):
+        visres = coalesce_visibility(residual, **kwargs)
+    else:
+        visres = residual
+    assert visres.data['vis'].shape == avis.data['vis'].shape, "Residual must have the same shape as the visibility"
+
+    nchan, npol, ny, nx = model.data.shape
+    if avis.data['vis'].shape[-1] != npol:
+        log.debug("residual_2d: visibility and model polarisations differ, using predict_2d and invert_2d")
+        modelvis = predict_2d(copy_visibility(avis, zero=True), model, **kwargs)
+        numpy.subtract(avis.data['vis'], modelvis.data['vis'], out=visres.data['vis'])
+        dirty, sumwt = invert_2d(visres, model, dopsf=False, normalize=normalize, **kwargs)
+        if isinstance(vis, BlockVisibility):
+            visres = decoalesce_visibility(visres)
+        return visres, dirty, sumwt
+
+    # The degridding and gridding are both done in the frame of the model
+    svis = shift_vis_to_image(copy_visibility(avis), model, tangent=True, inverse=False)
+    hermitian = get_parameter(kwargs, "hermitian", False)
+    if hermitian:
+        svis, flip = hermitian_flip_visibility(svis, model)
+
+    padding = get_padding(svis, model, **kwargs)
+    spectral_mode, vfrequencymap = get_frequency_map(svis, model)
+    polarisation_mode, vpolarisationmap = get_polarisation_map(svis, model)
+    uvw_mode, shape, padding, vuvwmap = get_uvw_map(svis, model, padding=padding)
+    kernel_name, gcf, vkernellist = get_kernel_list(svis, model, **kwargs)
+    npad = int(round(padding * nx))
+    margin = vkernellist[1][0].shape[-1] // 2
+
+    real_dtype, complex_dtype = get_precision_dtypes(kwargs)
+    uvgrid_tile = get_parameter(kwargs, "uvgrid_tile", None)
+    gridder = get_parameter(kwargs, "gridder", "numpy")
+    nthreads = get_parameter(kwargs, "nthreads", 1)
+    fft_workers = get_parameter(kwargs, "nthreads", None)
+    if hermitian:
+        uvgrid = fft_half_plane((pad_mid(model.data, npad) * gcf).astype(dtype=real_dtype), margin,
+                                workers=fft_workers)
+        vuvwmap = half_plane_uvwmap(vuvwmap, npad, margin)
+    elif uvgrid_tile is not None:
+        uvgrid = TiledGrid([nchan, npol, npad, npad], tile=uvgrid_tile, halo=vkernellist[1][0].shape[-1],
+                           dtype=complex_dtype)
+        uvgrid = tiled_grid_allocate(vkernellist, uvgrid, vuvwmap, vfrequencymap)
+        log.debug("residual_2d: using %d tiles, %.1f%% of grid" % (len(uvgrid), 100.0 * uvgrid.occupancy))
+        uvgrid = fft_tiled(uvgrid, (model.data * extract_mid(gcf, npixel=nx)).astype(dtype=complex_dtype),
+                           workers=fft_workers)
+    else:
+        uvgrid = buffer_pool.get([nchan, npol, npad, npad], dtype=complex_dtype)
+
+    try:
+        if not hermitian and not isinstance(uvgrid, TiledGrid):
+            pad_mid(model.data, npad, out=uvgrid)
+            uvgrid *= gcf
+            fft(uvgrid, workers=fft_workers, out=uvgrid)
+
+        # Degrid the model and subtract it from the data, in place in the shifted (and flipped) copy
+        if isinstance(uvgrid, TiledGrid):
+            model_values = convolutional_degrid_tiled(vkernellist, svis.data['vis'].shape, uvgrid, vuvwmap,
+                                                      vfrequencymap, gridder=gridder)
+        else:
+            model_values = convolutional_degrid(vkernellist, svis.data['vis'].shape, uvgrid, vuvwmap,
+                                                vfrequencymap, gridder=gridder)
+        svis.data['vis'] -= model_values
+
+        # Grid the residual onto the same grid array
+        if isinstance(uvgrid, TiledGrid):
+            uvgrid.data[...] = 0.0
+            uvgrid, sumwt = convolutional_grid_tiled(vkernellist, uvgrid, svis.data['vis'],
+                                                     svis.data['imaging_weight'], vuvwmap, vfrequencymap,
+                                                     gridder=gridder)
+        else:
+            uvgrid[...] = 0.0
+            order = None
+            if get_parameter(kwargs, "uvsort", False):
+                cachevis = vis if isinstance(vis, Visibility) else svis
+                order = get_gridding_order(cachevis, uvgrid.shape, vuvwmap, vfrequencymap,
+                                           tile=get_parameter(kwargs, "uvsort_tile", 32))
+            uvgrid, sumwt = convolutional_grid(vkernellist, uvgrid, svis.data['vis'], svis.data['imaging_weight'],
+                                               vuvwmap, vfrequencymap, gridder=gridder, nthreads=nthreads,
+                                               order=order)
+        sumwt /= float(padding * npad * ny)
+        result = transform_grid_to_image(uvgrid, gcf, nx, npad, hermitian=hermitian, margin=margin,
+                                         workers=fft_workers)
+    finally:
+        if not hermitian and not isinstance(uvgrid, TiledGrid):
+            buffer_pool.release(uvgrid)
+
+    dirty = create_image_from_array(numpy.ascontiguousarray(numpy.real(result)), model.wcs,
+                                    model.polarisation_frame)
+    if normalize:
+        dirty = normalize_sumwt(dirty, sumwt)
+
+    # Shift the model visibilities back to the frame of the visibility, and subtract them there
+    if hermitian:
+        model_values[flip] = numpy.conj(model_values[flip])
+    modelvis = copy_visibility(avis)
+    modelvis.data['vis'] = model_values
+    modelvis = shift_vis_to_image(modelvis, model, tangent=True, inverse=True)
+    numpy.subtract(avis.data['vis'], modelvis.data['vis'], out=visres.data['vis'])
+
+    if isinstance(vis, BlockVisibility):
+        visres = decoalesce_visibility(visres)
+    return visres, dirty, sumwt
+
+
 def predict_skycomponent_visibility(vis: Union[Visibility, BlockVisibility],
-                                    sc: Union[Skycomponent, List[Skycomponent]]) -> Union[Visibility, BlockVisibility]:
+                                    sc: Union[Skycomponent, List[Skycomponent]], **kwargs) \
+        -> Union[Visibility, BlockVisibility]:
     """Predict the visibility from a Skycomponent, add to existing visibility, for Visibility or BlockVisibility
 
+    The components are transformed together, channel by channel, by a blocked direct Fourier transform (see
+    :py:func:`libs.fourier_transforms.dft_support.dft_point_sources`). At most dft_block_size phasors are held at
+    once per thread, and the blocks of rows are done in nthreads threads.
+
     :param vis: Visibility or BlockVisibility
     :param sc: Skycomponent or list of SkyComponents
     :return: Visibility or BlockVisibility
     """
     if not isinstance(sc, collections.Iterable):
         sc = [sc]
+    else:
+        # Any iterable, e.g. a generator, is traversed more than once below
+        sc = list(sc)
+    if len(sc) == 0:
+        return vis
+
+    block_size = get_parameter(kwargs, "dft_block_size", 2 ** 20)
+    nthreads = get_parameter(kwargs, "nthreads", 1)
+
+    for comp in sc:
+        assert_same_chan_pol(vis, comp)
+    try:
+        # Convert all the directions at once where they are in the same frame
+        lmn = numpy.array(skycoord_to_lmn(SkyCoord([comp.direction for comp in sc]), vis.phasecentre)).T
+    except ValueError:
+        lmn = numpy.array([skycoord_to_lmn(comp.direction, vis.phasecentre) for comp in sc])
 
     if isinstance(vis, Visibility):
-    
-        _, im_nchan = list(get_frequency_map(vis, None))
-        npol = vis.polarisation_frame.npol
-        
+
         for comp in sc:
             assert isinstance(comp, Skycomponent), comp
+        flux = numpy.array([comp.flux for comp in sc])
+        _, im_nchan = list(get_frequency_map(vis, None))
+        im_nchan = numpy.asarray(im_nchan)
+        chans = numpy.unique(im_nchan)
+        if len(chans) == 1:
+            dft_point_sources(vis.uvw, lmn, flux[:, chans[0], :], vis=vis.data['vis'], block_size=block_size,
+                              nthreads=nthreads)
+        else:
+            for chan in chans:
+                rows = im_nchan == chan
+                vis.data['vis'][rows] += dft_point_sources(vis.uvw[rows], lmn, flux[:, chan, :],
+                                                           block_size=block_size, nthreads=nthreads)
 
-            assert_same_chan_pol(vis, comp)
-            
-            l, m, n = skycoord_to_lmn(comp.direction, vis.phasecentre)
-            phasor = simulate_point(vis.uvw, l, m)
-            for ivis in range(vis.nvis):
-                for pol in range(npol):
-                    vis.data['vis'][ivis, pol] += comp.flux[im_nchan[ivis], pol] * phasor[ivis]
-                
     elif isinstance(vis, BlockVisibility):
         
         ntimes, nant, _, nchan, npol = vis.vis.shape
     
         k = numpy.array(vis.frequency) / constants.c.to('m s^-1').value
-    
-        for comp in sc:
-#            assert isinstance(comp, Skycomponent), comp
-            assert_same_chan_pol(vis, comp)
-    
-            flux = comp.flux
-            if comp.polarisation_frame != vis.polarisation_frame:
-                flux = convert_pol_frame(flux, comp.polarisation_frame, vis.polarisation_frame)
-        
-            l, m, n = skycoord_to_lmn(comp.direction, vis.phasecentre)
-            uvw = vis.uvw[..., numpy.newaxis] * k
-            phasor = numpy.ones([ntimes, nant, nant, nchan, npol], dtype='complex')
-            for chan in range(nchan):
-                phasor[:,:,:,chan,:] = simulate_point(uvw[...,chan], l, m)[...,numpy.newaxis]
-                
-            vis.data['vis'][..., :, :] += flux[:, :] * phasor[..., :]
+        flux = numpy.array([comp.flux if comp.polarisation_frame == vis.polarisation_frame else
+                            convert_pol_frame(comp.flux, comp.polarisation_frame, vis.polarisation_frame)
+                            for comp in sc])
+        uvw = vis.uvw.reshape([-1, 3])
+        for chan in range(nchan):
+            vis.data['vis'][..., chan, :] += dft_point_sources(uvw * k[chan], lmn, flux[:, chan, :],
+                                                               block_size=block_size, nthreads=nthreads) \
+                .reshape([ntimes, nant, nant, npol])
 
     return vis
 
@@ -380,7 +976,9 @@ def advise_wide_field(vis: Visibility, delA=0.02, oversampling_synthesised_beam=
                       wprojection_planes=1):
     """ Advise on parameters for wide field imaging.
     
-    Calculate sampling requirements on various parameters
+    Calculate sampling requirements on various parameters. To choose the imaging context and parameters by
+    measuring the error and time of the candidates instead, see
+    :py:func:`processing_components.imaging.autotune.autotune_imaging`.
     
     For example::
     
@@ -446,6 +1044,9 @@ def advise_wide_field(vis: Visibility, delA=0.02, oversampling_synthesised_beam=
     npixels2 = pwr23(npixels)
     log.info("advice_wide_field: Npixels (power of 2, 3) per side = %d" % (npixels2))
 
+    npixels_fft = fft_friendly_size(npixels)
+    log.info("advice_wide_field: Npixels (FFT friendly, factors 2, 3, 5, 7) per side = %d" % (npixels_fft))
+
     # Following equation is from Cornwell, Humphreys, and Voronkov (2012) (equation 24)
     # We will assume that the constraint holds at one quarter the entire FOV i.e. that
     # the full field of view includes the entire primary beam
@@ -0,0 +1,156 @@
+"""
+Image domain gridding (IDG). The visibilities are gridded and degridded through small subgrids on which the w term,
+and optionally the A terms of the stations, are applied exactly in the image domain (see
+:mod:`libs.fourier_transforms.subgrid_gridding`). There is only one full size FFT per image, and the cost of the
+gridding is proportional to the number of visibilities and the square of the subgrid size, which grows only for
+visibilities with large w.
+"""
+
+import logging
+
+import numpy
+
+from data_models.memory_data_models import Visibility, BlockVisibility, Image
+from data_models.parameters import get_parameter, get_precision_dtypes
+
+from libs.fourier_transforms.fft_support import fft, ifft, pad_mid, extract_mid
+from libs.fourier_transforms.subgrid_gridding import subgrid_grid, subgrid_degrid
+from libs.image.operations import create_image_from_array
+from libs.imaging.imaging_params import get_frequency_map, get_polarisation_map, get_uvw_map, get_anti_aliasing, \
+    get_padding
+
+from ..imaging.base import shift_vis_to_image, normalize_sumwt
+from ..visibility.base import copy_visibility
+from ..visibility.coalesce import coalesce_visibility, decoalesce_visibility
+
+log = logging.getLogger(__name__)
+
+
+def idg_aterm_function(aterms, im: Image, padding=2):
+    """ Function sampling the A terms of the stations, given on the pixels of the image, on subgrids
+
+    Each subgrid covers the padded image. Subgrid pixels outside the image take the value of the nearest edge pixel.
+
+    :param aterms: A term of each station [nant, ny, nx]
+    :param im: Image template
+    :param padding: Padding of the grid
+    :return: function of the subgrid size returning the A terms on the subgrid [nant, size, size]
+    """
+    _, _, ny, nx = im.data.shape
+    npad = int(round(padding * nx))
+
+    def sample(size):
+        offsets = (numpy.arange(size) - size // 2) * npad // size
+        xs = numpy.clip(nx // 2 + offsets, 0, nx - 1)
+        ys = numpy.clip(ny // 2 + offsets, 0, ny - 1)
+        return aterms[:, ys[:, numpy.newaxis], xs[numpy.newaxis, :]]
+
+    return sample
+
+
+def invert_idg(vis: Visibility, im: Image, dopsf=False, normalize=True, **kwargs) -> (Image, numpy.ndarray):
+    """ Invert using image domain gridding
+
+    The w term is applied exactly for every visibility. If aterms [nant, ny, nx] is given, the product of the
+    conjugate A term of the first station and the A term of the second is also applied. The subgrid size is set by
+    subgrid_size (default 32), and is increased if needed to hold the w support. Other parameters are as for
+    invert_2d (the kernel, hermitian and imaginary options are not used).
+
+    :param vis: Visibility to be inverted
+    :param im: image template (not changed)
+    :param dopsf: Make the psf instead of the dirty image
+    :param normalize: Normalize by the sum of weights (True)
+    :return: resulting image, sum of weights
+    """
+    if not isinstance(vis, Visibility):
+        svis = coalesce_visibility(vis, **kwargs)
+    else:
+        svis = copy_visibility(vis)
+
+    if dopsf:
+        svis.data['vis'] = numpy.ones_like(svis.data['vis'])
+
+    svis = shift_vis_to_image(svis, im, tangent=True, inverse=False)
+
+    nchan, npol, ny, nx = im.data.shape
+    padding = get_padding(svis, im, **kwargs)
+    spectral_mode, vfrequencymap = get_frequency_map(svis, im)
+    polarisation_mode, vpolarisationmap = get_polarisation_map(svis, im)
+    uvw_mode, shape, padding, vuvwmap = get_uvw_map(svis, im, padding=padding)
+
+    real_dtype, complex_dtype = get_precision_dtypes(kwargs)
+    npad = int(round(padding * nx))
+    field_of_view = npad * abs(im.wcs.wcs.cdelt[0]) * numpy.pi / 180.0
+    subgrid_size = get_parameter(kwargs, "subgrid_size", 32)
+    aterms = get_parameter(kwargs, "aterms", None)
+    aterm_function, vantennas = None, None
+    if aterms is not None:
+        aterm_function = idg_aterm_function(numpy.asarray(aterms, dtype=complex_dtype), im, padding)
+        vantennas = numpy.stack([svis.antenna1, svis.antenna2], axis=1).astype('int')
+
+    imgridpad = numpy.zeros([nchan, npol, int(round(padding * ny)), npad], dtype=complex_dtype)
+    imgridpad, sumwt = subgrid_grid(imgridpad, svis.data['vis'], svis.data['imaging_weight'], vuvwmap,
+                                    vfrequencymap, svis.w, field_of_view, subgrid_size=subgrid_size,
+                                    aterm_function=aterm_function, vantennas=vantennas)
+
+    # Normalise weights for consistency with transform
+    sumwt /= float(padding * npad * ny)
+
+    gcf, _ = get_anti_aliasing(imgridpad.shape[-2:], dtype=complex_dtype)
+    result = extract_mid(numpy.real(ifft(imgridpad, workers=get_parameter(kwargs, "nthreads", None))) * gcf,
+                         npixel=nx)
+    resultimage = create_image_from_array(result.astype(real_dtype, copy=False), im.wcs, im.polarisation_frame)
+    if normalize:
+        resultimage = normalize_sumwt(resultimage, sumwt)
+    return resultimage, sumwt
+
+
+def predict_idg(vis, model: Image, **kwargs):
+    """ Predict using image domain gridding
+
+    The w term, and the A terms if aterms is given, are applied as for invert_idg. Other parameters are as for
+    predict_2d (the kernel and hermitian options are not used).
+
+    :param vis: Visibility to be predicted
+    :param model: model image
+    :return: resulting visibility (in place works)
+    """
+    if isinstance(vis, BlockVisibility):
+        log.debug("predict_idg: coalescing prior to prediction")
+        avis = coalesce_visibility(vis, **kwargs)
+    else:
+        avis = vis
+
+    assert isinstance(avis, Visibility), avis
+
+    _, _, ny, nx = model.data.shape
+    padding = get_padding(avis, model, **kwargs)
+    spectral_mode, vfrequencymap = get_frequency_map(avis, model)
+    polarisation_mode, vpolarisationmap = get_polarisation_map(avis, model)
+    uvw_mode, shape, padding, vuvwmap = get_uvw_map(avis, model, padding=padding)
+
+    _, complex_dtype = get_precision_dtypes(kwargs)
+    npad = int(round(padding * nx))
+    field_of_view = npad * abs(model.wcs.wcs.cdelt[0]) * numpy.pi / 180.0
+    subgrid_size = get_parameter(kwargs, "subgrid_size", 32)
+    aterms = get_parameter(kwargs, "aterms", None)
+    aterm_function, vantennas = None, None
+    if aterms is not None:
+        aterm_function = idg_aterm_function(numpy.asarray(aterms, dtype=complex_dtype), model, padding)
+        vantennas = numpy.stack([avis.antenna1, avis.antenna2], axis=1).astype('int')
+
+    gcf, _ = get_anti_aliasing((int(round(padding * ny)), npad), dtype=complex_dtype)
+    uvgrid = fft((pad_mid(model.data, npad) * gcf).astype(dtype=complex_dtype),
+                 workers=get_parameter(kwargs, "nthreads", None))
+    vis_values = subgrid_degrid(avis.data['vis'].shape, uvgrid, vuvwmap, vfrequencymap, avis.w, field_of_view,
+                                subgrid_size=subgrid_size, aterm_function=aterm_function, vantennas=vantennas)
+    avis.data['vis'] = vis_values
+
+    # Now we can shift the visibility from the image frame to the original visibility frame
+    svis = shift_vis_to_image(avis, model, tangent=True, inverse=True)
+
+    if isinstance(vis, BlockVisibility) and isinstance(svis, Visibility):
+        log.debug("predict_idg: decoalescing post prediction")
+        return decoalesce_visibility(svis)
+    else:
+        return svis
@@ -1,6 +1,9 @@
 """Manages the imaging context. This take a string and returns a dictionary containing:
  * Predict function
  * Invert function
+ * Optional joint dirty image and PSF invert function
+ * Optional invert and predict functions for many frequency windows
+ * Optional fused residual function
  * image_iterator function
  * vis_iterator function
 
@@ -11,13 +14,16 @@ import logging
 import numpy
 
 from data_models.memory_data_models import Visibility, Image
+from data_models.parameters import get_precision_dtypes
 
 from ..image.gather_scatter import image_scatter_facets
 from ..image.operations import create_empty_image_like
 from ..imaging.base import normalize_sumwt
-from ..imaging.base import predict_2d, invert_2d
+from ..imaging.base import predict_2d, invert_2d, invert_2d_dirty_psf, predict_2d_cube, invert_2d_cube, residual_2d
 from ..imaging.timeslice_single import predict_timeslice_single, invert_timeslice_single
 from ..imaging.wstack_single import predict_wstack_single, invert_wstack_single
+from ..imaging.wstack_multi import predict_wstack_multi, invert_wstack_multi
+from ..imaging.idg import predict_idg, invert_idg
 from ..visibility.base import copy_visibility, create_visibility_from_rows
 from ..visibility.coalesce import convert_blockvisibility_to_visibility, convert_visibility_to_blockvisibility
 from ..visibility.iterators import vis_timeslice_iter, vis_null_iter, vis_wslice_iter
@@ -34,15 +40,23 @@ def imaging_contexts():
         image_iterator: Iterator for traversing images
         vis_iterator: Iterator for traversing visibilities
         inner: The innermost axis
+        invert_dirty_psf: Optional function making the dirty image and PSF in one pass (see invert_2d_dirty_psf)
+        invert_cube, predict_cube: Optional functions for a list of frequency windows in one call (see invert_2d_cube)
+        residual: Optional function making the residual visibility and image in one pass (see residual_2d)
     
     :return:
     """
     contexts = {'2d': {'predict': predict_2d,
                        'invert': invert_2d,
+                       'invert_dirty_psf': invert_2d_dirty_psf,
+                       'predict_cube': predict_2d_cube,
+                       'invert_cube': invert_2d_cube,
+                       'residual': residual_2d,
                        'vis_iterator': vis_null_iter,
                        'inner': 'image'},
                 'facets': {'predict': predict_2d,
                            'invert': invert_2d,
+                           'invert_dirty_psf': invert_2d_dirty_psf,
                            'vis_iterator': vis_null_iter,
                            'inner': 'image'},
                 'facets_timeslice': {'predict': predict_timeslice_single,
@@ -60,7 +74,15 @@ def imaging_contexts():
                 'wstack': {'predict': predict_wstack_single,
                            'invert': invert_wstack_single,
                            'vis_iterator': vis_wslice_iter,
-                           'inner': 'image'}}
+                           'inner': 'image'},
+                'wstack_multi': {'predict': predict_wstack_multi,
+                                 'invert': invert_wstack_multi,
+                                 'vis_iterator': vis_null_iter,
+                                 'inner': 'image'},
+                'idg': {'predict': predict_idg,
+                        'invert': invert_idg,
+                        'vis_iterator': vis_null_iter,
+                        'inner': 'image'}}
     
     return contexts
 
@@ -77,6 +99,8 @@ def invert_function(vis, im: Image, dopsf=False, normalize=True, context='2d', i
 
      * 2d: Two-dimensional transform
      * wstack: wstacking with either vis_slices or wstack (spacing between w planes) set
+     * wstack_multi: wstacking of vis_slices w planes in a single pass over the data
+     * idg: image domain gridding, with the w term applied exactly on small subgrids
      * wprojection: w projection with wstep (spacing between w places) set, also kernel='wprojection'
      * timeslice: snapshot imaging with either vis_slices or timeslice set. timeslice='auto' does every time
      * facets: Faceted imaging with facets facets on each axis
@@ -105,15 +129,19 @@ def invert_function(vis, im: Image, dopsf=False, normalize=True, context='2d', i
     else:
         svis = vis
     
-    resultimage = create_empty_image_like(im)
+    # The images have the dtype of the precision used by invert
+    real_dtype, _ = get_precision_dtypes(kwargs)
+    resultimage = create_empty_image_like(im, dtype=real_dtype)
     
     if inner == 'image':
         totalwt = None
+        # One work image is reused for all slices
+        workimage = create_empty_image_like(im, dtype=real_dtype)
         for rows in vis_iter(svis, vis_slices=vis_slices):
             if numpy.sum(rows):
                 visslice = create_visibility_from_rows(svis, rows)
                 sumwt = 0.0
-                workimage = create_empty_image_like(im)
+                workimage.data[...] = 0.0
                 for dpatch in image_scatter_facets(workimage, facets=facets, overlap=overlap, taper=taper):
                     result, sumwt = invert(visslice, dpatch, dopsf, normalize=False, facets=facets,
                                            vis_slices=vis_slices, **kwargs)
@@ -128,7 +156,7 @@ def invert_function(vis, im: Image, dopsf=False, normalize=True, context='2d', i
     else:
         # We assume that the weight is the same for all image iterations
         totalwt = None
-        workimage = create_empty_image_like(im)
+        workimage = create_empty_image_like(im, dtype=real_dtype)
         for dpatch in image_scatter_facets(workimage, facets=facets, overlap=overlap, taper=taper):
             totalwt = None
             for rows in vis_iter(svis, vis_slices=vis_slices):
@@ -151,12 +179,141 @@ def invert_function(vis, im: Image, dopsf=False, normalize=True, context='2d', i
     return resultimage, totalwt
 
 
+def invert_dirty_psf_function(vis, im: Image, normalize=True, context='2d', vis_slices=1, facets=1, overlap=0,
+                              taper=None, **kwargs):
+    """ Invert to make both the dirty image and the PSF using algorithm specified by context
+
+    For contexts with an invert_dirty_psf function ('2d' and 'facets'), each slice and facet of the data is gridded
+    once for both images, sharing the grid coordinates, kernels and FFT (see invert_2d_dirty_psf). For the other
+    contexts, invert_function is called twice. The parameters are as for invert_function.
+
+    :param vis:
+    :param im:
+    :param normalize: Normalize by the sum of weights (True)
+    :param context: Imaging context e.g. '2d', 'timeslice', etc.
+    :param kwargs:
+    :return: (dirty image, sum of weights), (psf, sum of weights)
+    """
+    c = imaging_context(context)
+    invert_dirty_psf = c.get('invert_dirty_psf', None)
+    if invert_dirty_psf is None:
+        dirty = invert_function(vis, im, dopsf=False, normalize=normalize, context=context, vis_slices=vis_slices,
+                                facets=facets, overlap=overlap, taper=taper, **kwargs)
+        psf = invert_function(vis, im, dopsf=True, normalize=normalize, context=context, vis_slices=vis_slices,
+                              facets=facets, overlap=overlap, taper=taper, **kwargs)
+        return dirty, psf
+    
+    vis_iter = c['vis_iterator']
+    
+    if not isinstance(vis, Visibility):
+        svis = convert_blockvisibility_to_visibility(vis)
+    else:
+        svis = vis
+    
+    real_dtype, _ = get_precision_dtypes(kwargs)
+    dirtyimage = create_empty_image_like(im, dtype=real_dtype)
+    psfimage = create_empty_image_like(im, dtype=real_dtype)
+    totalwt = None
+    dirtywork = create_empty_image_like(im, dtype=real_dtype)
+    psfwork = create_empty_image_like(im, dtype=real_dtype)
+    for rows in vis_iter(svis, vis_slices=vis_slices):
+        if numpy.sum(rows):
+            visslice = create_visibility_from_rows(svis, rows)
+            sumwt = 0.0
+            dirtywork.data[...] = 0.0
+            psfwork.data[...] = 0.0
+            for dpatch, ppatch in zip(image_scatter_facets(dirtywork, facets=facets, overlap=overlap, taper=taper),
+                                      image_scatter_facets(psfwork, facets=facets, overlap=overlap, taper=taper)):
+                (dresult, sumwt), (presult, _) = invert_dirty_psf(visslice, dpatch, normalize=False, facets=facets,
+                                                                  vis_slices=vis_slices, **kwargs)
+                dpatch.data[...] = dresult.data[...]
+                ppatch.data[...] = presult.data[...]
+            # Assume that sumwt is the same for all patches
+            if totalwt is None:
+                totalwt = sumwt
+            else:
+                totalwt += sumwt
+            dirtyimage.data += dirtywork.data
+            psfimage.data += psfwork.data
+    
+    assert totalwt is not None, "No valid data found for imaging"
+    if normalize:
+        dirtyimage = normalize_sumwt(dirtyimage, totalwt)
+        psfimage = normalize_sumwt(psfimage, totalwt)
+    
+    return (dirtyimage, totalwt), (psfimage, totalwt.copy())
+
+
+def residual_function(vis, model: Image, normalize=True, context='2d', vis_slices=1, facets=1, overlap=0,
+                      taper=None, residual=None, **kwargs):
+    """ Calculate the residual visibility and residual image using algorithm specified by context
+
+    For contexts with a residual function ('2d'), and no facets, each slice of the data is degridded, subtracted and
+    gridded in one pass (see residual_2d). Otherwise the model is predicted by predict_function, subtracted, and the
+    residual inverted by invert_function. The parameters are as for invert_function.
+
+    :param vis:
+    :param model: Model image, also used as the template of the residual image
+    :param normalize: Normalize by the sum of weights (True)
+    :param context: Imaging context e.g. '2d', 'timeslice', etc.
+    :param residual: Visibility like vis to hold the residual, e.g. from the previous major cycle (default new)
+    :param kwargs:
+    :return: residual visibility, residual image, sum of weights
+    """
+    c = imaging_context(context)
+    residual_slice = c.get('residual', None)
+    if residual is None:
+        residual = copy_visibility(vis)
+    
+    if residual_slice is None or facets != 1:
+        vispred = predict_function(copy_visibility(vis, zero=True), model, context=context, vis_slices=vis_slices,
+                                   facets=facets, overlap=overlap, taper=taper, **kwargs)
+        residual.data['vis'][...] = vis.data['vis'] - vispred.data['vis']
+        dirty, sumwt = invert_function(residual, model, dopsf=False, normalize=normalize, context=context,
+                                       vis_slices=vis_slices, facets=facets, overlap=overlap, taper=taper, **kwargs)
+        return residual, dirty, sumwt
+    
+    vis_iter = c['vis_iterator']
+    
+    if not isinstance(vis, Visibility):
+        svis = convert_blockvisibility_to_visibility(vis)
+        sres = convert_blockvisibility_to_visibility(residual)
+    else:
+        svis = vis
+        sres = residual
+    
+    dirty = create_empty_image_like(model, dtype=get_precision_dtypes(kwargs)[0])
+    totalwt = None
+    for rows in vis_iter(svis, vis_slices=vis_slices):
+        if numpy.sum(rows):
+            visslice = create_visibility_from_rows(svis, rows)
+            resslice, result, sumwt = residual_slice(visslice, model, normalize=False, vis_slices=vis_slices,
+                                                     **kwargs)
+            sres.data['vis'][rows] = resslice.data['vis']
+            if totalwt is None:
+                totalwt = sumwt
+            else:
+                totalwt += sumwt
+            dirty.data += result.data
+    
+    assert totalwt is not None, "No valid data found for imaging"
+    if normalize:
+        dirty = normalize_sumwt(dirty, totalwt)
+    
+    if not isinstance(vis, Visibility):
+        residual = convert_visibility_to_blockvisibility(sres)
+    
+    return residual, dirty, totalwt
+
+
 def predict_function(vis, model: Image, context='2d', inner=None, vis_slices=1, facets=1, overlap=0, taper=None,
                      **kwargs) -> Visibility:
     """Predict visibilities using algorithm specified by context
     
      * 2d: Two-dimensional transform
      * wstack: wstacking with either vis_slices or wstack (spacing between w planes) set
+     * wstack_multi: wstacking of vis_slices w planes in a single pass over the data
+     * idg: image domain gridding, with the w term applied exactly on small subgrids
      * wprojection: w projection with wstep (spacing between w places) set, also kernel='wprojection'
      * timeslice: snapshot imaging with either vis_slices or timeslice set. timeslice='auto' does every time
      * facets: Faceted imaging with facets facets on each axis
@@ -194,7 +351,7 @@ def predict_function(vis, model: Image, context='2d', inner=None, vis_slices=1,
                 visslice.data['vis'][...] = 0.0
                 for dpatch in image_scatter_facets(model, facets=facets, overlap=overlap, taper=taper):
                     result.data['vis'][...] = 0.0
-                    result = predict(visslice, dpatch, **kwargs)
+                    result = predict(visslice, dpatch, vis_slices=vis_slices, **kwargs)
                     svis.data['vis'][rows] += result.data['vis']
     else:
         for dpatch in image_scatter_facets(model, facets=facets, overlap=overlap, taper=taper):
@@ -202,7 +359,7 @@ def predict_function(vis, model: Image, context='2d', inner=None, vis_slices=1,
                 if numpy.sum(rows):
                     visslice = create_visibility_from_rows(svis, rows)
                     result.data['vis'][...] = 0.0
-                    result = predict(visslice, dpatch, **kwargs)
+                    result = predict(visslice, dpatch, vis_slices=vis_slices, **kwargs)
                     svis.data['vis'][rows] += result.data['vis']
 
     if not isinstance(vis, Visibility):
@@ -21,12 +21,19 @@ Ignoring changes in the normalisation term, we have:
 
     V(u,v,w) =\\int \\frac{ I(l',m')} { \\sqrt{1-l'^2-m'^2}} e^{-2 \\pi j (ul'+um')} dl' dm'
 
+The image is resampled between the nominal and distorted coordinates by cubic spline interpolation at pixel
+coordinates that depend only on the fitted plane and the image geometry. These maps are calculated once per time
+slice and held in the process-wide timeslice_cache, so that later major cycles reuse them. timeslice_resample='griddata'
+selects the cubic interpolation by scipy griddata instead, which triangulates the image for every plane.
 
 """
 import numpy
 from scipy.interpolate import griddata
+from scipy.ndimage import map_coordinates
 
 from data_models.memory_data_models import Visibility, Image
+from data_models.parameters import get_parameter
+from libs.util.array_cache import ArrayCache
 
 from ..image.operations import copy_image, create_empty_image_like
 
@@ -38,6 +45,17 @@ import logging
 
 log = logging.getLogger(__name__)
 
+# Process-wide cache of the resampling maps of time slices, shared by all imaging calls in e.g. a Dask worker
+timeslice_cache = ArrayCache(max_bytes=2 ** 30, name='timeslice_cache')
+
+
+def set_timeslice_cache_size(max_bytes):
+    """ Set the memory cap of the process-wide cache of time slice resampling maps, discarding entries as needed
+
+    :param max_bytes: Maximum total size of cached maps (bytes)
+    """
+    timeslice_cache.resize(max_bytes)
+
 
 def fit_uvwplane_only(vis: Visibility) -> (float, float):
     """ Fit the best fitting plane p u + q v = w
@@ -106,19 +124,26 @@ def predict_timeslice_single(vis: Visibility, model: Image, predict=predict_2d,
     # from nominal to distorted before predicting.
     workimage = copy_image(model)
     
-    # Use griddata to do the conversion. This could be improved. Only cubic is possible in griddata.
-    # The interpolation is ok for invert since the image is smooth but for clean images the
-    # interpolation is particularly poor, leading to speckle in the residual image.
-    lnominal, mnominal, ldistorted, mdistorted = lm_distortion(model, -p, -q)
-    for chan in range(inchan):
-        for pol in range(inpol):
-            workimage.data[chan, pol, ...] = \
-                griddata((mnominal.flatten(), lnominal.flatten()),
-                         values=workimage.data[chan, pol, ...].flatten(),
-                         xi=(mdistorted.flatten(), ldistorted.flatten()),
-                         method='cubic',
-                         fill_value=0.0,
-                         rescale=True).reshape(workimage.data[chan, pol, ...].shape)
+    # Convert the model from nominal to distorted coordinates
+    interpolation = get_parameter(kwargs, "timeslice_resample", "spline")
+    if interpolation == 'spline':
+        coords = get_lm_resampling_map(model, -p, -q, inverse=False)
+        resample_image_planes(model.data, coords, out=workimage.data)
+    elif interpolation == 'griddata':
+        # Only cubic is possible in griddata. The interpolation is ok for invert since the image is smooth but
+        # for clean images the interpolation is particularly poor, leading to speckle in the residual image.
+        lnominal, mnominal, ldistorted, mdistorted = lm_distortion(model, -p, -q)
+        for chan in range(inchan):
+            for pol in range(inpol):
+                workimage.data[chan, pol, ...] = \
+                    griddata((mnominal.flatten(), lnominal.flatten()),
+                             values=workimage.data[chan, pol, ...].flatten(),
+                             xi=(mdistorted.flatten(), ldistorted.flatten()),
+                             method='cubic',
+                             fill_value=0.0,
+                             rescale=True).reshape(workimage.data[chan, pol, ...].shape)
+    else:
+        raise ValueError("Unknown timeslice_resample %s" % interpolation)
 
     avis = predict(avis, workimage, facets=facets, vis_slices=vis_slices, **kwargs)
     
@@ -152,6 +177,65 @@ def lm_distortion(im: Image, a, b) -> (numpy.ndarray, numpy.ndarray, numpy.ndarr
     return l2d, m2d, ldistorted, mdistorted
 
 
+def get_lm_resampling_map(im: Image, a, b, inverse=False, niter=10) -> numpy.ndarray:
+    """ Get the pixel coordinates at which to resample an image between nominal and distorted coordinates
+
+    The distortion for w = au + bv maps nominal (l, m) to (l + a (n - 1), m + b (n - 1)), see lm_distortion. For
+    inverse=False the map gives, for each pixel, the pixel of the nominal image at its distorted coordinates, as
+    used by predict. For inverse=True it gives the pixel of the distorted image at its nominal coordinates, as used
+    by invert, found by fixed point iteration.
+
+    The map depends only on a, b and the image geometry, and is held in the process-wide timeslice_cache.
+
+    :param im: Image with the coordinate system
+    :param a, b: parameters in fit
+    :param inverse: Map from distorted to nominal coordinates
+    :param niter: Number of iterations for the inverse map
+    :return: read-only pixel coordinates [2, ny, nx] (row, column) for scipy.ndimage.map_coordinates
+    """
+    ny, nx = im.shape[2], im.shape[3]
+    key = ('timeslice', ny, nx, tuple(im.wcs.wcs.crpix[:2]), tuple(im.wcs.wcs.cdelt[:2]), float(a), float(b),
+           inverse, niter)
+    
+    def calculate():
+        cy = im.wcs.wcs.crpix[1] - 1
+        cx = im.wcs.wcs.crpix[0] - 1
+        dy = im.wcs.wcs.cdelt[1] * (numpy.pi / 180.0)
+        dx = im.wcs.wcs.cdelt[0] * (numpy.pi / 180.0)
+        lnominal, mnominal, ldistorted, mdistorted = lm_distortion(im, a, b)
+        if inverse:
+            # Solve l + a (n(l, m) - 1) = lnominal and m + b (n(l, m) - 1) = mnominal for l, m
+            l, m = lnominal, mnominal
+            for i in range(niter):
+                dn = numpy.sqrt(1.0 - (l * l + m * m)) - 1.0
+                l = lnominal - a * dn
+                m = mnominal - b * dn
+        else:
+            l, m = ldistorted, mdistorted
+        return numpy.array([m / dy + cy, l / dx + cx])
+    
+    return timeslice_cache.get(key, calculate)
+
+
+def resample_image_planes(data, coords, out=None) -> numpy.ndarray:
+    """ Resample every channel and polarisation plane of an image at the given pixel coordinates
+
+    Cubic spline interpolation is used, with zero outside the image.
+
+    :param data: Image data [nchan, npol, ny, nx]
+    :param coords: pixel coordinates [2, ny, nx], see get_lm_resampling_map
+    :param out: Array to hold the result (default new)
+    :return: resampled data [nchan, npol, ny, nx]
+    """
+    if out is None:
+        out = numpy.zeros_like(data)
+    inchan, inpol = data.shape[:2]
+    for chan in range(inchan):
+        for pol in range(inpol):
+            map_coordinates(data[chan, pol], coords, output=out[chan, pol], order=3, mode='constant', cval=0.0)
+    return out
+
+
 def invert_timeslice_single(vis: Visibility, im: Image, dopsf, normalize=True, facets=1, vis_slices=1, **kwargs) -> (
         Image, numpy.ndarray):
     """Process single time slice
@@ -178,21 +262,24 @@ def invert_timeslice_single(vis: Visibility, im: Image, dopsf, normalize=True, f
 
     finalimage = create_empty_image_like(im)
     
-    # Use griddata to do the conversion. This could be improved. Only cubic is possible in griddata.
-    # The interpolation is ok for invert since the image is smooth.
-    
-    # Calculate nominal and distorted coordinates. The image is in distorted coordinates so we
-    # need to convert back to nominal
-    lnominal, mnominal, ldistorted, mdistorted = lm_distortion(workimage, -p, -q)
-
-    for chan in range(inchan):
-        for pol in range(inpol):
-            finalimage.data[chan, pol, ...] = \
-                griddata((mdistorted.flatten(), ldistorted.flatten()),
-                         values=workimage.data[chan, pol, ...].flatten(),
-                         method='cubic',
-                         xi=(mnominal.flatten(), lnominal.flatten()),
-                         fill_value=0.0,
-                         rescale=True).reshape(finalimage.data[chan, pol, ...].shape)
+    # The image is in distorted coordinates so we need to convert back to nominal
+    interpolation = get_parameter(kwargs, "timeslice_resample", "spline")
+    if interpolation == 'spline':
+        coords = get_lm_resampling_map(workimage, -p, -q, inverse=True)
+        resample_image_planes(workimage.data, coords, out=finalimage.data)
+    elif interpolation == 'griddata':
+        # Only cubic is possible in griddata. The interpolation is ok for invert since the image is smooth.
+        lnominal, mnominal, ldistorted, mdistorted = lm_distortion(workimage, -p, -q)
+        for chan in range(inchan):
+            for pol in range(inpol):
+                finalimage.data[chan, pol, ...] = \
+                    griddata((mdistorted.flatten(), ldistorted.flatten()),
+                             values=workimage.data[chan, pol, ...].flatten(),
+                             method='cubic',
+                             xi=(mnominal.flatten(), lnominal.flatten()),
+                             fill_value=0.0,
+                             rescale=True).reshape(finalimage.data[chan, pol, ...].shape)
+    else:
+        raise ValueError("Unknown timeslice_resample %s" % interpolation)
     
     return finalimage, sumwt
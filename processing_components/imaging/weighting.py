@@ -13,7 +13,7 @@ from libs.util.array_functions import tukey_filter
 from data_models.memory_data_models import Visibility, Image
 from data_models.parameters import get_parameter
 
-from libs.fourier_transforms.convolutional_gridding import weight_gridding
+from libs.fourier_transforms.convolutional_gridding import weight_gridding, weight_density
 from libs.imaging.imaging_params import get_polarisation_map, get_uvw_map
 from libs.imaging.imaging_params import get_frequency_map
 
@@ -28,11 +28,17 @@ def weight_visibility(vis: Visibility, im: Image, **kwargs) -> Visibility:
         - Uniform: weight of sample divided by sum of weights in cell (optimum for sidelobes)
         - Super-uniform: As uniform, by sum of weights is over extended box region
         - Briggs: Compromise between natural and uniform
-        - Super-briggs: As Briggs, by sum of weights is over extended box region
+
+    The density of weights may be supplied as densitygrid, for example summed over many partitions of the data
+    using weight_density_visibility. Otherwise it is calculated from vis alone.
 
     :param vis:
     :param im:
-    :return: visibility with imaging_weights column added and filled
+    :param weighting: 'natural' | 'uniform' | 'briggs' | 'super_uniform' ('uniform')
+    :param robustness: Briggs robustness parameter (0.0)
+    :param super_uniform_box: Width of box in grid cells for super uniform weighting (3)
+    :param densitygrid: Gridded density of weights to use (numpy array with the shape of im)
+    :return: visibility with imaging_weights column added and filled, density, densitygrid
     """
     assert isinstance(vis, Visibility), "vis is not a Visibility: %r" % vis
     
@@ -41,16 +47,37 @@ def weight_visibility(vis: Visibility, im: Image, **kwargs) -> Visibility:
     polarisation_mode, vpolarisationmap = get_polarisation_map(vis, im)
     uvw_mode, shape, padding, vuvwmap = get_uvw_map(vis, im)
     
-    density = None
-    densitygrid = None
-    
     weighting = get_parameter(kwargs, "weighting", "uniform")
-    vis.data['imaging_weight'], density, densitygrid = weight_gridding(im.data.shape, vis.data['weight'], vuvwmap,
-                                                                       vfrequencymap, vpolarisationmap, weighting)
+    gridder = get_parameter(kwargs, "gridder", "numpy")
+    vis.data['imaging_weight'], density, densitygrid = \
+        weight_gridding(im.data.shape, vis.data['weight'], vuvwmap, vfrequencymap, vpolarisationmap, weighting,
+                        gridder, robustness=get_parameter(kwargs, "robustness", 0.0),
+                        super_uniform_box=get_parameter(kwargs, "super_uniform_box", 3),
+                        densitygrid=get_parameter(kwargs, "densitygrid", None))
     
     return vis, density, densitygrid
 
 
+def weight_density_visibility(vis: Visibility, im: Image, **kwargs) -> numpy.ndarray:
+    """ Grid the density of the visibility weights, for use by weight_visibility
+
+    Densities from several partitions of the data (e.g. time or frequency) imaged onto the same grid may be added
+    so that weighting can use the density of all of the data.
+
+    :param vis:
+    :param im:
+    :param gridder: Engine 'numpy' | 'numba' | 'python'
+    :return: densitygrid (numpy array with the shape of im)
+    """
+    assert isinstance(vis, Visibility), "vis is not a Visibility: %r" % vis
+    
+    spectral_mode, vfrequencymap = get_frequency_map(vis, im)
+    uvw_mode, shape, padding, vuvwmap = get_uvw_map(vis, im)
+    _, densitygrid = weight_density(im.data.shape, vis.data['weight'], vuvwmap, vfrequencymap,
+                                    get_parameter(kwargs, "gridder", "numpy"))
+    return densitygrid
+
+
 def taper_visibility_gaussian(vis: Visibility, beam=None) -> Visibility:
     """ Taper the visibility weights
 
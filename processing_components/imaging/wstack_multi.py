@@ -0,0 +1,220 @@
+"""
+W-stacking of all w planes in a single pass over the visibility data. The measurement equation is approximated as
+for :mod:`processing_components.imaging.wstack_single`:
+
+.. math::
+
+    V(u,v,w) =\\sum_i \\int \\frac{ I(l,m) e^{-2 \\pi j (w_i(\\sqrt{1-l^2-m^2}-1))})}{\\sqrt{1-l^2-m^2}} e^{-2 \\pi j (ul+vm)} dl dm
+
+but instead of slicing the visibility once per w plane, the rows are sorted by w plane once and each plane is
+gridded or degridded from a contiguous range of the sorted rows. The w planes are equally spaced, so the w screen
+of each plane is found from the previous one by multiplying by the screen for one step in w. The complex screen is
+applied to the image in one pass, and the image is accumulated in place.
+
+The planes are at the same w values as the slices made by vis_wslice_iter, and the result summed over the planes
+matches the 'wstack' imaging context with the same vis_slices.
+"""
+
+import logging
+
+import numpy
+
+from data_models.memory_data_models import Visibility, BlockVisibility, Image
+from data_models.parameters import get_parameter, get_precision_dtypes
+
+from libs.fourier_transforms.convolutional_gridding import convolutional_grid, convolutional_degrid, w_beam
+from libs.fourier_transforms.fft_support import fft, ifft, extract_mid
+from libs.image.operations import create_image_from_array
+from libs.imaging.imaging_params import get_frequency_map, get_polarisation_map, get_uvw_map, get_kernel_list, \
+    get_padding
+
+from ..imaging.base import shift_vis_to_image, normalize_sumwt
+from ..visibility.base import copy_visibility
+from ..visibility.coalesce import coalesce_visibility, decoalesce_visibility
+
+log = logging.getLogger(__name__)
+
+
+def w_planes(vis: Visibility, vis_slices=1):
+    """ Assign each row of a visibility to the nearest of vis_slices equally spaced w planes
+
+    The planes are at the centres of the slices of vis_wslice_iter.
+
+    :param vis: Visibility
+    :param vis_slices: Number of w planes
+    :return: w of first plane, spacing of planes, plane index of each row, row order sorted by plane, start of
+        each plane in the sorted rows [vis_slices + 1]
+    """
+    assert isinstance(vis, Visibility), vis
+    wmaxabs = numpy.max(numpy.abs(vis.w))
+    if vis_slices > 1 and wmaxabs > 0.0:
+        w0 = -wmaxabs
+        wstep = 2.0 * wmaxabs / (vis_slices - 1)
+        plane = numpy.clip(numpy.round((vis.w - w0) / wstep).astype('int'), 0, vis_slices - 1)
+    else:
+        w0, wstep = 0.0, 0.0
+        plane = numpy.zeros(vis.nvis, dtype='int')
+    order = numpy.argsort(plane, kind='stable')
+    starts = numpy.searchsorted(plane[order], numpy.arange(vis_slices + 1))
+    return w0, wstep, plane, order, starts
+
+
+def w_screen_stepper(im: Image, w0, wstep, dtype='complex'):
+    """ Generate the w screens (see create_w_term_like) for w0, w0 + wstep, w0 + 2 * wstep, ...
+
+    Only two screens are calculated directly: the first, and the screen for wstep, by which each screen is multiplied
+    to get the next.
+
+    :param im: Image template
+    :param w0: w of first screen
+    :param wstep: step in w between screens
+    :param dtype: Complex dtype of screens
+    :return: generator of screens [ny, nx]
+    """
+    cellsize = abs(im.wcs.wcs.cdelt[0]) * numpy.pi / 180.0
+    npixel = im.shape[3]
+    wcentre = [im.wcs.wcs.crpix[0] - 1.0, im.wcs.wcs.crpix[1] - 1.0]
+    screen = w_beam(npixel, npixel * cellsize, w=w0, cx=wcentre[0], cy=wcentre[1]).astype(dtype)
+    step = w_beam(npixel, npixel * cellsize, w=wstep, cx=wcentre[0], cy=wcentre[1]).astype(dtype)
+    while True:
+        yield screen
+        screen *= step
+
+
+def invert_wstack_multi(vis: Visibility, im: Image, dopsf=False, normalize=True, vis_slices=1, **kwargs) \
+        -> (Image, numpy.ndarray):
+    """ Invert using w stacking over vis_slices w planes in a single pass
+
+    Each plane is gridded, transformed and multiplied by its w screen, and the image is accumulated. Other
+    parameters are as for invert_2d (the hermitian option is not used).
+
+    :param vis: Visibility to be inverted
+    :param im: image template (not changed)
+    :param dopsf: Make the psf instead of the dirty image
+    :param normalize: Normalize by the sum of weights (True)
+    :param vis_slices: Number of w planes
+    :return: resulting image, sum of weights
+    """
+    if not isinstance(vis, Visibility):
+        svis = coalesce_visibility(vis, **kwargs)
+    else:
+        svis = copy_visibility(vis)
+
+    if dopsf:
+        svis.data['vis'] = numpy.ones_like(svis.data['vis'])
+
+    w0, wstep, plane, order, starts = w_planes(svis, vis_slices)
+    log.debug("invert_wstack_multi: gridding %d w planes" % vis_slices)
+    # Remove the w of each plane, in case we want to do w projection
+    svis.data['uvw'][..., 2] -= w0 + wstep * plane
+    svis = shift_vis_to_image(svis, im, tangent=True, inverse=False)
+
+    nchan, npol, ny, nx = im.data.shape
+    padding = get_padding(svis, im, **kwargs)
+    spectral_mode, vfrequencymap = get_frequency_map(svis, im)
+    polarisation_mode, vpolarisationmap = get_polarisation_map(svis, im)
+    uvw_mode, shape, padding, vuvwmap = get_uvw_map(svis, im, padding=padding)
+    kernel_name, gcf, vkernellist = get_kernel_list(svis, im, **kwargs)
+
+    # Sort once by plane so that each plane is a contiguous range of rows
+    kernel_indices = vkernellist[0][order]
+    visdata = svis.data['vis'][order]
+    visweights = svis.data['imaging_weight'][order]
+    vuvwmap = vuvwmap[order]
+    vfrequencymap = numpy.array(vfrequencymap)[order]
+
+    _, complex_dtype = get_precision_dtypes(kwargs)
+    gridder = get_parameter(kwargs, "gridder", "numpy")
+    nthreads = get_parameter(kwargs, "nthreads", 1)
+    fft_workers = get_parameter(kwargs, "nthreads", None)
+    imgridpad = numpy.zeros([nchan, npol, int(round(padding * ny)), int(round(padding * nx))], dtype=complex_dtype)
+    result = numpy.zeros([nchan, npol, ny, nx], dtype=complex_dtype)
+    sumwt = numpy.zeros([nchan, npol])
+
+    screens = w_screen_stepper(im, w0, wstep, dtype=complex_dtype)
+    for iplane in range(vis_slices):
+        screen = next(screens)
+        rows = slice(starts[iplane], starts[iplane + 1])
+        if starts[iplane + 1] > starts[iplane]:
+            imgridpad[...] = 0.0
+            imgridpad, planewt = convolutional_grid((kernel_indices[rows], vkernellist[1]), imgridpad,
+                                                    visdata[rows], visweights[rows], vuvwmap[rows],
+                                                    vfrequencymap[rows], gridder=gridder, nthreads=nthreads)
+            sumwt += planewt
+            result += screen * extract_mid(ifft(imgridpad, workers=fft_workers), npixel=nx)
+
+    # Normalise weights for consistency with transform
+    sumwt /= float(padding * int(round(padding * nx)) * ny)
+
+    resultimage = create_image_from_array(result.real * extract_mid(gcf, npixel=nx), im.wcs, im.polarisation_frame)
+    if normalize:
+        resultimage = normalize_sumwt(resultimage, sumwt)
+    return resultimage, sumwt
+
+
+def predict_wstack_multi(vis, model: Image, vis_slices=1, **kwargs):
+    """ Predict using w stacking over vis_slices w planes in a single pass
+
+    For each plane, the model is multiplied by the conjugate of its w screen, transformed and degridded in one pass.
+    Other parameters are as for predict_2d (the hermitian option is not used).
+
+    :param vis: Visibility to be predicted
+    :param model: model image
+    :param vis_slices: Number of w planes
+    :return: resulting visibility (in place works)
+    """
+    if isinstance(vis, BlockVisibility):
+        log.debug("predict_wstack_multi: coalescing prior to prediction")
+        avis = coalesce_visibility(vis, **kwargs)
+    else:
+        avis = vis
+
+    assert isinstance(avis, Visibility), avis
+
+    kvis = copy_visibility(avis)
+    w0, wstep, plane, order, starts = w_planes(kvis, vis_slices)
+    log.debug("predict_wstack_multi: degridding %d w planes" % vis_slices)
+    kvis.data['uvw'][..., 2] -= w0 + wstep * plane
+
+    _, _, ny, nx = model.data.shape
+    padding = get_padding(kvis, model, **kwargs)
+    spectral_mode, vfrequencymap = get_frequency_map(kvis, model)
+    polarisation_mode, vpolarisationmap = get_polarisation_map(kvis, model)
+    uvw_mode, shape, padding, vuvwmap = get_uvw_map(kvis, model, padding=padding)
+    kernel_name, gcf, vkernellist = get_kernel_list(kvis, model, **kwargs)
+
+    kernel_indices = vkernellist[0][order]
+    vuvwmap = vuvwmap[order]
+    vfrequencymap = numpy.array(vfrequencymap)[order]
+    vis_values = numpy.zeros(avis.data['vis'].shape, dtype=avis.data['vis'].dtype)
+
+    _, complex_dtype = get_precision_dtypes(kwargs)
+    gridder = get_parameter(kwargs, "gridder", "numpy")
+    fft_workers = get_parameter(kwargs, "nthreads", None)
+
+    # Only the unpadded centre of the padded image changes from plane to plane
+    npad = int(round(padding * nx))
+    workimage = numpy.zeros(list(model.data.shape[:2]) + [npad, npad], dtype=complex_dtype)
+    centre = extract_mid(workimage, npixel=nx)
+    modelgcf = model.data * extract_mid(gcf, npixel=nx)
+
+    screens = w_screen_stepper(model, -w0, -wstep, dtype=complex_dtype)
+    for iplane in range(vis_slices):
+        screen = next(screens)
+        rows = slice(starts[iplane], starts[iplane + 1])
+        if starts[iplane + 1] > starts[iplane]:
+            numpy.multiply(modelgcf, screen, out=centre)
+            uvgrid = fft(workimage, workers=fft_workers)
+            vshape = [starts[iplane + 1] - starts[iplane]] + list(vis_values.shape[1:])
+            vis_values[order[rows]] = convolutional_degrid((kernel_indices[rows], vkernellist[1]), vshape, uvgrid,
+                                                           vuvwmap[rows], vfrequencymap[rows], gridder=gridder)
+
+    avis.data['vis'] = vis_values
+    # The shift uses the original w of each row
+    svis = shift_vis_to_image(avis, model, tangent=True, inverse=True)
+
+    if isinstance(vis, BlockVisibility) and isinstance(svis, Visibility):
+        log.debug("predict_wstack_multi: decoalescing post prediction")
+        return decoalesce_visibility(svis)
+    else:
+        return svis
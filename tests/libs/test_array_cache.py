@@ -0,0 +1,83 @@
+""" Unit libs for the array cache
+
+
+"""
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from libs.imaging.imaging_params import get_anti_aliasing, kernel_cache
+from libs.fourier_transforms.convolutional_gridding import anti_aliasing_calculate
+from libs.util.array_cache import ArrayCache
+
+
+class TestArrayCache(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = ArrayCache(max_bytes=10000)
+        calls = []
+        
+        def compute(n):
+            calls.append(n)
+            return numpy.ones([n])
+        
+        a = cache.get(('ones', 10), compute, 10)
+        b = cache.get(('ones', 10), compute, 10)
+        assert a is b
+        assert calls == [10]
+        assert cache.stats()['hits'] == 1
+        assert cache.stats()['misses'] == 1
+        assert cache.nbytes == a.nbytes
+        with self.assertRaises(ValueError):
+            a[0] = 2.0
+    
+    def test_eviction(self):
+        cache = ArrayCache(max_bytes=2000)
+        for n in range(4):
+            cache.get(n, numpy.zeros, [100])
+        assert len(cache) == 2
+        assert 2 in cache and 3 in cache
+        cache.get(2, numpy.zeros, [100])
+        cache.get(4, numpy.zeros, [100])
+        assert 2 in cache and 4 in cache and 3 not in cache
+        cache.get(5, numpy.zeros, [1000])
+        assert 5 not in cache
+        cache.resize(800)
+        assert len(cache) == 1 and 4 in cache
+        assert cache.nbytes == 800
+        cache.clear()
+        assert len(cache) == 0 and cache.nbytes == 0
+    
+    def test_get_persistent(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = ArrayCache(max_bytes=10000)
+            a = cache.get_persistent(('linspace', 0.0, 1.0, 11), directory, numpy.linspace, 0.0, 1.0, 11)
+            assert cache.get_persistent(('linspace', 0.0, 1.0, 11), directory, numpy.linspace, 0.0, 1.0, 11) is a
+            
+            def fail():
+                raise AssertionError("should be loaded from the cache directory")
+            
+            b = ArrayCache().get_persistent(('linspace', 0.0, 1.0, 11), directory, fail)
+            numpy.testing.assert_array_equal(a, b)
+            assert not b.flags.writeable
+        finally:
+            shutil.rmtree(directory)
+    
+    def test_get_anti_aliasing(self):
+        kernel_cache.clear()
+        gcf, kernel = get_anti_aliasing((128, 128), 8)
+        gcf_cached, kernel_cached = get_anti_aliasing((128, 128), 8)
+        assert kernel_cached is kernel
+        assert kernel_cache.hits == 1 and kernel_cache.misses == 1
+        gcf_calc, kernel_calc = anti_aliasing_calculate((128, 128), 8)
+        numpy.testing.assert_array_equal(gcf, gcf_calc)
+        numpy.testing.assert_array_equal(kernel, kernel_calc)
+        _, kernel64 = get_anti_aliasing((128, 128), 8, dtype='complex64')
+        assert kernel64.dtype == numpy.complex64
+        assert kernel_cache.misses == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+""" Unit libs for the buffer pool
+
+
+"""
+import unittest
+import weakref
+
+import numpy
+
+from libs.util.buffer_pool import BufferPool
+
+
+class TestBufferPool(unittest.TestCase):
+    def test_reuse(self):
+        pool = BufferPool(max_bytes=10000)
+        a = pool.get([10, 10], 'complex', zero=True)
+        assert a.shape == (10, 10) and a.dtype == numpy.complex128
+        assert numpy.all(a == 0.0)
+        a[...] = 1.0
+        pool.release(a)
+        b = pool.get([10, 10], 'complex', zero=True)
+        assert b is a
+        assert numpy.all(b == 0.0)
+        # A different shape or dtype is a new array
+        c = pool.get([10, 10], 'float')
+        d = pool.get([5, 20], 'complex')
+        assert c is not b and d is not b
+        stats = pool.stats()
+        assert stats['reuses'] == 1
+        assert stats['allocations'] == 3
+        assert stats['allocated_bytes'] == 1600 + 800 + 1600
+        assert stats['in_use_bytes'] == 4000
+        assert stats['peak_bytes'] == 4000
+        for x in [b, c, d]:
+            pool.release(x)
+        assert pool.stats()['in_use_bytes'] == 0
+        assert pool.nbytes == 4000
+        # Releasing twice, or an array from elsewhere, does nothing
+        pool.release(d)
+        pool.release(numpy.zeros([10, 10]))
+        assert pool.nbytes == 4000
+    
+    def test_borrow(self):
+        pool = BufferPool()
+        with pool.borrow([100], 'float') as a:
+            assert pool.stats()['in_use_bytes'] == 800
+        with pool.borrow([100], 'float') as b:
+            assert b is a
+        assert pool.stats()['allocations'] == 1
+        # The array is given back even if the block raises
+        with self.assertRaises(RuntimeError):
+            with pool.borrow([100], 'float'):
+                raise RuntimeError("error in block")
+        assert pool.stats()['in_use_bytes'] == 0
+        assert pool.get([100], 'float') is a
+    
+    def test_in_use_reference(self):
+        # The pool holds arrays in use, so that a dropped array cannot be confused with a new one of the same id
+        pool = BufferPool()
+        a = pool.get([100], 'float')
+        ref = weakref.ref(a)
+        del a
+        assert ref() is not None
+        pool.release(ref())
+        assert pool.stats()['in_use_bytes'] == 0
+    
+    def test_eviction(self):
+        pool = BufferPool(max_bytes=2000)
+        arrays = [pool.get([100], 'float') for _ in range(4)]
+        for a in arrays:
+            pool.release(a)
+        # Only the last two released are kept
+        assert pool.nbytes == 1600
+        assert pool.get([100], 'float') is arrays[3]
+        pool.resize(0)
+        assert pool.nbytes == 0
+        pool.clear()
+        assert pool.stats()['allocations'] == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
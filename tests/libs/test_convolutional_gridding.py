@@ -10,7 +10,11 @@ from numpy.testing import assert_allclose
 
 from libs.fourier_transforms.convolutional_gridding import w_beam, coordinates, \
     coordinates2, coordinateBounds, anti_aliasing_calculate, \
-    convolutional_degrid, convolutional_grid
+    convolutional_degrid, convolutional_grid, convolutional_grid_python, convolutional_grid_numpy, \
+    convolutional_degrid_python, convolutional_degrid_numpy, convolutional_grid_numba, convolutional_degrid_numba, \
+    weight_gridding, convolutional_grid_threaded, gridding_order, half_plane_uvwmap, box_sum, es_kernel_parameters, \
+    es_kernel, es_grid_correction, es_calculate, es_kernels_exact, ExactKernel
+from libs.fourier_transforms.fft_support import fft, pad_mid
 
 
 class TestConvolutionalGridding(unittest.TestCase):
@@ -73,6 +77,29 @@ class TestConvolutionalGridding(unittest.TestCase):
         assert uvgrid.shape[2] == npixel
         assert uvgrid.shape[3] == npixel
 
+    def test_convolutional_grid_numpy(self):
+        npixel = 256
+        nvis = 10000
+        nchan = 2
+        npol = 4
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords = numpy.array([[random.uniform(-0.25, 0.25), random.uniform(-0.25, 0.25)] for ivis in range(nvis)])
+        vis = numpy.array([[complex(random.gauss(0.0, 1.0), random.gauss(0.0, 1.0)) for pol in range(npol)]
+                           for ivis in range(nvis)])
+        visweights = numpy.array([[random.uniform(0.5, 1.0) for pol in range(npol)] for ivis in range(nvis)])
+        frequencymap = numpy.array([random.randint(0, nchan - 1) for ivis in range(nvis)])
+        # Check both the single kernel and the kernel per row (e.g. w projection) cases
+        for kernels in [(numpy.zeros([nvis], dtype='int'), [kernel]),
+                        (numpy.array([random.randint(0, 2) for ivis in range(nvis)]),
+                         [kernel, 2.0 * kernel, (1.0 + 1.0j) * kernel])]:
+            uvgrid = numpy.zeros([nchan, npol, npixel, npixel], dtype='complex')
+            uvgrid, sumwt = convolutional_grid_python(kernels, uvgrid, vis, visweights, uvcoords, frequencymap)
+            uvgrid_numpy = numpy.zeros([nchan, npol, npixel, npixel], dtype='complex')
+            uvgrid_numpy, sumwt_numpy = convolutional_grid_numpy(kernels, uvgrid_numpy, vis, visweights, uvcoords,
+                                                                 frequencymap, batch_size=1000)
+            assert_allclose(sumwt_numpy, sumwt)
+            assert_allclose(uvgrid_numpy, uvgrid, atol=1e-12 * numpy.max(numpy.abs(uvgrid)))
+
     def test_convolutional_degrid(self):
         npixel = 256
         nvis = 100000
@@ -92,6 +119,274 @@ class TestConvolutionalGridding(unittest.TestCase):
         assert vis.shape[0] == nvis
         assert vis.shape[1] == npol
 
+    def test_convolutional_degrid_numpy(self):
+        npixel = 256
+        nvis = 10000
+        nchan = 2
+        npol = 4
+        uvgrid = numpy.random.normal(size=[nchan, npol, npixel, npixel]) \
+                 + 1j * numpy.random.normal(size=[nchan, npol, npixel, npixel])
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords = numpy.array([[random.uniform(-0.25, 0.25), random.uniform(-0.25, 0.25)] for ivis in range(nvis)])
+        vshape = [nvis, npol]
+        frequencymap = numpy.array([random.randint(0, nchan - 1) for ivis in range(nvis)])
+        # Check both the single kernel and the kernel per row (e.g. w projection) cases
+        for kernels in [(numpy.zeros([nvis], dtype='int'), [kernel]),
+                        (numpy.array([random.randint(0, 2) for ivis in range(nvis)]),
+                         [kernel, 2.0 * kernel, (1.0 + 1.0j) * kernel])]:
+            vis = convolutional_degrid_python(kernels, vshape, uvgrid, uvcoords, frequencymap)
+            vis_numpy = convolutional_degrid_numpy(kernels, vshape, uvgrid, uvcoords, frequencymap, batch_size=1000)
+            assert vis_numpy.shape == vis.shape
+            assert_allclose(vis_numpy, vis, atol=1e-12 * numpy.max(numpy.abs(vis)))
+
+    def test_convolutional_grid_numba(self):
+        npixel = 256
+        nvis = 10000
+        nchan = 2
+        npol = 4
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords = numpy.array([[random.uniform(-0.25, 0.25), random.uniform(-0.25, 0.25)] for ivis in range(nvis)])
+        vis = numpy.array([[complex(random.gauss(0.0, 1.0), random.gauss(0.0, 1.0)) for pol in range(npol)]
+                           for ivis in range(nvis)])
+        visweights = numpy.array([[random.uniform(0.5, 1.0) for pol in range(npol)] for ivis in range(nvis)])
+        frequencymap = numpy.array([random.randint(0, nchan - 1) for ivis in range(nvis)])
+        for kernels in [(numpy.zeros([nvis], dtype='int'), [kernel]),
+                        (numpy.array([random.randint(0, 2) for ivis in range(nvis)]),
+                         [kernel, 2.0 * kernel, (1.0 + 1.0j) * kernel])]:
+            uvgrid = numpy.zeros([nchan, npol, npixel, npixel], dtype='complex')
+            uvgrid, sumwt = convolutional_grid_numpy(kernels, uvgrid, vis, visweights, uvcoords, frequencymap)
+            uvgrid_numba = numpy.zeros([nchan, npol, npixel, npixel], dtype='complex')
+            uvgrid_numba, sumwt_numba = convolutional_grid_numba(kernels, uvgrid_numba, vis, visweights, uvcoords,
+                                                                 frequencymap)
+            assert_allclose(sumwt_numba, sumwt)
+            assert_allclose(uvgrid_numba, uvgrid, atol=1e-12 * numpy.max(numpy.abs(uvgrid)))
+
+    def test_convolutional_grid_threaded(self):
+        npixel = 256
+        nvis = 10000
+        nchan = 2
+        npol = 4
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords = numpy.array([[random.uniform(-0.25, 0.25), random.uniform(-0.25, 0.25)] for ivis in range(nvis)])
+        vis = numpy.array([[complex(random.gauss(0.0, 1.0), random.gauss(0.0, 1.0)) for pol in range(npol)]
+                           for ivis in range(nvis)])
+        visweights = numpy.array([[random.uniform(0.5, 1.0) for pol in range(npol)] for ivis in range(nvis)])
+        frequencymap = numpy.array([random.randint(0, nchan - 1) for ivis in range(nvis)])
+        kernels = (numpy.array([random.randint(0, 2) for ivis in range(nvis)]),
+                   [kernel, 2.0 * kernel, (1.0 + 1.0j) * kernel])
+        uvgrid = numpy.zeros([nchan, npol, npixel, npixel], dtype='complex')
+        uvgrid, sumwt = convolutional_grid_numpy(kernels, uvgrid, vis, visweights, uvcoords, frequencymap)
+        for gridder in ['numpy', 'numba']:
+            for nthreads in [2, 7]:
+                uvgrid_threaded = numpy.zeros([nchan, npol, npixel, npixel], dtype='complex')
+                uvgrid_threaded, sumwt_threaded = convolutional_grid_threaded(kernels, uvgrid_threaded, vis,
+                                                                              visweights, uvcoords, frequencymap,
+                                                                              gridder=gridder, nthreads=nthreads)
+                assert_allclose(sumwt_threaded, sumwt)
+                assert_allclose(uvgrid_threaded, uvgrid, atol=1e-12 * numpy.max(numpy.abs(uvgrid)))
+
+    def test_convolutional_grid_order(self):
+        npixel = 256
+        nvis = 10000
+        nchan = 2
+        npol = 4
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords = numpy.array([[random.uniform(-0.25, 0.25), random.uniform(-0.25, 0.25)] for ivis in range(nvis)])
+        vis = numpy.array([[complex(random.gauss(0.0, 1.0), random.gauss(0.0, 1.0)) for pol in range(npol)]
+                           for ivis in range(nvis)])
+        visweights = numpy.array([[random.uniform(0.5, 1.0) for pol in range(npol)] for ivis in range(nvis)])
+        frequencymap = numpy.array([random.randint(0, nchan - 1) for ivis in range(nvis)])
+        kernels = (numpy.array([random.randint(0, 2) for ivis in range(nvis)]),
+                   [kernel, 2.0 * kernel, (1.0 + 1.0j) * kernel])
+        shape = [nchan, npol, npixel, npixel]
+        order = gridding_order(shape, uvcoords, frequencymap, tile=16)
+        assert numpy.all(numpy.sort(order) == numpy.arange(nvis))
+        tiles = (frequencymap[order] * 16 + ((uvcoords[order, 1] + 0.5) * npixel + 0.5).astype('int') // 16) * 16 + \
+                ((uvcoords[order, 0] + 0.5) * npixel + 0.5).astype('int') // 16
+        assert numpy.all(numpy.diff(tiles) >= 0)
+        uvgrid, sumwt = convolutional_grid(kernels, numpy.zeros(shape, dtype='complex'), vis, visweights, uvcoords,
+                                           frequencymap, gridder='python')
+        for gridder in ['numpy', 'numba', 'python']:
+            uvgrid_order, sumwt_order = convolutional_grid(kernels, numpy.zeros(shape, dtype='complex'), vis,
+                                                           visweights, uvcoords, frequencymap, gridder=gridder,
+                                                           order=order)
+            assert_allclose(sumwt_order, sumwt)
+            assert_allclose(uvgrid_order, uvgrid, atol=1e-12 * numpy.max(numpy.abs(uvgrid)))
+
+    def test_convolutional_grid_half_plane(self):
+        npixel = 256
+        nvis = 1000
+        margin = 8
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords = numpy.array([[random.uniform(0.0, 0.25), random.uniform(-0.25, 0.25)] for ivis in range(nvis)])
+        vis = numpy.array([[complex(random.gauss(0.0, 1.0), random.gauss(0.0, 1.0))] for ivis in range(nvis)])
+        visweights = numpy.ones([nvis, 1])
+        frequencymap = numpy.zeros([nvis], dtype='int')
+        kernels = (numpy.zeros([nvis], dtype='int'), [kernel])
+        uvgrid, _ = convolutional_grid(kernels, numpy.zeros([1, 1, npixel, npixel], dtype='complex'), vis,
+                                       visweights, uvcoords, frequencymap)
+        half_uvcoords = half_plane_uvwmap(uvcoords, npixel, margin)
+        half_uvgrid, _ = convolutional_grid(kernels, numpy.zeros([1, 1, npixel, npixel // 2 + margin],
+                                                                 dtype='complex'),
+                                            vis, visweights, half_uvcoords, frequencymap)
+        assert_allclose(half_uvgrid, uvgrid[..., npixel // 2 - margin:], atol=1e-12)
+        assert_allclose(convolutional_degrid(kernels, vis.shape, half_uvgrid, half_uvcoords, frequencymap),
+                        convolutional_degrid(kernels, vis.shape, uvgrid, uvcoords, frequencymap), atol=1e-12)
+
+    def test_convolutional_degrid_numba(self):
+        npixel = 256
+        nvis = 10000
+        nchan = 2
+        npol = 4
+        uvgrid = numpy.random.normal(size=[nchan, npol, npixel, npixel]) \
+                 + 1j * numpy.random.normal(size=[nchan, npol, npixel, npixel])
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords = numpy.array([[random.uniform(-0.25, 0.25), random.uniform(-0.25, 0.25)] for ivis in range(nvis)])
+        vshape = [nvis, npol]
+        frequencymap = numpy.array([random.randint(0, nchan - 1) for ivis in range(nvis)])
+        for kernels in [(numpy.zeros([nvis], dtype='int'), [kernel]),
+                        (numpy.array([random.randint(0, 2) for ivis in range(nvis)]),
+                         [kernel, 2.0 * kernel, (1.0 + 1.0j) * kernel])]:
+            vis = convolutional_degrid_numpy(kernels, vshape, uvgrid, uvcoords, frequencymap)
+            vis_numba = convolutional_degrid_numba(kernels, vshape, uvgrid, uvcoords, frequencymap)
+            assert vis_numba.shape == vis.shape
+            assert_allclose(vis_numba, vis, atol=1e-12 * numpy.max(numpy.abs(vis)))
+
+    def test_weight_gridding(self):
+        npixel = 256
+        nvis = 10000
+        nchan = 2
+        npol = 4
+        uvcoords = numpy.array([[random.uniform(-0.25, 0.25), random.uniform(-0.25, 0.25)] for ivis in range(nvis)])
+        visweights = numpy.array([[random.uniform(0.5, 1.0) for pol in range(npol)] for ivis in range(nvis)])
+        frequencymap = numpy.array([random.randint(0, nchan - 1) for ivis in range(nvis)])
+        shape = [nchan, npol, npixel, npixel]
+        weights, density, densitygrid = weight_gridding(shape, visweights, uvcoords, frequencymap, gridder='python')
+        for gridder in ['numpy', 'numba']:
+            weights_engine, density_engine, densitygrid_engine = weight_gridding(shape, visweights, uvcoords,
+                                                                                 frequencymap, gridder=gridder)
+            assert_allclose(densitygrid_engine, densitygrid)
+            assert_allclose(density_engine, density)
+            assert_allclose(weights_engine, weights)
+
+    def test_weight_gridding_schemes(self):
+        npixel = 64
+        nvis = 10000
+        nchan = 2
+        npol = 2
+        numpy.random.seed(180555)
+        uvcoords = numpy.random.uniform(-0.25, 0.25, [nvis, 2])
+        visweights = numpy.random.uniform(0.5, 1.0, [nvis, npol])
+        frequencymap = numpy.random.randint(0, nchan, nvis)
+        shape = [nchan, npol, npixel, npixel]
+        natural, density, densitygrid = weight_gridding(shape, visweights, uvcoords, frequencymap, weighting='natural')
+        assert density is None and densitygrid is None
+        assert_allclose(natural, visweights)
+        uniform, density, densitygrid = weight_gridding(shape, visweights, uvcoords, frequencymap)
+        # Briggs tends to uniform (up to a scale) and natural at the extremes of robustness
+        for robustness, expected in [(-5.0, uniform), (5.0, natural)]:
+            briggs, _, _ = weight_gridding(shape, visweights, uvcoords, frequencymap, weighting='briggs',
+                                           robustness=robustness)
+            briggs *= numpy.sum(expected, axis=0) / numpy.sum(briggs, axis=0)
+            assert_allclose(briggs, expected, rtol=1e-3)
+        # Super uniform with a box of one cell is uniform
+        superuniform, _, _ = weight_gridding(shape, visweights, uvcoords, frequencymap, weighting='super_uniform',
+                                             super_uniform_box=1)
+        assert_allclose(superuniform, uniform)
+        superuniform, superdensity, _ = weight_gridding(shape, visweights, uvcoords, frequencymap,
+                                                        weighting='super_uniform', super_uniform_box=5)
+        assert numpy.all(superdensity >= density)
+        # A supplied density grid is used in place of the density of visweights
+        scaled, _, _ = weight_gridding(shape, visweights, uvcoords, frequencymap, densitygrid=2.0 * densitygrid)
+        assert_allclose(scaled, 0.5 * uniform)
+        with self.assertRaises(ValueError):
+            weight_gridding(shape, visweights, uvcoords, frequencymap, weighting='robust')
+    
+    def test_box_sum(self):
+        numpy.random.seed(180555)
+        grid = numpy.random.uniform(size=[2, 1, 16, 20])
+        padded = numpy.pad(grid, [(0, 0), (0, 0), (2, 2), (2, 2)], mode='constant')
+        expected = numpy.zeros_like(grid)
+        for dy in range(5):
+            for dx in range(5):
+                expected += padded[..., dy:dy + 16, dx:dx + 20]
+        assert_allclose(box_sum(grid, 5), expected)
+
+    
+    def test_es_kernel_parameters(self):
+        widths = [es_kernel_parameters(epsilon)[0] for epsilon in [1e-2, 1e-4, 1e-6, 1e-8]]
+        assert widths == sorted(widths) and widths[0] < widths[-1]
+        # Less padding needs a wider kernel
+        assert es_kernel_parameters(1e-6, padding=1.25)[0] > es_kernel_parameters(1e-6, padding=2.0)[0]
+    
+    def test_es_grid_correction(self):
+        # Compare the quadrature with the transform of a finely sampled kernel
+        width, beta, _ = es_kernel_parameters(1e-6)
+        oversampling = 64
+        npixel = 32
+        u = (numpy.arange(npixel * oversampling) - npixel * oversampling // 2) / oversampling
+        kernel = es_kernel(u / (0.5 * width), beta)
+        expected = numpy.real(numpy.fft.fftshift(numpy.fft.fft(numpy.fft.ifftshift(kernel))))[
+                   (npixel * oversampling - npixel) // 2:(npixel * oversampling + npixel) // 2] / oversampling
+        assert_allclose(es_grid_correction(npixel, width, beta), expected, atol=1e-10)
+    
+    def test_es_degrid_accuracy(self):
+        # Degridding a point source should match the direct Fourier transform to the target accuracy
+        npixel, padding, nvis = 64, 2, 1000
+        numpy.random.seed(180555)
+        uv = numpy.random.uniform(-0.2, 0.2, [nvis, 2])
+        vuvwmap = numpy.zeros([nvis, 3])
+        vuvwmap[:, 0:2] = uv
+        frequencymap = numpy.zeros(nvis, dtype='int')
+        x, y = 13, -22
+        image = numpy.zeros([1, 1, npixel, npixel])
+        image[0, 0, npixel // 2 + y, npixel // 2 + x] = 1.0
+        expected = numpy.exp(-2j * numpy.pi * (uv[:, 0] * x + uv[:, 1] * y))
+        shape = (padding * npixel, padding * npixel)
+        for epsilon in [1e-3, 1e-6]:
+            width, beta, oversampling = es_kernel_parameters(epsilon, padding)
+            for exact in [False, True]:
+                if exact:
+                    gcf, _ = es_calculate(shape, width, beta)
+                    kernel_list = (numpy.arange(nvis), es_kernels_exact(shape, vuvwmap, width, beta))
+                else:
+                    gcf, kernel = es_calculate(shape, width, beta, min(oversampling, 256))
+                    kernel_list = (numpy.zeros(nvis, dtype='int'), [kernel])
+                uvgrid = fft((pad_mid(image, padding * npixel) * gcf).astype('complex'))
+                vis = convolutional_degrid(kernel_list, (nvis, 1), uvgrid, vuvwmap, frequencymap)
+                error = numpy.max(numpy.abs(vis[:, 0] - expected))
+                # Rounding the uv positions to the kernel table adds a phase error
+                limit = epsilon if exact else epsilon + numpy.pi / (padding * min(oversampling, 256))
+                assert error < limit, "Error %g exceeds %g for epsilon %g" % (error, limit, epsilon)
+    
+    def test_es_exact_kernel_chunks(self):
+        # Evaluating the exact kernels in chunks of rows should give the same grid and visibilities as all at once
+        npixel, nvis = 64, 1000
+        numpy.random.seed(180555)
+        vuvwmap = numpy.zeros([nvis, 3])
+        vuvwmap[:, 0:2] = numpy.random.uniform(-0.2, 0.2, [nvis, 2])
+        frequencymap = numpy.zeros(nvis, dtype='int')
+        vis = numpy.random.randn(nvis, 1) + 1j * numpy.random.randn(nvis, 1)
+        weights = numpy.ones([nvis, 1])
+        shape = (npixel, npixel)
+        width, beta, _ = es_kernel_parameters(1e-6, 2.0)
+        kernel_list = (numpy.arange(nvis), es_kernels_exact(shape, vuvwmap, width, beta))
+        kernel = ExactKernel(lambda s, m: es_kernels_exact(s, m, width, beta), kernel_list[1].shape[-1],
+                             max_bytes=100 * kernel_list[1][0].nbytes)
+        assert len(kernel.chunks(nvis)) == 10
+        chunked_list = (numpy.zeros(nvis, dtype='int'), [kernel])
+        for gridder in ['numpy', 'python']:
+            expected, expected_sumwt = convolutional_grid(kernel_list, numpy.zeros([1, 1, npixel, npixel], 'complex'),
+                                                          vis, weights, vuvwmap, frequencymap, gridder=gridder)
+            uvgrid, sumwt = convolutional_grid(chunked_list, numpy.zeros([1, 1, npixel, npixel], 'complex'), vis,
+                                               weights, vuvwmap, frequencymap, gridder=gridder)
+            assert_allclose(uvgrid, expected, atol=1e-12)
+            assert_allclose(sumwt, expected_sumwt)
+            assert_allclose(convolutional_degrid(chunked_list, (nvis, 1), uvgrid, vuvwmap, frequencymap,
+                                                 gridder=gridder),
+                            convolutional_degrid(kernel_list, (nvis, 1), uvgrid, vuvwmap, frequencymap,
+                                                 gridder=gridder), atol=1e-12)
+
 
 if __name__ == '__main__':
     unittest.main()
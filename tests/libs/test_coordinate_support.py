@@ -10,7 +10,7 @@ from astropy.coordinates import SkyCoord
 from numpy.testing import assert_allclose
 
 from libs.util.coordinate_support import xyz_to_uvw, xyz_at_latitude, simulate_point, baselines, uvw_to_xyz, \
-    skycoord_to_lmn
+    skycoord_to_lmn, parallactic_angle
 
 
 class TestCoordinates(unittest.TestCase):
@@ -87,6 +87,18 @@ class TestCoordinates(unittest.TestCase):
         assert_allclose(transform(1, 0, 0, -90, 0), [0, 0, 1], atol=1e-15)
         assert_allclose(transform(1, 0, 0, 90, 0), [0, 0, -1], atol=1e-15)
     
+    def test_parallactic_angle(self):
+        lat = numpy.radians(-26.8)
+        # On the meridian a source south of the zenith has zero parallactic angle
+        assert_allclose(parallactic_angle(0.0, numpy.radians(-60.0), lat), 0.0, atol=1e-15)
+        # and a source north of the zenith has 180 degrees
+        assert_allclose(abs(parallactic_angle(0.0, numpy.radians(10.0), lat)), numpy.pi)
+        # The angle is antisymmetric in hour angle and positive to the west
+        ha = numpy.linspace(-1.0, 1.0, 7)
+        q = parallactic_angle(ha, numpy.radians(-60.0), lat)
+        assert_allclose(q, -q[::-1], atol=1e-15)
+        assert numpy.all(q[ha > 0] > 0.0)
+    
     def test_baselines(self):
         # There should be exactly npixel*(npixel-1)/2 baselines
         def test(ants_uvw):
@@ -0,0 +1,44 @@
+""" Unit tests for the direct Fourier transform of point sources
+
+
+"""
+import unittest
+
+import numpy
+
+from libs.fourier_transforms.dft_support import dft_point_sources
+from libs.util.coordinate_support import simulate_point
+
+
+class TestDFTSupport(unittest.TestCase):
+    
+    def setUp(self):
+        self.rng = numpy.random.RandomState(1805550721)
+        self.nvis = 1000
+        self.ncomp = 30
+        self.uvw = self.rng.normal(0.0, 300.0, [self.nvis, 3])
+        self.lmn = self.rng.uniform(-0.05, 0.05, [self.ncomp, 2])
+        self.flux = self.rng.uniform(0.0, 1.0, [self.ncomp, 4]) + 1j * self.rng.uniform(0.0, 1.0, [self.ncomp, 4])
+        self.vis = numpy.zeros([self.nvis, 4], dtype='complex')
+        for (l, m), flux in zip(self.lmn, self.flux):
+            self.vis += simulate_point(self.uvw, l, m)[:, numpy.newaxis] * flux[numpy.newaxis, :]
+    
+    def test_dft_point_sources(self):
+        vis = dft_point_sources(self.uvw, self.lmn, self.flux)
+        numpy.testing.assert_allclose(vis, self.vis, atol=1e-10)
+    
+    def test_dft_point_sources_blocks(self):
+        # Blocks smaller than the number of components, and threads, must give the same result
+        for block_size, nthreads in [(7, 1), (1000, 1), (1000, 4), (10 ** 6, 4)]:
+            vis = dft_point_sources(self.uvw, self.lmn, self.flux, block_size=block_size, nthreads=nthreads)
+            numpy.testing.assert_allclose(vis, self.vis, atol=1e-10)
+    
+    def test_dft_point_sources_add(self):
+        vis = numpy.ones([self.nvis, 4], dtype='complex')
+        result = dft_point_sources(self.uvw, self.lmn, self.flux, vis=vis)
+        assert result is vis
+        numpy.testing.assert_allclose(vis, self.vis + 1.0, atol=1e-10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,8 @@ import unittest
 
 from numpy.testing import assert_allclose
 
-from libs.fourier_transforms.fft_support import extract_mid, pad_mid, extract_oversampled
+from libs.fourier_transforms.fft_support import extract_mid, pad_mid, extract_oversampled, fft, ifft, \
+    fft_half_plane, ifft_half_plane, fft_backend, set_fft_backend, fft_friendly_size, fft_axis, ifft_axis
 from libs.fourier_transforms.convolutional_gridding import coordinates2
 
 
@@ -39,6 +40,82 @@ class TestFFTSupport(unittest.TestCase):
             ex = extract_oversampled(a, 0, 0, kernel_oversampling, npixel) / kernel_oversampling ** 2
             assert_allclose(ex, 1 + self._pattern(npixel))
 
+    def test_half_plane(self):
+        ny, nx, margin = 32, 40, 4
+        numpy.random.seed(180555)
+        grid = numpy.zeros([2, 1, ny, nx], dtype='complex')
+        grid[..., nx // 2 - margin:] = numpy.random.normal(size=[2, 1, ny, nx // 2 + margin]) + \
+                                       1j * numpy.random.normal(size=[2, 1, ny, nx // 2 + margin])
+        assert_allclose(ifft_half_plane(grid[..., nx // 2 - margin:], nx, margin), numpy.real(ifft(grid)),
+                        atol=1e-15)
+        image = numpy.random.normal(size=[2, 1, ny, nx])
+        assert_allclose(fft_half_plane(image, margin), fft(image)[..., nx // 2 - margin:], atol=1e-12)
+    
+    def test_single_precision(self):
+        ny, nx, margin = 32, 40, 4
+        numpy.random.seed(180555)
+        image = numpy.random.normal(size=[2, 1, ny, nx])
+        grid = fft(image.astype('complex64'))
+        assert grid.dtype == numpy.complex64
+        assert ifft(grid).dtype == numpy.complex64
+        assert_allclose(grid, fft(image), atol=1e-4 * numpy.max(numpy.abs(grid)))
+        half = fft_half_plane(image.astype('float32'), margin)
+        assert half.dtype == numpy.complex64
+        assert_allclose(half, fft(image)[..., nx // 2 - margin:], atol=1e-4 * numpy.max(numpy.abs(half)))
+        assert ifft_half_plane(half, nx, margin).dtype == numpy.float32
+    
+    def test_fft_backends(self):
+        numpy.random.seed(180555)
+        saved = dict(fft_backend)
+        try:
+            for shape in [(32, 40), (2, 1, 32, 40), (2, 1, 30, 32), (2, 1, 31, 33)]:
+                a = numpy.random.normal(size=shape) + 1j * numpy.random.normal(size=shape)
+                expected = numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(a, axes=[-2, -1])), axes=[-2, -1])
+                for backend in ['numpy', 'scipy']:
+                    set_fft_backend(backend, workers=2)
+                    assert_allclose(fft(a), expected, atol=1e-12)
+                    assert_allclose(ifft(fft(a)), a, atol=1e-12)
+            with self.assertRaises(ValueError):
+                set_fft_backend('fftpack')
+        finally:
+            set_fft_backend(saved['backend'], saved['workers'])
+
+    def test_out(self):
+        rng = numpy.random.RandomState(17)
+        for npixel in [64, 63]:
+            image = rng.normal(size=[2, npixel, npixel])
+            padded = pad_mid(image, 2 * npixel + npixel % 2, out=numpy.empty([2, 2 * npixel + npixel % 2,
+                                                                               2 * npixel + npixel % 2]))
+            assert_allclose(padded, pad_mid(image, 2 * npixel + npixel % 2))
+            work = numpy.empty(padded.shape, dtype='complex')
+            grid = fft(padded, out=work)
+            assert grid is work
+            assert_allclose(grid, fft(padded), atol=1e-12)
+            # In place
+            result = ifft(work, out=work)
+            assert result is work
+            assert_allclose(result, padded, atol=1e-12)
+    
+    def test_fft_axis(self):
+        a = numpy.random.RandomState(17).normal(size=[2, 32, 48]).astype('complex')
+        assert_allclose(fft_axis(fft_axis(a, axis=-1), axis=-2), fft(a), atol=1e-12)
+        assert_allclose(ifft_axis(ifft_axis(a, axis=-2), axis=-1), ifft(a), atol=1e-12)
+    
+    def test_fft_friendly_size(self):
+        assert fft_friendly_size(256) == 256
+        assert fft_friendly_size(1997) == 2000
+        assert fft_friendly_size(333) == 336
+        assert fft_friendly_size(333, parity=1) == 343
+        assert fft_friendly_size(11, parity=None) == 12
+        assert fft_friendly_size(13, parity=None) == 14
+        for n in range(1, 200):
+            m = fft_friendly_size(n)
+            assert m >= n and m % 2 == 0
+            for p in (2, 3, 5, 7):
+                while m % p == 0:
+                    m //= p
+            assert m == 1
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -5,7 +5,9 @@
 
 import unittest
 
-from data_models.parameters import get_parameter
+import numpy
+
+from data_models.parameters import get_parameter, get_precision_dtypes
 
 import logging
 
@@ -29,6 +31,13 @@ class TestParameters(unittest.TestCase):
         kwargs = self.parameters
         t1(**kwargs)
 
+    def test_get_precision_dtypes(self):
+        assert get_precision_dtypes({}) == (numpy.float64, numpy.complex128)
+        assert get_precision_dtypes({'precision': 'double'}) == (numpy.float64, numpy.complex128)
+        assert get_precision_dtypes({'precision': 'single'}) == (numpy.float32, numpy.complex64)
+        with self.assertRaises(ValueError):
+            get_precision_dtypes({'precision': 'half'})
+
 
 if __name__ == '__main__':
     unittest.main()
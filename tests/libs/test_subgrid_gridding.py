@@ -0,0 +1,93 @@
+""" Unit tests for image domain gridding onto subgrids
+
+
+"""
+import unittest
+
+import numpy
+
+from libs.fourier_transforms.convolutional_gridding import anti_aliasing_calculate
+from libs.fourier_transforms.fft_support import fft, pad_mid
+from libs.fourier_transforms.subgrid_gridding import subgrid_grid, subgrid_degrid, subgrid_layout, \
+    subgrid_size_required
+
+
+class TestSubgridGridding(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = numpy.random.RandomState(1805550721)
+        self.npixel = 64
+        self.npad = 128
+        self.cellsize = 0.002
+        self.field_of_view = self.npad * self.cellsize
+        self.nvis = 500
+        self.uvw = numpy.zeros([self.nvis, 3])
+        self.uvw[:, 0:2] = self.rng.uniform(-0.4, 0.4, [self.nvis, 2]) / self.cellsize
+        self.uvw[:, 2] = self.rng.uniform(-40.0, 40.0, self.nvis)
+        self.vuvwmap = self.uvw * self.cellsize
+        self.vfrequencymap = numpy.zeros(self.nvis, dtype='int')
+
+    def test_subgrid_layout(self):
+        layouts = subgrid_layout((1, 1, self.npad, self.npad), self.vuvwmap, self.vfrequencymap, self.uvw[:, 2],
+                                 self.field_of_view, subgrid_size=16)
+        rows = numpy.concatenate([layout[1] for layout in layouts])
+        assert numpy.array_equal(numpy.sort(rows), numpy.arange(self.nvis))
+        for size, order, starts, chunkchan, y0, x0 in layouts:
+            _, margin = subgrid_size_required(self.field_of_view, numpy.max(numpy.abs(self.uvw[order, 2])), size)
+            assert size >= 4 * margin
+            for chunk in range(len(starts) - 1):
+                chunkrows = order[starts[chunk]:starts[chunk + 1]]
+                x = self.npad // 2 + self.vuvwmap[chunkrows, 0] * self.npad - x0[chunk]
+                assert numpy.min(x) >= margin - 1 and numpy.max(x) < size - margin + 1
+
+    def test_subgrid_degrid_point(self):
+        # A point source degridded through subgrids should match the direct Fourier transform, including the w term
+        for x, y in [(0, 0), (20, -13), (-31, 25)]:
+            image = numpy.zeros([1, 1, self.npixel, self.npixel])
+            image[0, 0, self.npixel // 2 + y, self.npixel // 2 + x] = 1.0
+            gcf, _ = anti_aliasing_calculate((self.npad, self.npad))
+            uvgrid = fft((pad_mid(image, self.npad) * gcf).astype('complex'))
+            vis = subgrid_degrid((self.nvis, 1), uvgrid, self.vuvwmap, self.vfrequencymap, self.uvw[:, 2],
+                                 self.field_of_view)
+            l, m = x * self.cellsize, y * self.cellsize
+            n = numpy.sqrt(1.0 - l ** 2 - m ** 2)
+            expected = numpy.exp(-2j * numpy.pi * (self.uvw[:, 0] * l + self.uvw[:, 1] * m + self.uvw[:, 2] * (n - 1)))
+            numpy.testing.assert_allclose(vis[:, 0], expected, atol=2e-3)
+
+    def test_subgrid_grid_adjoint(self):
+        vis = self.rng.normal(size=[self.nvis, 1]) + 1j * self.rng.normal(size=[self.nvis, 1])
+        uvgrid = self.rng.normal(size=[1, 1, self.npad, self.npad]) + 1j * self.rng.normal(size=[1, 1, self.npad,
+                                                                                                  self.npad])
+        vantennas = self.rng.randint(0, 4, [self.nvis, 2])
+        aterms = {}
+
+        def aterm_function(size):
+            if size not in aterms:
+                aterms[size] = self.rng.uniform(0.5, 1.0, [4, size, size]) * \
+                               numpy.exp(1j * self.rng.uniform(0.0, 1.0, [4, size, size]))
+            return aterms[size]
+
+        for kwargs in [{}, {'aterm_function': aterm_function, 'vantennas': vantennas}]:
+            grid, sumwt = subgrid_grid(numpy.zeros_like(uvgrid), vis, numpy.ones([self.nvis, 1]), self.vuvwmap,
+                                       self.vfrequencymap, self.uvw[:, 2], self.field_of_view, **kwargs)
+            self.assertAlmostEqual(sumwt[0, 0], self.nvis)
+            degridded = subgrid_degrid((self.nvis, 1), uvgrid, self.vuvwmap, self.vfrequencymap, self.uvw[:, 2],
+                                       self.field_of_view, **kwargs)
+            lhs = numpy.vdot(uvgrid, grid)
+            rhs = numpy.vdot(degridded, vis)
+            assert abs(lhs - rhs) < 1e-9 * abs(lhs), "Degridding is not the adjoint of gridding: %s %s" % (lhs, rhs)
+
+    def test_subgrid_aterms_unity(self):
+        vis = self.rng.normal(size=[self.nvis, 1]) + 1j * self.rng.normal(size=[self.nvis, 1])
+        grid, _ = subgrid_grid(numpy.zeros([1, 1, self.npad, self.npad], dtype='complex'), vis,
+                               numpy.ones([self.nvis, 1]), self.vuvwmap, self.vfrequencymap, self.uvw[:, 2],
+                               self.field_of_view)
+        agrid, _ = subgrid_grid(numpy.zeros([1, 1, self.npad, self.npad], dtype='complex'), vis,
+                                numpy.ones([self.nvis, 1]), self.vuvwmap, self.vfrequencymap, self.uvw[:, 2],
+                                self.field_of_view, aterm_function=lambda size: numpy.ones([2, size, size]),
+                                vantennas=numpy.zeros([self.nvis, 2], dtype='int'))
+        numpy.testing.assert_allclose(agrid, grid, atol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()
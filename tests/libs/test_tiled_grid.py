@@ -0,0 +1,68 @@
+""" Unit tests for tiled uv grids
+
+
+"""
+import unittest
+
+import numpy
+
+from libs.fourier_transforms.convolutional_gridding import anti_aliasing_calculate, convolutional_grid, \
+    convolutional_degrid
+from libs.fourier_transforms.fft_support import fft, ifft, pad_mid, extract_mid
+from libs.fourier_transforms.tiled_grid import TiledGrid, convolutional_grid_tiled, convolutional_degrid_tiled, \
+    tiled_grid_allocate, fft_tiled, ifft_tiled
+
+
+class TestTiledGrid(unittest.TestCase):
+    
+    def setUp(self):
+        self.rng = numpy.random.RandomState(1805550721)
+        self.npixel = 64
+        self.npad = 128
+        self.nvis = 500
+        self.shape = [2, 2, self.npad, self.npad]
+        # Mostly short baselines, with a few long ones
+        self.vuvwmap = numpy.zeros([self.nvis, 3])
+        self.vuvwmap[:, 0:2] = self.rng.uniform(-0.1, 0.1, [self.nvis, 2])
+        self.vuvwmap[:5, 0:2] = self.rng.uniform(-0.45, 0.45, [5, 2])
+        self.vfrequencymap = self.rng.randint(0, 2, self.nvis)
+        self.vis = self.rng.normal(size=[self.nvis, 2]) + 1j * self.rng.normal(size=[self.nvis, 2])
+        self.visweights = self.rng.uniform(0.5, 1.0, [self.nvis, 2])
+        _, kernel = anti_aliasing_calculate((self.npad, self.npad), 8)
+        self.kernel_list = (numpy.zeros(self.nvis, dtype='int'), [kernel])
+    
+    def test_grid_tiled(self):
+        dense, sumwt = convolutional_grid(self.kernel_list, numpy.zeros(self.shape, dtype='complex'), self.vis,
+                                          self.visweights, self.vuvwmap, self.vfrequencymap)
+        for tile in [16, 50, 128]:
+            tiledgrid, tiledsumwt = convolutional_grid_tiled(self.kernel_list, TiledGrid(self.shape, tile=tile),
+                                                             self.vis, self.visweights, self.vuvwmap,
+                                                             self.vfrequencymap)
+            numpy.testing.assert_allclose(tiledsumwt, sumwt)
+            numpy.testing.assert_allclose(tiledgrid.to_dense(), dense, atol=1e-12)
+            image = extract_mid(ifft(dense), self.npixel)
+            numpy.testing.assert_allclose(ifft_tiled(tiledgrid, self.npixel), image, atol=1e-14)
+        # Small tiles cover only part of the grid
+        assert TiledGrid(self.shape, tile=16).occupancy == 0.0
+        assert tiledgrid.occupancy <= 1.0
+    
+    def test_degrid_tiled(self):
+        model = self.rng.normal(size=[2, 2, self.npixel, self.npixel])
+        dense = fft(pad_mid(model, self.npad).astype('complex'))
+        vis = convolutional_degrid(self.kernel_list, self.vis.shape, dense, self.vuvwmap, self.vfrequencymap)
+        tiledgrid = tiled_grid_allocate(self.kernel_list, TiledGrid(self.shape, tile=16), self.vuvwmap,
+                                        self.vfrequencymap)
+        assert tiledgrid.occupancy < 0.5
+        tiledgrid = fft_tiled(tiledgrid, model)
+        tiledvis = convolutional_degrid_tiled(self.kernel_list, self.vis.shape, tiledgrid, self.vuvwmap,
+                                              self.vfrequencymap)
+        numpy.testing.assert_allclose(tiledvis, vis, atol=1e-10)
+    
+    def test_halo_too_small(self):
+        with self.assertRaises(AssertionError):
+            convolutional_grid_tiled(self.kernel_list, TiledGrid(self.shape, tile=16, halo=4), self.vis,
+                                     self.visweights, self.vuvwmap, self.vfrequencymap)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -88,6 +88,13 @@ class TestImageDeconvolution(unittest.TestCase):
         export_image_to_fits(self.cmodel, "%s/test_deconvolve_msclean-clean.fits" % (self.dir))
         assert numpy.max(self.residual.data) < 1.2
 
+    def test_deconvolve_msclean_single(self):
+        self.comp, self.residual = deconvolve_cube(self.dirty, self.psf, niter=1000, gain=0.7, algorithm='msclean',
+                                                   scales=[0, 3, 10, 30], threshold=0.01, precision='single')
+        assert self.comp.data.dtype == numpy.float32
+        assert self.residual.data.dtype == numpy.float32
+        assert numpy.max(self.residual.data) < 1.2
+
     def test_deconvolve_msclean_1scale(self):
         
         self.comp, self.residual = deconvolve_cube(self.dirty, self.psf, niter=10000, gain=0.1, algorithm='msclean',
@@ -9,12 +9,17 @@ import unittest
 
 import numpy
 from astropy import units as u
+from scipy.ndimage import map_coordinates
 from astropy.coordinates import SkyCoord
 
 from data_models.polarisation import PolarisationFrame
-from processing_components.image.operations import export_image_to_fits, smooth_image
-from processing_components.imaging.base import predict_skycomponent_visibility
-from processing_components.imaging.imaging_functions import predict_function, invert_function
+from libs.util.buffer_pool import buffer_pool
+from processing_components.image.operations import export_image_to_fits, smooth_image, copy_image
+from processing_components.imaging.base import predict_skycomponent_visibility, normalize_sumwt, ImageAccumulator
+from processing_components.imaging.imaging_functions import predict_function, invert_function, \
+    invert_dirty_psf_function, residual_function
+from processing_components.imaging.primary_beams import create_pb_generic
+from processing_components.imaging.timeslice_single import get_lm_resampling_map, timeslice_cache
 from processing_components.simulation.testing_support import create_named_configuration, ingest_unittest_visibility, \
     create_unittest_model, insert_unittest_errors, create_unittest_components
 from processing_components.skycomponent.operations import find_skycomponents, find_nearest_skycomponent, \
@@ -142,6 +147,56 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp(zerow=True)
         self._predict_base(context='2d')
     
+    def test_predict_2d_hermitian(self):
+        self.actualSetUp(zerow=True)
+        self._predict_base(context='2d', extra='_hermitian', hermitian=True)
+    
+    def test_predict_2d_es(self):
+        self.actualSetUp(zerow=True)
+        self._predict_base(context='2d', extra='_es', kernel='es', epsilon=1e-6)
+        # The error against the direct Fourier transform of the components is set by epsilon
+        for epsilon in [1e-3, 1e-6]:
+            vis = predict_function(copy_visibility(self.vis, zero=True), self.model, context='2d', kernel='es',
+                                   epsilon=epsilon)
+            error = numpy.max(numpy.abs(vis.vis - self.vis.vis)) / numpy.max(numpy.abs(self.vis.vis))
+            assert error < epsilon, "Error %g greater than epsilon %g" % (error, epsilon)
+    
+    def test_predict_2d_single(self):
+        self.actualSetUp(zerow=True)
+        self._predict_base(context='2d', extra='_single', precision='single')
+        # Single precision grids and kernels change the visibilities by about 1e-7 of the peak
+        vis_double = predict_function(copy_visibility(self.vis, zero=True), self.model, context='2d')
+        vis_single = predict_function(copy_visibility(self.vis, zero=True), self.model, context='2d',
+                                      precision='single')
+        error = numpy.max(numpy.abs(vis_single.vis - vis_double.vis)) / numpy.max(numpy.abs(vis_double.vis))
+        assert error < 1e-5, "Single precision predict differs from double by %g" % error
+    
+    def test_predict_2d_tiled(self):
+        self.actualSetUp(zerow=True)
+        self._predict_base(context='2d', extra='_tiled', uvgrid_tile=32)
+        # Degridding from the tiles gives the same visibilities as from the dense grid
+        vis_dense = predict_function(copy_visibility(self.vis, zero=True), self.model, context='2d')
+        vis_tiled = predict_function(copy_visibility(self.vis, zero=True), self.model, context='2d', uvgrid_tile=32)
+        error = numpy.max(numpy.abs(vis_tiled.vis - vis_dense.vis)) / numpy.max(numpy.abs(vis_dense.vis))
+        assert error < 1e-12, "Tiled predict differs from dense by %g" % error
+    
+    def test_predict_2d_aprojection(self):
+        self.actualSetUp(zerow=True)
+        # A-projection of the model gives the visibilities of the model multiplied by the primary beam
+        pb = create_pb_generic(self.model, diameter=35.0, blockage=0.0)
+        apparent = copy_image(self.model)
+        apparent.data *= pb.data
+        vis_pb = predict_function(copy_visibility(self.vis, zero=True), apparent, context='2d')
+        vis_aprojection = predict_function(copy_visibility(self.vis, zero=True), self.model, context='2d',
+                                           kernel='aprojection', pb=pb, kernelwidth=32)
+        error = numpy.max(numpy.abs(vis_aprojection.vis - vis_pb.vis)) / numpy.max(numpy.abs(vis_pb.vis))
+        assert error < 1e-2, "A-projection predict differs from beam weighted predict by %g" % error
+        # The visibility norm is dominated by the bright sources near the centre, so compare the images as well
+        dirty_pb = invert_function(vis_pb, self.model, context='2d')[0]
+        dirty_aprojection = invert_function(vis_aprojection, self.model, context='2d')[0]
+        error = numpy.max(numpy.abs(dirty_aprojection.data - dirty_pb.data)) / numpy.max(numpy.abs(dirty_pb.data))
+        assert error < 1e-2, "A-projection predict image differs from beam weighted predict image by %g" % error
+
     @unittest.skip("Facets requires overlap")
     def test_predict_facets(self):
         self.actualSetUp()
@@ -182,6 +237,22 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp()
         self._predict_base(context='wstack', fluxthreshold=2.0, vis_slices=41)
     
+    def test_predict_wstack_multi(self):
+        self.actualSetUp()
+        self._predict_base(context='wstack_multi', fluxthreshold=2.0, vis_slices=41)
+    
+    def test_predict_wstack_multi_spectral_pol(self):
+        self.actualSetUp(dospectral=True, dopol=True)
+        self._predict_base(context='wstack_multi', extra='_spectral', fluxthreshold=4.0, vis_slices=41)
+    
+    def test_predict_idg(self):
+        self.actualSetUp()
+        self._predict_base(context='idg', fluxthreshold=2.0)
+    
+    def test_predict_idg_spectral_pol(self):
+        self.actualSetUp(dospectral=True, dopol=True)
+        self._predict_base(context='idg', extra='_spectral', fluxthreshold=4.0)
+    
     def test_predict_wstack_wprojection(self):
         self.actualSetUp()
         self._predict_base(context='wstack', extra='_wprojection', fluxthreshold=3.0, wstep=2.5, vis_slices=11,
@@ -199,6 +270,134 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp(zerow=True)
         self._invert_base(context='2d', positionthreshold=2.0, check_components=False)
     
+    def test_invert_2d_hermitian(self):
+        self.actualSetUp(zerow=True)
+        self._invert_base(context='2d', extra='_hermitian', positionthreshold=2.0, check_components=False,
+                          hermitian=True)
+    
+    def test_invert_2d_es(self):
+        self.actualSetUp(zerow=True)
+        self._invert_base(context='2d', extra='_es', positionthreshold=1.0, check_components=True, kernel='es',
+                          epsilon=1e-6)
+    
+    def test_invert_2d_fft_friendly(self):
+        self.actualSetUp(zerow=True)
+        # padding * npixel = 332.8 is rounded up to 336 = 2 ** 4 * 3 * 7 but the image keeps its shape
+        self._invert_base(context='2d', extra='_fft_friendly', positionthreshold=1.0, check_components=True,
+                          kernel='es', epsilon=1e-6, padding=1.3)
+        dirty = invert_function(self.vis, self.model, context='2d', kernel='es', epsilon=1e-6, padding=1.3)[0]
+        assert dirty.shape == self.model.shape
+    
+    def test_invert_2d_tiled(self):
+        self.actualSetUp(zerow=True)
+        self._invert_base(context='2d', extra='_tiled', positionthreshold=2.0, check_components=True,
+                          uvgrid_tile=32)
+        dirty_dense, sumwt_dense = invert_function(self.vis, self.model, context='2d')
+        dirty_tiled, sumwt_tiled = invert_function(self.vis, self.model, context='2d', uvgrid_tile=32)
+        numpy.testing.assert_allclose(sumwt_tiled, sumwt_dense)
+        error = numpy.max(numpy.abs(dirty_tiled.data - dirty_dense.data)) / numpy.max(numpy.abs(dirty_dense.data))
+        assert error < 1e-12, "Tiled invert differs from dense by %g" % error
+    
+    def test_invert_dirty_psf(self):
+        self.actualSetUp(zerow=True)
+        # The joint invert must give the same images as two separate inverts
+        for context, kwargs in [('2d', {}), ('2d', {'hermitian': True}), ('facets', {'facets': 2}),
+                                ('timeslice', {'vis_slices': 3})]:
+            dirty, sumwt = invert_function(self.vis, self.model, context=context, **kwargs)
+            psf, _ = invert_function(self.vis, self.model, context=context, dopsf=True, **kwargs)
+            (dirty_joint, sumwt_joint), (psf_joint, _) = invert_dirty_psf_function(self.vis, self.model,
+                                                                                   context=context, **kwargs)
+            numpy.testing.assert_allclose(sumwt_joint, sumwt)
+            numpy.testing.assert_allclose(dirty_joint.data, dirty.data, atol=1e-12)
+            numpy.testing.assert_allclose(psf_joint.data, psf.data, atol=1e-12)
+    
+    def test_residual(self):
+        self.actualSetUp(zerow=True)
+        # The fused residual must give the same results as predict, subtract and invert
+        model = smooth_image(self.model)
+        for context, kwargs in [('2d', {}), ('2d', {'hermitian': True}), ('2d', {'uvgrid_tile': 64}),
+                                ('facets', {'facets': 2})]:
+            vispred = predict_function(copy_visibility(self.vis, zero=True), model, context=context, **kwargs)
+            visres = copy_visibility(self.vis)
+            visres.data['vis'] = self.vis.data['vis'] - vispred.data['vis']
+            dirty, sumwt = invert_function(visres, model, context=context, **kwargs)
+            residual = copy_visibility(self.vis, zero=True)
+            visres_fused, dirty_fused, sumwt_fused = residual_function(self.vis, model, context=context,
+                                                                       residual=residual, **kwargs)
+            assert visres_fused is residual
+            numpy.testing.assert_allclose(visres_fused.data['vis'], visres.data['vis'], atol=1e-12)
+            numpy.testing.assert_allclose(sumwt_fused, sumwt)
+            numpy.testing.assert_allclose(dirty_fused.data, dirty.data, atol=1e-12)
+    
+    def test_image_accumulator(self):
+        self.actualSetUp(zerow=True)
+        # The accumulated sum must be the weighted mean of the images, without changing them
+        dirty, sumwt = invert_function(self.vis, self.model, context='2d')
+        psf, _ = invert_function(self.vis, self.model, context='2d', dopsf=True)
+        original = copy_image(dirty)
+        accumulator = ImageAccumulator()
+        assert len(accumulator) == 0
+        accumulator.add(dirty, sumwt)
+        accumulator.add(psf, 3.0 * sumwt)
+        assert len(accumulator) == 2
+        result, totalwt = accumulator.result()
+        numpy.testing.assert_allclose(totalwt, 4.0 * sumwt)
+        numpy.testing.assert_allclose(result.data, 0.25 * dirty.data + 0.75 * psf.data, atol=1e-12)
+        numpy.testing.assert_array_equal(dirty.data, original.data)
+        # Planes with no weight are zero after normalisation
+        normalized = normalize_sumwt(copy_image(original), numpy.zeros_like(sumwt))
+        assert numpy.max(numpy.abs(normalized.data)) == 0.0
+    
+    def test_timeslice_resampling_map(self):
+        self.actualSetUp(zerow=True)
+        forward = get_lm_resampling_map(self.model, 0.3, -0.2)
+        inverse = get_lm_resampling_map(self.model, 0.3, -0.2, inverse=True)
+        # The maps are calculated once
+        hits = timeslice_cache.hits
+        assert get_lm_resampling_map(self.model, 0.3, -0.2) is forward
+        assert timeslice_cache.hits == hits + 1
+        # The inverse map undoes the forward map
+        composed = numpy.array([map_coordinates(inverse[axis], forward, order=3) for axis in range(2)])
+        pixels = numpy.array(numpy.meshgrid(numpy.arange(self.npixel), numpy.arange(self.npixel), indexing='ij'))
+        inner = (slice(None), slice(16, -16), slice(16, -16))
+        numpy.testing.assert_allclose(composed[inner], pixels[inner], atol=1e-3)
+    
+    def test_invert_2d_aprojection(self):
+        self.actualSetUp(zerow=True)
+        # A-projection gives the dirty image multiplied by the primary beam
+        pb = create_pb_generic(self.model, diameter=35.0, blockage=0.0)
+        dirty = invert_function(self.vis, self.model, context='2d')[0]
+        dirty_aprojection = invert_function(self.vis, self.model, context='2d', kernel='aprojection', pb=pb,
+                                            kernelwidth=32)[0]
+        error = numpy.max(numpy.abs(dirty_aprojection.data - dirty.data * pb.data)) / numpy.max(numpy.abs(dirty.data))
+        assert error < 1e-2, "A-projection invert differs from beam weighted invert by %g" % error
+    
+    def test_invert_predict_buffer_reuse(self):
+        self.actualSetUp(zerow=True)
+        # Repeated major cycles take their padded grids from the buffer pool instead of allocating them
+        buffer_pool.clear()
+        for cycle in range(3):
+            invert_function(self.vis, self.model, context='2d')
+            predict_function(copy_visibility(self.vis, zero=True), self.model, context='2d')
+        stats = buffer_pool.stats()
+        log.info("test_invert_predict_buffer_reuse: buffer pool %s" % str(stats))
+        assert stats['allocations'] == 1, stats
+        assert stats['reuses'] == 5, stats
+        assert stats['in_use_bytes'] == 0, stats
+        assert stats['peak_bytes'] == stats['allocated_bytes'], stats
+    
+    def test_invert_2d_single(self):
+        self.actualSetUp(zerow=True)
+        self._invert_base(context='2d', extra='_single', positionthreshold=2.0, check_components=False,
+                          precision='single')
+        # Single precision grids and kernels change the image by about 1e-7 of the peak
+        dirty_double = invert_function(self.vis, self.model, context='2d', dopsf=False, normalize=True)[0]
+        dirty_single = invert_function(self.vis, self.model, context='2d', dopsf=False, normalize=True,
+                                       precision='single')[0]
+        assert dirty_single.data.dtype == numpy.float32
+        error = numpy.max(numpy.abs(dirty_single.data - dirty_double.data)) / numpy.max(numpy.abs(dirty_double.data))
+        assert error < 1e-5, "Single precision invert differs from double by %g" % error
+    
     def test_invert_facets(self):
         self.actualSetUp()
         self._invert_base(context='facets', positionthreshold=2.0, check_components=True, facets=8)
@@ -234,6 +433,11 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp()
         self._invert_base(context='2d', extra='_wprojection', positionthreshold=2.0, wstep=10.0, oversampling=2)
     
+    def test_invert_wprojection_hermitian(self):
+        self.actualSetUp()
+        self._invert_base(context='2d', extra='_wprojection_hermitian', positionthreshold=2.0, wstep=10.0,
+                          oversampling=2, hermitian=True)
+    
     def test_invert_wprojection_wstack(self):
         self.actualSetUp()
         self._invert_base(context='wstack', extra='_wprojection', positionthreshold=1.0, wstep=2.5, vis_slices=11,
@@ -243,6 +447,26 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp()
         self._invert_base(context='wstack', positionthreshold=1.0, vis_slices=41)
     
+    def test_invert_wstack_multi(self):
+        self.actualSetUp()
+        self._invert_base(context='wstack_multi', positionthreshold=1.0, vis_slices=41)
+        # The planes are at the centres of the w slices rather than at the average w of each slice, which makes a
+        # small difference from the wstack context
+        dirty = invert_function(self.vis, self.model, context='wstack', vis_slices=41)[0]
+        dirty_multi = invert_function(self.vis, self.model, context='wstack_multi', vis_slices=41)[0]
+        error = numpy.max(numpy.abs(dirty_multi.data - dirty.data)) / numpy.max(numpy.abs(dirty.data))
+        assert error < 1e-2, "wstack_multi differs from wstack by %g" % error
+    
+    def test_invert_idg(self):
+        self.actualSetUp()
+        self._invert_base(context='idg', positionthreshold=1.0)
+        # The w term is exact for idg, so the difference from w projection is set by the w projection kernels
+        dirty = invert_function(self.vis, self.model, context='2d', kernel='wprojection', wstep=2.5,
+                                oversampling=4)[0]
+        dirty_idg = invert_function(self.vis, self.model, context='idg')[0]
+        error = numpy.max(numpy.abs(dirty_idg.data - dirty.data)) / numpy.max(numpy.abs(dirty.data))
+        assert error < 1e-1, "idg differs from wprojection by %g" % error
+    
     def test_invert_wstack_spectral(self):
         self.actualSetUp(dospectral=True)
         self._invert_base(context='wstack', extra='_spectral', positionthreshold=2.0,
@@ -0,0 +1,86 @@
+""" Unit tests for the imaging autotuner
+
+
+"""
+import logging
+import tracemalloc
+import unittest
+
+import numpy
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+
+from data_models.polarisation import PolarisationFrame
+
+from processing_components.imaging.autotune import autotune_imaging, autotune_error, autotune_benchmark, \
+    autotune_subsample
+from processing_components.imaging.base import create_image_from_visibility
+from processing_components.imaging.imaging_functions import invert_function
+from processing_components.simulation.testing_support import create_named_configuration
+from processing_components.visibility.base import create_visibility
+
+log = logging.getLogger(__name__)
+
+
+class TestImagingAutotune(unittest.TestCase):
+    def setUp(self):
+        self.lowcore = create_named_configuration('LOWBD2', rmax=300.0)
+        self.times = (numpy.pi / 12.0) * numpy.linspace(-3.0, 3.0, 5)
+        self.frequency = numpy.array([1e8])
+        self.channel_bandwidth = numpy.array([1e6])
+        self.phasecentre = SkyCoord(ra=+180.0 * u.deg, dec=-60.0 * u.deg, frame='icrs', equinox='J2000')
+        self.vis = create_visibility(self.lowcore, times=self.times, frequency=self.frequency,
+                                     phasecentre=self.phasecentre, weight=1.0,
+                                     polarisation_frame=PolarisationFrame('stokesI'),
+                                     channel_bandwidth=self.channel_bandwidth)
+        self.model = create_image_from_visibility(self.vis, npixel=128, cellsize=0.001, nchan=1)
+
+    def test_subsample(self):
+        svis = autotune_subsample(self.vis, 1000)
+        assert svis.nvis == 1000
+        assert numpy.all(numpy.diff(svis.time) >= 0.0)
+
+    def test_error(self):
+        # The w term is large enough that the 2d transform is much less accurate than w stacking
+        error_2d = autotune_error(self.vis, self.model, {'context': '2d', 'kernel': 'es', 'epsilon': 1e-4})
+        error_wstack = autotune_error(self.vis, self.model, {'context': 'wstack', 'vis_slices': 32, 'kernel': 'es',
+                                                             'epsilon': 1e-4})
+        assert error_wstack < 0.1 * error_2d, "Errors %.3g, %.3g" % (error_wstack, error_2d)
+
+    def test_benchmark(self):
+        estimated_time, estimated_memory = autotune_benchmark(self.vis, self.model, {'context': '2d'}, nrows=1000,
+                                                              measure_memory=True)
+        assert estimated_time > 0.0
+        assert estimated_memory > 0.0
+
+    def test_autotune_imaging(self):
+        params = autotune_imaging(self.vis, self.model, max_error=1e-1, strategies=['2d', 'wstack', 'timeslice'],
+                                  nrows=1000, max_slices=16)
+        for key in ['context', 'vis_slices', 'facets', 'padding', 'kernel']:
+            assert key in params, "Missing %s" % key
+        assert params['context'] in ['wstack', 'timeslice']
+        assert autotune_error(self.vis, self.model, params, nrows=1000) < 1e-1
+        psf, sumwt = invert_function(self.vis, self.model, dopsf=True, **params)
+        assert numpy.abs(numpy.max(psf.data) - 1.0) < 1e-2, numpy.max(psf.data)
+
+    def test_autotune_imaging_tracemalloc(self):
+        # The memory cannot be measured if tracemalloc is already tracing
+        tracemalloc.start()
+        try:
+            with self.assertRaises(AssertionError):
+                autotune_imaging(self.vis, self.model, max_error=1e-1, max_memory=2 ** 30, strategies=['2d'])
+        finally:
+            tracemalloc.stop()
+    
+    def test_autotune_imaging_no_candidates(self):
+        # There is no w projection candidate if all w are zero, so the 2d context is used
+        self.vis.data['uvw'][:, 2] = 0.0
+        params = autotune_imaging(self.vis, self.model, max_error=1e-1, strategies=['wprojection'], nrows=1000)
+        assert params['context'] == '2d', params
+        assert params['kernel'] in ['2d', 'es'], params
+        params = autotune_imaging(self.vis, self.model, max_error=1e-1, strategies=[], nrows=1000)
+        assert params['context'] == '2d', params
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,7 +11,7 @@ from astropy.coordinates import SkyCoord
 
 from data_models.polarisation import PolarisationFrame
 
-from libs.imaging.imaging_params import get_frequency_map, w_kernel_list
+from libs.imaging.imaging_params import get_frequency_map, get_rowmap, w_kernel_list, kernel_cache
 
 from processing_components.simulation.testing_support import create_named_configuration, create_low_test_image_from_gleam
 from processing_components.visibility.base import create_visibility
@@ -49,6 +49,15 @@ class TestImagingParams(unittest.TestCase):
         assert numpy.min(vfrequency_map) == 0
         assert spectral_mode == 'channel'
 
+    def test_get_rowmap(self):
+        col = numpy.array([1.2e8, 8e7, 1e8, 8e7, 1.2e8])
+        numpy.testing.assert_array_equal(get_rowmap(col), [2, 0, 1, 0, 2])
+        # Values are matched after rounding
+        numpy.testing.assert_array_equal(get_rowmap(col + 0.1, numpy.array([8e7, 1e8, 1.2e8, 1.4e8])),
+                                         [2, 0, 1, 0, 2])
+        with self.assertRaises(KeyError):
+            get_rowmap(col, numpy.array([8e7, 1e8]))
+    
     def test_get_frequency_map_different_channel(self):
         self.model = create_image_from_visibility(self.vis, npixel=128, cellsize=0.001,
                                                   frequency=self.startfrequency, nchan=3,
@@ -93,6 +102,23 @@ class TestImagingParams(unittest.TestCase):
                                                     wstep=50, oversampling=3,
                                                     maxsupport=128)
 
+    def test_w_kernel_list_cache(self):
+        cache_dir = "%s/test_w_kernel_list_cache" % self.dir
+        kernel_cache.clear()
+        kernel_indices, kernels = w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=50, oversampling=2,
+                                                cache_dir=cache_dir)
+        misses = kernel_cache.misses
+        assert misses >= len(kernels)
+        kernel_indices, cached_kernels = w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=50,
+                                                       oversampling=2, cache_dir=cache_dir)
+        assert kernel_cache.misses == misses
+        assert all(cached is kernel for cached, kernel in zip(cached_kernels, kernels))
+        kernel_cache.clear()
+        kernel_indices, loaded_kernels = w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=50,
+                                                       oversampling=2, cache_dir=cache_dir)
+        for loaded, kernel in zip(loaded_kernels, kernels):
+            numpy.testing.assert_array_equal(loaded, kernel)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -131,6 +131,16 @@ class TestVisibilityOperations(unittest.TestCase):
         summedflux, weight = sum_visibility(self.vismodel, self.compreldirection)
         assert_allclose(self.flux, summedflux, rtol=1e-7)
 
+    def test_predict_skycomponent_iterable(self):
+        # A single component, a list, and a generator of components should all give the same visibility
+        self.vis = create_visibility(self.lowcore, self.times, self.frequency,
+                                     channel_bandwidth=self.channel_bandwidth, phasecentre=self.phasecentre, weight=1.0,
+                                     polarisation_frame=PolarisationFrame("stokesIQUV"))
+        vismodel = predict_skycomponent_visibility(copy_visibility(self.vis, zero=True), self.comp)
+        for sc in [[self.comp], (comp for comp in [self.comp])]:
+            vismodel_iterable = predict_skycomponent_visibility(copy_visibility(self.vis, zero=True), sc)
+            assert_allclose(vismodel_iterable.vis, vismodel.vis, rtol=1e-12)
+
     def test_phase_rotation_identity(self):
         self.vis = create_visibility(self.lowcore, self.times, self.frequency,
                                      channel_bandwidth=self.channel_bandwidth,
@@ -17,7 +17,8 @@ from libs.image.operations import fft_image
 from processing_components.image.operations import export_image_to_fits
 from processing_components.imaging.base import invert_2d
 from processing_components.imaging.base import create_image_from_visibility
-from processing_components.imaging.weighting import weight_visibility, taper_visibility_gaussian, taper_visibility_tukey
+from processing_components.imaging.weighting import weight_visibility, taper_visibility_gaussian, \
+    taper_visibility_tukey, weight_density_visibility
 from processing_components.simulation.testing_support import create_named_configuration
 from processing_components.visibility.base import create_visibility
 
@@ -86,6 +87,46 @@ class TestWeighting(unittest.TestCase):
         assert density is None
         assert densitygrid is None
 
+    def test_weighting_briggs(self):
+        self.actualSetUp()
+        vis, density, densitygrid = weight_visibility(self.componentvis, self.model, weighting='briggs',
+                                                      robustness=0.0)
+        assert numpy.std(vis.imaging_weight) > 0.0
+        assert numpy.all(vis.imaging_weight <= vis.weight)
+        
+        # Compare the weights normalised to unit sum, relative to the largest weight of the limit
+        def normalised_weights(**kwargs):
+            vis, _, _ = weight_visibility(self.componentvis, self.model, **kwargs)
+            return vis.imaging_weight / numpy.sum(vis.imaging_weight)
+        
+        uniform = normalised_weights(weighting='uniform')
+        natural = normalised_weights(weighting='natural')
+        robust = {robustness: normalised_weights(weighting='briggs', robustness=robustness)
+                  for robustness in [-2.0, 0.0, 2.0]}
+        # Robustness -2 is uniform weighting and +2 is close to natural weighting
+        assert numpy.max(numpy.abs(robust[-2.0] - uniform)) < 1e-4 * numpy.max(uniform)
+        assert numpy.max(numpy.abs(robust[2.0] - natural)) < 2e-2 * numpy.max(natural)
+        # In between, each weight lies between its uniform and natural weights, and differs from both
+        assert numpy.all(robust[0.0] >= (1.0 - 1e-12) * numpy.minimum(uniform, natural))
+        assert numpy.all(robust[0.0] <= (1.0 + 1e-12) * numpy.maximum(uniform, natural))
+        assert numpy.max(numpy.abs(robust[0.0] - uniform)) > 1e-3 * numpy.max(uniform)
+        assert numpy.max(numpy.abs(robust[0.0] - natural)) > 1e-1 * numpy.max(natural)
+
+    def test_weighting_super_uniform(self):
+        self.actualSetUp()
+        vis, density, densitygrid = weight_visibility(self.componentvis, self.model, weighting='super_uniform',
+                                                      super_uniform_box=5)
+        assert numpy.std(vis.imaging_weight) > 0.0
+        
+    def test_weighting_densitygrid(self):
+        self.actualSetUp()
+        densitygrid = weight_density_visibility(self.componentvis, self.model)
+        assert densitygrid.shape == self.model.data.shape
+        vis, density, _ = weight_visibility(self.componentvis, self.model, weighting='uniform')
+        uniform = numpy.copy(vis.imaging_weight)
+        vis, _, _ = weight_visibility(self.componentvis, self.model, weighting='uniform', densitygrid=2.0 * densitygrid)
+        numpy.testing.assert_allclose(vis.imaging_weight, 0.5 * uniform)
+
     def test_tapering_Gaussian(self):
         self.actualSetUp()
         size_required = 0.01
@@ -16,7 +16,7 @@ from workflows.arlexecute.execution_support.arlexecute import arlexecute
 from processing_components.image.operations import export_image_to_fits, smooth_image
 from processing_components.imaging.base import predict_skycomponent_visibility
 from workflows.arlexecute.imaging.imaging_workflows import zero_vislist_workflow, predict_workflow, \
-    invert_workflow, subtract_vislist_workflow
+    invert_workflow, subtract_vislist_workflow, invert_dirty_psf_workflow, residual_workflow
 from processing_components.skycomponent.operations import find_skycomponents, find_nearest_skycomponent, \
     insert_skycomponent
 from processing_components.simulation.testing_support import create_named_configuration, ingest_unittest_visibility, \
@@ -223,6 +223,68 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp(zerow=True)
         self._invert_base(context='2d', positionthreshold=2.0, check_components=False)
     
+    def test_invert_2d_single(self):
+        self.actualSetUp(zerow=True)
+        # The gathered and summed images keep the single precision of the inverts
+        for context, kwargs in [('2d', {}), ('facets', {'facets': 2}), ('wstack', {'vis_slices': 3})]:
+            dirty = invert_workflow(self.vis_list, self.model_list, context=context, precision='single', **kwargs)[0]
+            dirty = arlexecute.compute(dirty, sync=True)
+            assert dirty[0].data.dtype == numpy.float32, dirty[0].data.dtype
+    
+    def test_invert_dirty_psf(self):
+        self.actualSetUp()
+        for context, kwargs in [('2d', {}), ('facets', {'facets': 2}), ('wstack', {'vis_slices': 3})]:
+            dirty = invert_workflow(self.vis_list, self.model_list, context=context, dopsf=False, **kwargs)[0]
+            psf = invert_workflow(self.vis_list, self.model_list, context=context, dopsf=True, **kwargs)[0]
+            dirty, psf = arlexecute.compute((dirty, psf), sync=True)
+            dirty_list, psf_list = invert_dirty_psf_workflow(self.vis_list, self.model_list, context=context, **kwargs)
+            dirty_joint, psf_joint = arlexecute.compute((dirty_list[0], psf_list[0]), sync=True)
+            numpy.testing.assert_allclose(dirty_joint[1], dirty[1])
+            numpy.testing.assert_allclose(dirty_joint[0].data, dirty[0].data, atol=1e-12)
+            numpy.testing.assert_allclose(psf_joint[0].data, psf[0].data, atol=1e-12)
+    
+    def test_residual(self):
+        self.actualSetUp()
+        # The single node residual must match zero, predict, subtract and invert
+        model_vis = zero_vislist_workflow(self.vis_list)
+        model_vis = predict_workflow(model_vis, self.model_list, context='2d')
+        residual_vis = subtract_vislist_workflow(self.vis_list, model_vis)
+        dirty = invert_workflow(residual_vis, self.model_list, context='2d')[0]
+        dirty_fused = residual_workflow(self.vis_list, self.model_list, context='2d')[0]
+        dirty, dirty_fused = arlexecute.compute((dirty, dirty_fused), sync=True)
+        numpy.testing.assert_allclose(dirty_fused[1], dirty[1])
+        numpy.testing.assert_allclose(dirty_fused[0].data, dirty[0].data, atol=1e-12)
+    
+    def test_invert_predict_freqwin_batch(self):
+        self.actualSetUp(freqwin=5)
+        # The models of self.model_list have a different cellsize for each frequency window, so are imaged one cube
+        # per window. Models with the cellsize of the highest frequency are imaged in one cube per batch.
+        def common_model(vis, highest_model):
+            cellsize = numpy.deg2rad(abs(highest_model.wcs.wcs.cdelt[1]))
+            return create_unittest_model(vis, self.image_pol, npixel=self.npixel, cellsize=cellsize)
+        
+        common_model_list = [arlexecute.execute(common_model, nout=1)(self.vis_list[freqwin], self.model_list[-1])
+                             for freqwin, _ in enumerate(self.frequency)]
+        common_model_list = [arlexecute.execute(insert_skycomponent, nout=1)(common_model_list[freqwin],
+                                                                             self.components_list[freqwin])
+                             for freqwin, _ in enumerate(self.frequency)]
+        # Batches of frequency windows imaged in one task must match one task per frequency window
+        for model_list in [self.model_list, common_model_list]:
+            for dopsf in [False, True]:
+                dirty = arlexecute.compute(invert_workflow(self.vis_list, model_list, dopsf=dopsf), sync=True)
+                dirty_batch = arlexecute.compute(invert_workflow(self.vis_list, model_list, dopsf=dopsf,
+                                                                 freqwin_batch=2), sync=True)
+                assert len(dirty_batch) == len(dirty)
+                for result, result_batch in zip(dirty, dirty_batch):
+                    numpy.testing.assert_allclose(result_batch[1], result[1])
+                    numpy.testing.assert_allclose(result_batch[0].data, result[0].data, atol=1e-12)
+            
+            vis = arlexecute.compute(predict_workflow(zero_vislist_workflow(self.vis_list), model_list), sync=True)
+            vis_batch = arlexecute.compute(predict_workflow(zero_vislist_workflow(self.vis_list), model_list,
+                                                            freqwin_batch=2), sync=True)
+            for v, v_batch in zip(vis, vis_batch):
+                numpy.testing.assert_allclose(v_batch.vis, v.vis, atol=1e-12)
+    
     def test_invert_facets(self):
         self.actualSetUp()
         self._invert_base(context='facets', positionthreshold=2.0, check_components=True, facets=8)
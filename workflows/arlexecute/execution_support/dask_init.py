@@ -13,7 +13,7 @@ log = logging.getLogger(__name__)
 
 
 def get_dask_Client(timeout=30, n_workers=None, threads_per_worker=1, processes=True, create_cluster=True,
-                    memory_limit=None):
+                    memory_limit=None, numba_warmup=False):
     """ Get a Dask.distributed Client for the scheduler defined externally, otherwise create
 
     The environment variable ARL_DASK_SCHEDULER is interpreted as pointing to the scheduler.
@@ -25,6 +25,7 @@ def get_dask_Client(timeout=30, n_workers=None, threads_per_worker=1, processes=
     :param processes: Use processes instead of threads
     :param create_cluster: Create a LocalCluster
     :param memory_limit: Memory limit per worker (bytes e.g. 8e9)
+    :param numba_warmup: Compile the numba gridding engines on all workers (gridder='numba')
     :return: Dask client
     """
     scheduler = os.getenv('ARL_DASK_SCHEDULER', None)
@@ -58,6 +59,10 @@ def get_dask_Client(timeout=30, n_workers=None, threads_per_worker=1, processes=
     if 'bokeh' in services.keys():
         bokeh_addr = 'http:%s:%s' % (addr.split(':')[1], services['bokeh'])
         print('Diagnostic pages available on port %s' % bokeh_addr)
+    
+    if numba_warmup:
+        from libs.fourier_transforms.convolutional_gridding import numba_warmup as warmup
+        print("Compiling numba gridding engines on workers: %s" % c.run(warmup))
     return c
 
 
@@ -35,15 +35,15 @@ import logging
 import numpy
 
 from data_models.memory_data_models import Image
-from data_models.parameters import get_parameter
+from data_models.parameters import get_parameter, get_precision_dtypes
 from libs.image.operations import copy_image, create_empty_image_like
 from ..execution_support.arlexecute import arlexecute
 from processing_components.image.deconvolution import deconvolve_cube, restore_cube
 from processing_components.image.gather_scatter import image_scatter_facets, image_gather_facets, \
     image_scatter_channels,    image_gather_channels
-from processing_components.imaging.base import normalize_sumwt
+from processing_components.imaging.base import ImageAccumulator
 from processing_components.imaging.imaging_functions import imaging_context
-from processing_components.imaging.weighting import weight_visibility
+from processing_components.imaging.weighting import weight_visibility, weight_density_visibility
 from processing_components.visibility.base import copy_visibility
 from processing_components.visibility.gather_scatter import visibility_scatter, visibility_gather
 from processing_components.image.operations import calculate_image_frequency_moments
@@ -51,37 +51,26 @@ from processing_components.image.operations import calculate_image_frequency_mom
 log = logging.getLogger(__name__)
 
 
-def sum_invert_results(image_list):
+def sum_invert_results(image_list, dtype=None):
     """ Sum a set of invert results with appropriate weighting
 
+    The images are added in place to one image (see ImageAccumulator), which is normalised at the end.
+
     :param image_list: List of [image, sum weights] pairs
+    :param dtype: dtype of the summed image e.g. get_precision_dtypes(kwargs)[0] (default that of the first image)
     :return: image, sum of weights
     """
-    if len(image_list) == 1:
+    if len(image_list) == 1 and (dtype is None or image_list[0][0].data.dtype == dtype):
         return image_list[0]
     
-    first = True
-    sumwt = 0.0
-    im = None
-    for i, arg in enumerate(image_list):
+    accumulator = ImageAccumulator(dtype=dtype)
+    for arg in image_list:
         if arg is not None:
-            if isinstance(arg[1], numpy.ndarray):
-                scale = arg[1][..., numpy.newaxis, numpy.newaxis]
-            else:
-                scale = arg[1]
-            if first:
-                im = copy_image(arg[0])
-                im.data *= scale
-                sumwt = arg[1]
-                first = False
-            else:
-                im.data += scale * arg[0].data
-                sumwt += arg[1]
+            accumulator.add(arg[0], arg[1])
     
-    assert not first, "No invert results"
+    assert len(accumulator) > 0, "No invert results"
     
-    im = normalize_sumwt(im, sumwt)
-    return im, sumwt
+    return accumulator.result()
 
 
 def remove_sumwt(results):
@@ -200,6 +189,106 @@ def weight_vislist_workflow(vis_list, model_imagelist, weighting='uniform', **kw
             for i in range(len(vis_list))]
 
 
+def use_cube_workflow(c, facets=1, vis_slices=1, **kwargs):
+    """ Should the frequency windows be imaged in batches by invert_cube_workflow and predict_cube_workflow?
+
+    This is so if freqwin_batch > 1 and the context has invert_cube and predict_cube functions, without facets or
+    visibility slices.
+
+    :param c: Imaging context (see imaging_context)
+    :param facets: Number of facets
+    :param vis_slices: Number of slices
+    :param kwargs: Parameters for functions in components
+    :return: True or False
+    """
+    return get_parameter(kwargs, "freqwin_batch", 1) > 1 and facets == 1 and vis_slices == 1 and \
+           c.get('invert_cube', None) is not None and c.get('predict_cube', None) is not None
+
+
+def freqwin_batches(nfreqwin, freqwin_batch):
+    """ Split the frequency windows into batches
+
+    :param nfreqwin: Number of frequency windows
+    :param freqwin_batch: Maximum number of frequency windows per batch
+    :return: List of lists of frequency window indices
+    """
+    return [list(range(start, min(start + freqwin_batch, nfreqwin))) for start in range(0, nfreqwin, freqwin_batch)]
+
+
+def invert_cube_workflow(vis_list, template_model_imagelist, dopsf=False, normalize=True, context='2d', **kwargs):
+    """ Invert the frequency windows in batches of freqwin_batch, each batch in one task
+
+    Each task grids all the frequency windows in its batch in one call, with one batched FFT (see invert_2d_cube),
+    instead of making one task per frequency window. This reduces the overheads for spectral line imaging with many
+    frequency windows. The memory used by a task grows with freqwin_batch. Windows whose images differ in shape or
+    cellsize are gridded onto separate cubes within the task. The default freqwin_batch of 1 is one task per window.
+
+    :param vis_list:
+    :param template_model_imagelist: Model used to determine image parameters
+    :param dopsf: Make the PSF instead of the dirty image
+    :param normalize: Normalize by sumwt
+    :param context: Imaging context, with an invert_cube function
+    :param kwargs: Parameters for functions in components
+    :return: list of graphs for (image, sumwt), one per frequency window
+    """
+    invert_cube = imaging_context(context)['invert_cube']
+    freqwin_batch = get_parameter(kwargs, "freqwin_batch", 1)
+    real_dtype, _ = get_precision_dtypes(kwargs)
+    
+    def invert_batch(vis_batch, model_batch):
+        results = [(create_empty_image_like(model, dtype=real_dtype), numpy.zeros([model.nchan, model.npol]))
+                   for model in model_batch]
+        valid = [i for i, vis in enumerate(vis_batch) if vis is not None]
+        if len(valid) > 0:
+            cube_results = invert_cube([vis_batch[i] for i in valid], [model_batch[i] for i in valid], dopsf=dopsf,
+                                       normalize=normalize, **kwargs)
+            for i, result in zip(valid, cube_results):
+                results[i] = result
+        return results
+    
+    results_vislist = list()
+    for batch in freqwin_batches(len(vis_list), freqwin_batch):
+        results = arlexecute.execute(invert_batch, nout=len(batch))([vis_list[i] for i in batch],
+                                                                     [template_model_imagelist[i] for i in batch])
+        results_vislist.extend([results[i] for i in range(len(batch))])
+    return results_vislist
+
+
+def predict_cube_workflow(vis_list, model_imagelist, context='2d', **kwargs):
+    """ Predict the frequency windows in batches of freqwin_batch, each batch in one task
+
+    Each task transforms the models of all the frequency windows in its batch by one batched FFT, and degrids all the
+    visibilities in one call (see predict_2d_cube). The default freqwin_batch of 1 is one task per window.
+
+    :param vis_list:
+    :param model_imagelist: Model used to determine image parameters
+    :param context: Imaging context, with a predict_cube function
+    :param kwargs: Parameters for functions in components
+    :return: List of vis_lists
+    """
+    assert len(vis_list) == len(model_imagelist), "Model must be the same length as the vis_list"
+    
+    predict_cube = imaging_context(context)['predict_cube']
+    freqwin_batch = get_parameter(kwargs, "freqwin_batch", 1)
+    
+    def predict_batch(vis_batch, model_batch):
+        results = [None for vis in vis_batch]
+        valid = [i for i, vis in enumerate(vis_batch) if vis is not None]
+        if len(valid) > 0:
+            cube_results = predict_cube([copy_visibility(vis_batch[i]) for i in valid],
+                                        [model_batch[i] for i in valid], **kwargs)
+            for i, result in zip(valid, cube_results):
+                results[i] = result
+        return results
+    
+    results_vislist = list()
+    for batch in freqwin_batches(len(vis_list), freqwin_batch):
+        results = arlexecute.execute(predict_batch, nout=len(batch))([vis_list[i] for i in batch],
+                                                                     [model_imagelist[i] for i in batch])
+        results_vislist.extend([results[i] for i in range(len(batch))])
+    return results_vislist
+
+
 def invert_workflow(vis_list, template_model_imagelist, dopsf=False, normalize=True,
                      facets=1, vis_slices=1, context='2d', **kwargs):
     """ Sum results from invert, iterating over the scattered image and vis_list
@@ -223,13 +312,20 @@ def invert_workflow(vis_list, template_model_imagelist, dopsf=False, normalize=T
     invert = c['invert']
     inner = c['inner']
     
+    if use_cube_workflow(c, facets, vis_slices, **kwargs):
+        return invert_cube_workflow(vis_list, template_model_imagelist, dopsf=dopsf, normalize=normalize,
+                                    context=context, **kwargs)
+    
     if facets % 2 == 0 or facets == 1:
         actual_number_facets = facets
     else:
         actual_number_facets = max(1, (facets - 1))
     
+    # The images have the dtype of the precision used by invert
+    real_dtype, _ = get_precision_dtypes(kwargs)
+    
     def gather_image_iteration_results(results, template_model):
-        result = create_empty_image_like(template_model)
+        result = create_empty_image_like(template_model, dtype=real_dtype)
         i = 0
         sumwt = numpy.zeros([template_model.nchan, template_model.npol])
         for dpatch in image_scatter_facets(result, facets=facets):
@@ -246,7 +342,7 @@ def invert_workflow(vis_list, template_model_imagelist, dopsf=False, normalize=T
             return invert(vis, model, context=context, dopsf=dopsf, normalize=normalize, facets=facets,
                           vis_slices=vis_slices, **kwargs)
         else:
-            return create_empty_image_like(model), 0.0
+            return create_empty_image_like(model, dtype=real_dtype), 0.0
     
     # Loop over all vis_lists independently
     results_vislist = list()
@@ -267,7 +363,7 @@ def invert_workflow(vis_list, template_model_imagelist, dopsf=False, normalize=T
                 for sub_vis_list in sub_vis_lists:
                     facet_vis_results.append(
                         arlexecute.execute(invert_ignore_none, pure=True)(sub_vis_list, facet_list))
-                vis_results.append(arlexecute.execute(sum_invert_results)(facet_vis_results))
+                vis_results.append(arlexecute.execute(sum_invert_results)(facet_vis_results, dtype=real_dtype))
             
             results_vislist.append(arlexecute.execute(gather_image_iteration_results,
                                                       nout=1)(vis_results, template_model_imagelist[freqwin]))
@@ -281,11 +377,97 @@ def invert_workflow(vis_list, template_model_imagelist, dopsf=False, normalize=T
                 vis_results.append(arlexecute.execute(gather_image_iteration_results, nout=1)(facet_vis_results,
                                                                                               template_model_imagelist[
                                                                                                   freqwin]))
-            results_vislist.append(arlexecute.execute(sum_invert_results)(vis_results))
+            results_vislist.append(arlexecute.execute(sum_invert_results)(vis_results, dtype=real_dtype))
     
     return results_vislist
 
 
+def invert_dirty_psf_workflow(vis_list, template_model_imagelist, normalize=True, facets=1, vis_slices=1,
+                              context='2d', **kwargs):
+    """ Sum results from a joint invert making both the dirty image and the PSF
+
+    For contexts with an invert_dirty_psf function (see invert_dirty_psf_function), each slice and facet is gridded
+    once for both images. For the other contexts, or if freqwin_batch is set (see invert_cube_workflow), this is the
+    same as calling invert_workflow twice.
+
+    :param vis_list:
+    :param template_model_imagelist: Model used to determine image parameters
+    :param normalize: Normalize by sumwt
+    :param facets: Number of facets
+    :param vis_slices: Number of slices
+    :param context: Imaging context
+    :param kwargs: Parameters for functions in components
+    :return: list of graphs for (dirty, sumwt), list of graphs for (psf, sumwt)
+   """
+    
+    if not isinstance(template_model_imagelist, collections.Iterable):
+        template_model_imagelist = [template_model_imagelist]
+    
+    c = imaging_context(context)
+    vis_iter = c['vis_iterator']
+    invert_dirty_psf = c.get('invert_dirty_psf', None)
+    if invert_dirty_psf is None or use_cube_workflow(c, facets, vis_slices, **kwargs):
+        dirty_list = invert_workflow(vis_list, template_model_imagelist, dopsf=False, normalize=normalize,
+                                     facets=facets, vis_slices=vis_slices, context=context, **kwargs)
+        psf_list = invert_workflow(vis_list, template_model_imagelist, dopsf=True, normalize=normalize,
+                                   facets=facets, vis_slices=vis_slices, context=context, **kwargs)
+        return dirty_list, psf_list
+    
+    if facets % 2 == 0 or facets == 1:
+        actual_number_facets = facets
+    else:
+        actual_number_facets = max(1, (facets - 1))
+    
+    real_dtype, _ = get_precision_dtypes(kwargs)
+    
+    def gather_image_iteration_results(results, template_model):
+        gathered = list()
+        for part in range(2):
+            result = create_empty_image_like(template_model, dtype=real_dtype)
+            sumwt = numpy.zeros([template_model.nchan, template_model.npol])
+            for dpatch, facet_result in zip(image_scatter_facets(result, facets=facets), results):
+                dpatch.data[...] = facet_result[part][0].data[...]
+                sumwt += facet_result[part][1]
+            gathered.append((result, sumwt))
+        return tuple(gathered)
+    
+    def sum_invert_dirty_psf_results(results):
+        return sum_invert_results([r[0] for r in results], dtype=real_dtype), \
+               sum_invert_results([r[1] for r in results], dtype=real_dtype)
+    
+    def invert_ignore_none(vis, model):
+        if vis is not None:
+            return invert_dirty_psf(vis, model, context=context, normalize=normalize, facets=facets,
+                                    vis_slices=vis_slices, **kwargs)
+        else:
+            return (create_empty_image_like(model, dtype=real_dtype), 0.0), \
+                   (create_empty_image_like(model, dtype=real_dtype), 0.0)
+    
+    dirty_list = list()
+    psf_list = list()
+    for freqwin, vis_list in enumerate(vis_list):
+        # Create the graph to divide an image into facets. This is by reference.
+        facet_lists = arlexecute.execute(image_scatter_facets, nout=actual_number_facets ** 2)(
+            template_model_imagelist[freqwin], facets=facets)
+        # Create the graph to divide the visibility into slices. This is by copy.
+        sub_vis_lists = arlexecute.execute(visibility_scatter, nout=vis_slices)(vis_list, vis_iter,
+                                                                                vis_slices=vis_slices)
+        
+        vis_results = list()
+        for sub_vis_list in sub_vis_lists:
+            facet_vis_results = list()
+            for facet_list in facet_lists:
+                facet_vis_results.append(
+                    arlexecute.execute(invert_ignore_none, pure=True)(sub_vis_list, facet_list))
+            vis_results.append(arlexecute.execute(gather_image_iteration_results, nout=2)(
+                facet_vis_results, template_model_imagelist[freqwin]))
+        dirty, psf = arlexecute.execute(sum_invert_dirty_psf_results, nout=2)(vis_results)
+        dirty_list.append(dirty)
+        psf_list.append(psf)
+    
+    return dirty_list, psf_list
+
+
 def predict_workflow(vis_list, model_imagelist, vis_slices=1, facets=1, context='2d', **kwargs):
     """Predict, iterating over both the scattered vis_list and image
     
@@ -308,6 +490,9 @@ def predict_workflow(vis_list, model_imagelist, vis_slices=1, facets=1, context=
     predict = c['predict']
     inner = c['inner']
     
+    if use_cube_workflow(c, facets, vis_slices, **kwargs):
+        return predict_cube_workflow(vis_list, model_imagelist, context=context, **kwargs)
+    
     if facets % 2 == 0 or facets == 1:
         actual_number_facets = facets
     else:
@@ -365,6 +550,10 @@ def predict_workflow(vis_list, model_imagelist, vis_slices=1, facets=1, context=
 def residual_workflow(vis, model_imagelist, context='2d', **kwargs):
     """ Create a graph to calculate residual image using w stacking and faceting
 
+    For contexts with a residual function (see residual_function), and no facets, slices or freqwin_batch, the
+    residual of each visibility is calculated in one graph node, predicting, subtracting and inverting in one pass
+    over the data.
+
     :param context: 
     :param vis:
     :param model_imagelist: Model used to determine image parameters
@@ -373,6 +562,22 @@ def residual_workflow(vis, model_imagelist, context='2d', **kwargs):
     :param kwargs: Parameters for functions in components
     :return:
     """
+    c = imaging_context(context)
+    residual = c.get('residual', None)
+    facets = get_parameter(kwargs, 'facets', 1)
+    vis_slices = get_parameter(kwargs, 'vis_slices', 1)
+    if residual is not None and facets == 1 and vis_slices == 1 and not use_cube_workflow(c, **kwargs):
+        
+        def residual_ignore_none(vis, model):
+            if vis is not None:
+                _, dirty, sumwt = residual(vis, model, normalize=True, **kwargs)
+                return dirty, sumwt
+            else:
+                return create_empty_image_like(model, dtype=get_precision_dtypes(kwargs)[0]), 0.0
+        
+        return [arlexecute.execute(residual_ignore_none, pure=True, nout=1)(v, model_imagelist[i])
+                for i, v in enumerate(vis)]
+    
     model_vis = zero_vislist_workflow(vis)
     model_vis = predict_workflow(model_vis, model_imagelist, context=context, **kwargs)
     residual_vis = subtract_vislist_workflow(vis, model_vis)
@@ -545,22 +750,51 @@ def deconvolve_channel_workflow(dirty_list, psf_list, model_imagelist, subimages
 def weight_workflow(vis_list, model_imagelist, weighting='uniform', **kwargs):
     """ Weight the visibility data
 
+    Except for natural weighting, the density of weights is gridded for each element of vis_list and the grids
+    are summed, so that all elements (e.g. time slices and frequency windows) are weighted by the density of all of
+    the data. The model images must therefore all have the same shape. Set global_weighting=False to weight each
+    element by its own density instead.
+
     :param vis_list:
     :param model_imagelist: Model required to determine weighting parameters
-    :param weighting: Type of weighting
+    :param weighting: Type of weighting: 'natural' | 'uniform' | 'briggs' | 'super_uniform'
     :param kwargs: Parameters for functions in graphs
     :return: List of vis_graphs
    """
     
-    def weight_vis(vis, model):
+    def weight_vis(vis, model, densitygrid=None):
         if vis is not None:
             if model is not None:
-                vis, _, _ = weight_visibility(vis, model, weighting=weighting, **kwargs)
+                vis, _, _ = weight_visibility(vis, model, weighting=weighting, densitygrid=densitygrid, **kwargs)
                 return vis
             else:
                 return None
         else:
             return None
     
-    return [arlexecute.execute(weight_vis, pure=True, nout=1)(vis_list[i], model_imagelist[i])
+    if weighting in ['', 'natural'] or not get_parameter(kwargs, "global_weighting", True):
+        return [arlexecute.execute(weight_vis, pure=True, nout=1)(vis_list[i], model_imagelist[i])
+                for i in range(len(vis_list))]
+    
+    def density_vis(vis, model):
+        if vis is not None and model is not None:
+            return weight_density_visibility(vis, model, **kwargs)
+        else:
+            return None
+    
+    def sum_density(density_list):
+        densitygrid = None
+        for d in density_list:
+            if d is not None:
+                if densitygrid is None:
+                    densitygrid = numpy.copy(d)
+                else:
+                    assert densitygrid.shape == d.shape, "Global weighting needs model images of the same shape"
+                    densitygrid += d
+        return densitygrid
+    
+    density_list = [arlexecute.execute(density_vis, pure=True, nout=1)(vis_list[i], model_imagelist[i])
+                    for i in range(len(vis_list))]
+    densitygrid = arlexecute.execute(sum_density, pure=True, nout=1)(density_list)
+    return [arlexecute.execute(weight_vis, pure=True, nout=1)(vis_list[i], model_imagelist[i], densitygrid)
             for i in range(len(vis_list))]
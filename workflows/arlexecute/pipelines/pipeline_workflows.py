@@ -6,7 +6,7 @@ from ..calibration.calibration_workflows import calibrate_workflow
 from ..execution_support.arlexecute import arlexecute
 from workflows.arlexecute.imaging.imaging_workflows import invert_workflow, residual_workflow, \
     predict_workflow, zero_vislist_workflow, subtract_vislist_workflow, restore_workflow, \
-    deconvolve_workflow
+    deconvolve_workflow, invert_dirty_psf_workflow
 
 
 def ical_workflow(vis_list, model_imagelist, context='2d', calibration_context='TG', do_selfcal=True, **kwargs):
@@ -20,8 +20,6 @@ def ical_workflow(vis_list, model_imagelist, context='2d', calibration_context='
     :param kwargs: Parameters for functions in components
     :return:
     """
-    psf_imagelist = invert_workflow(vis_list, model_imagelist, dopsf=True, context=context, **kwargs)
-    
     model_vislist = zero_vislist_workflow(vis_list)
     model_vislist = predict_workflow(model_vislist, model_imagelist, context=context, **kwargs)
     if do_selfcal:
@@ -30,12 +28,13 @@ def ical_workflow(vis_list, model_imagelist, context='2d', calibration_context='
         vis_list = calibrate_workflow(vis_list, model_vislist,
                                        calibration_context=calibration_context, **kwargs)
         residual_vislist = subtract_vislist_workflow(vis_list, model_vislist)
-        residual_imagelist = invert_workflow(residual_vislist, model_imagelist, dopsf=True, context=context,
-                                              iteration=0, **kwargs)
+        residual_imagelist, psf_imagelist = invert_dirty_psf_workflow(residual_vislist, model_imagelist,
+                                                                      context=context, iteration=0, **kwargs)
     else:
-        # If we are not selfcalibrating it's much easier and we can avoid an unnecessary round of gather/scatter
-        # for visibility partitioning such as timeslices and wstack.
-        residual_imagelist = residual_workflow(vis_list, model_imagelist, context=context, **kwargs)
+        # The residual image and the PSF are made in the same pass over the residual visibility
+        residual_vislist = subtract_vislist_workflow(vis_list, model_vislist)
+        residual_imagelist, psf_imagelist = invert_dirty_psf_workflow(residual_vislist, model_imagelist,
+                                                                      context=context, **kwargs)
     
     deconvolve_model_imagelist, _ = deconvolve_workflow(residual_imagelist, psf_imagelist, model_imagelist,
                                                          prefix='cycle 0', **kwargs)
@@ -79,9 +78,12 @@ def continuum_imaging_workflow(vis_list, model_imagelist, context='2d', **kwargs
     :param kwargs: Parameters for functions in components
     :return:
     """
-    psf_imagelist = invert_workflow(vis_list, model_imagelist, dopsf=True, context=context, **kwargs)
-    
-    residual_imagelist = residual_workflow(vis_list, model_imagelist, context=context, **kwargs)
+    # The residual image and the PSF are made in the same pass over the residual visibility
+    model_vislist = zero_vislist_workflow(vis_list)
+    model_vislist = predict_workflow(model_vislist, model_imagelist, context=context, **kwargs)
+    residual_vislist = subtract_vislist_workflow(vis_list, model_vislist)
+    residual_imagelist, psf_imagelist = invert_dirty_psf_workflow(residual_vislist, model_imagelist,
+                                                                  context=context, **kwargs)
     deconvolve_model_imagelist, _ = deconvolve_workflow(residual_imagelist, psf_imagelist, model_imagelist,
                                                          prefix='cycle 0',
                                                          **kwargs)